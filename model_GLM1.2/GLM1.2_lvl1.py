@@ -167,47 +167,15 @@ def get_subs(cons):
 
 # Function for extracting the motion parameters from the noise files
 def motion_noise(subjinfo, files):
-    import numpy as np
-    motion_noise_params = []
-    motion_noi_par_names = []
-    # If each instance of files is not a list, make it one
+    # Each file is parsed once into a cached array (last three volumes dropped) and attached by reference
+    from wmaze_utility.confound_util import load_run_confounds, attach_confounds
     if not isinstance(files, list):
         files = [files]
-    # If each instance of subjinfo is not a list, make it one
     if not isinstance(subjinfo, list):
         subjinfo = [subjinfo]
-    # For each instance of files
-    for j,i in enumerate(files):
-        curr_mot_noi_par_names = ['Pitch (rad)', 'Roll (rad)', 'Yaw (rad)', 'Tx (mm)', 'Ty (mm)', 'Tz (mm)',
-                                  'Pitch_1d', 'Roll_1d', 'Yaw_1d', 'Tx_1d', 'Ty_1d', 'Tz_1d',
-                                  'Norm (mm)', 'LG_1stOrd', 'LG_2ndOrd', 'LG_3rdOrd', 'LG_4thOrd']
-        # Numpy array of each motion noise files
-        a_orig = np.genfromtxt(i)
-        a = a_orig[:-3]
-        motion_noise_params.append([[]] * a.shape[1])
-        # If there are more than 17 motion noise parameters
-        if a.shape[1] > 17:
-            # For those additional noise parameters over 17
-            for num_out in range(a.shape[1] - 17):
-                # Give it a name
-                out_name = 'out_{0}'.format(num_out + 1)
-                curr_mot_noi_par_names.append(out_name)
-        # For each instance in the second column of a
-        for z in range(a.shape[1]):
-            motion_noise_params[j][z] = a[:, z].tolist()
-        motion_noi_par_names.append(curr_mot_noi_par_names)
-    # For each instace of subjinfo    
+    confounds = [load_run_confounds(i, trim = 3) for i in files]
     for j,i in enumerate(subjinfo):
-        # If there are are no regressor names
-        if i.regressor_names == None: 
-            i.regressor_names = []
-        # If there are no regressors
-        if i.regressors == None: 
-            i.regressors = []
-        # For each instance of motion_noise_params in the current iteration of subjinfo
-        for j3, i3 in enumerate(motion_noise_params[j]):
-            i.regressor_names.append(motion_noi_par_names[j][j3])
-            i.regressors.append(i3)          
+        attach_confounds(i, confounds[j])
     return subjinfo
 
 ###################################
@@ -217,6 +185,9 @@ def motion_noise(subjinfo, files):
 
 def firstlevel_wf(subject_id,
                   sink_directory,
+                  engine = 'fsl',
+                  batch_runs = False,
+                  store = False,
                   name = 'wmaze_frstlvl_wf'):
     # Create the frstlvl workflow
     frstlvl_wf = Workflow(name = 'frstlvl_wf')
@@ -287,14 +258,19 @@ def firstlevel_wf(subject_id,
 
 
 
-    # Function to remove last three volumes from functional data
-                                    # Start from the first volume and end on the -3 volume
-    fslroi_epi = MapNode(ExtractROI(t_min = 0, t_size = 197),
-                         iterfield = ['in_file'],
-                         name = 'fslroi_epi')
-    fslroi_epi.output_type = 'NIFTI_GZ'
-    fslroi_epi.terminal_output = 'stream'
-    frstlvl_wf.connect(datasource, 'task_mri_files', fslroi_epi, 'in_file')
+    if engine == 'native':
+        # The estimator keeps the first 197 volumes while loading each run, no trimmed copy is written
+        epi_source, epi_field = datasource, 'task_mri_files'
+    else:
+        # Function to remove last three volumes from functional data
+                                        # Start from the first volume and end on the -3 volume
+        fslroi_epi = MapNode(ExtractROI(t_min = 0, t_size = 197),
+                             iterfield = ['in_file'],
+                             name = 'fslroi_epi')
+        fslroi_epi.output_type = 'NIFTI_GZ'
+        fslroi_epi.terminal_output = 'stream'
+        frstlvl_wf.connect(datasource, 'task_mri_files', fslroi_epi, 'in_file')
+        epi_source, epi_field = fslroi_epi, 'roi_file'
 
 
 
@@ -323,7 +299,7 @@ def firstlevel_wf(subject_id,
     # Time between start of one volume and the start of following volume
     specify_model.inputs.time_repetition = 2.0
     # Editted data files for model -- list of 4D files
-    frstlvl_wf.connect(fslroi_epi, 'roi_file', specify_model, 'functional_runs')
+    frstlvl_wf.connect(epi_source, epi_field, specify_model, 'functional_runs')
     # List of event description files in 3 column format corresponding to onsets, durations, and amplitudes 
     frstlvl_wf.connect(motionnoise, 'subjinfo', specify_model, 'subject_info')
 
@@ -344,60 +320,86 @@ def firstlevel_wf(subject_id,
     modelfit_inputspec.inputs.interscan_interval = 2.0
     # Create model serial correlations for Level1Design
     modelfit_inputspec.inputs.model_serial_correlations = True
-    frstlvl_wf.connect(fslroi_epi, 'roi_file', modelfit_inputspec, 'functional_data')
+    frstlvl_wf.connect(epi_source, epi_field, modelfit_inputspec, 'functional_data')
     frstlvl_wf.connect(getcontrasts, 'contrasts', modelfit_inputspec, 'contrasts')
     frstlvl_wf.connect(specify_model, 'session_info', modelfit_inputspec, 'session_info')
    
 
 
-    # Creates a first level SPM design matrix to demonstrate contrasts and motion/noise regressors
-    level1_design = MapNode(Level1Design(),
-                            iterfield = ['contrasts', 'session_info'],
-                            name = 'level1_design')
-    level1_design.inputs.ignore_exception = False
-    # Inputs the interscan interval (in secs)
-    frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', level1_design, 'interscan_interval')
-    # Session specific information generated by ``modelgen.SpecifyModel``
-    frstlvl_wf.connect(modelfit_inputspec, 'session_info', level1_design, 'session_info')
-    # List of contrasts with each contrast being a list of the form -[('name', 'stat', [condition list], [weight list], [session list])].
-    # If session list is None or not provided, all sessions are used.
-    frstlvl_wf.connect(modelfit_inputspec, 'contrasts', level1_design, 'contrasts')
-    # Name of basis function and options e.g., {'dgamma': {'derivs': True}}
-    frstlvl_wf.connect(modelfit_inputspec, 'bases', level1_design, 'bases')
-    # Option to model serial correlations using an autoregressive estimator (order 1)
-    # Setting this option is only useful in the context of the fsf file
-    frstlvl_wf.connect(modelfit_inputspec, 'model_serial_correlations', level1_design, 'model_serial_correlations')
+    if engine == 'native':
+        # Design and contrast matrices built in-process, no fsf file or feat_model (see wmaze_utility.design_util)
+        from wmaze_utility.interfaces import Level1DesignNative
+        generate_model = MapNode(Level1DesignNative(),
+                                 iterfield = ['contrasts', 'session_info'],
+                                 name = 'generate_model')
+        frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', generate_model, 'interscan_interval')
+        frstlvl_wf.connect(modelfit_inputspec, 'session_info', generate_model, 'session_info')
+        frstlvl_wf.connect(modelfit_inputspec, 'contrasts', generate_model, 'contrasts')
+        frstlvl_wf.connect(modelfit_inputspec, 'bases', generate_model, 'bases')
+        generate_model.inputs.n_vols = 197
+    else:
+        # Creates a first level SPM design matrix to demonstrate contrasts and motion/noise regressors
+        level1_design = MapNode(Level1Design(),
+                                iterfield = ['contrasts', 'session_info'],
+                                name = 'level1_design')
+        level1_design.inputs.ignore_exception = False
+        # Inputs the interscan interval (in secs)
+        frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', level1_design, 'interscan_interval')
+        # Session specific information generated by ``modelgen.SpecifyModel``
+        frstlvl_wf.connect(modelfit_inputspec, 'session_info', level1_design, 'session_info')
+        # List of contrasts with each contrast being a list of the form -[('name', 'stat', [condition list], [weight list], [session list])].
+        # If session list is None or not provided, all sessions are used.
+        frstlvl_wf.connect(modelfit_inputspec, 'contrasts', level1_design, 'contrasts')
+        # Name of basis function and options e.g., {'dgamma': {'derivs': True}}
+        frstlvl_wf.connect(modelfit_inputspec, 'bases', level1_design, 'bases')
+        # Option to model serial correlations using an autoregressive estimator (order 1)
+        # Setting this option is only useful in the context of the fsf file
+        frstlvl_wf.connect(modelfit_inputspec, 'model_serial_correlations', level1_design, 'model_serial_correlations')
 
     
 
-    # Create a MapNode to generate a design.mat file for each run
-    generate_model = MapNode(FEATModel(),
-                             iterfield = ['fsf_file', 'ev_files'],
-                             name = 'generate_model') 
-    generate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    generate_model.inputs.ignore_exception = False
-    generate_model.inputs.output_type = 'NIFTI_GZ'
-    generate_model.inputs.terminal_output = 'stream'
-    # File specifying the feat design spec file 
-    frstlvl_wf.connect(level1_design, 'fsf_files', generate_model, 'fsf_file')
-    # Event spec files generated by level1design (condition information files)
-    frstlvl_wf.connect(level1_design, 'ev_files', generate_model, 'ev_files')
+        # Create a MapNode to generate a design.mat file for each run
+        generate_model = MapNode(FEATModel(),
+                                 iterfield = ['fsf_file', 'ev_files'],
+                                 name = 'generate_model') 
+        generate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        generate_model.inputs.ignore_exception = False
+        generate_model.inputs.output_type = 'NIFTI_GZ'
+        generate_model.inputs.terminal_output = 'stream'
+        # File specifying the feat design spec file 
+        frstlvl_wf.connect(level1_design, 'fsf_files', generate_model, 'fsf_file')
+        # Event spec files generated by level1design (condition information files)
+        frstlvl_wf.connect(level1_design, 'ev_files', generate_model, 'ev_files')
 
     
 
     # Create a MapNode to estimate the model using FILMGLS -- fits the design matrix to the voxel timeseries
-    estimate_model = MapNode(FILMGLS(),
-                             iterfield = ['design_file', 'in_file', 'tcon_file'],
-                             name = 'estimate_model')
-    estimate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    estimate_model.inputs.ignore_exception = False
+    if engine == 'native':
+        # In-process prewhitened GLM with the same outputs (see wmaze_utility.glm_util)
+        from wmaze_utility.interfaces import FILMGLSNative, FILMGLSNativeRuns
+        if batch_runs or store:
+            # One node fits every run, reusing the mask and reading the next run during each fit
+            estimate_model = Node(FILMGLSNativeRuns(), name = 'estimate_model')
+        else:
+            estimate_model = MapNode(FILMGLSNative(),
+                                     iterfield = ['design_file', 'in_file', 'tcon_file'],
+                                     name = 'estimate_model')
+        estimate_model.inputs.n_vols = 197
+        estimate_model.inputs.stats = ['pe', 'cope', 'varcope', 'zstat', 'pval'] # tstats are not used downstream
+        estimate_model.inputs.final_names = True # written as the DataSink substitutions would name them
+    else:
+        estimate_model = MapNode(FILMGLS(),
+                                 iterfield = ['design_file', 'in_file', 'tcon_file'],
+                                 name = 'estimate_model')
+        estimate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        estimate_model.inputs.ignore_exception = False
+        estimate_model.inputs.output_type = 'NIFTI_GZ'
+        estimate_model.inputs.terminal_output = 'stream'
     # Susan-smooth mask size
     estimate_model.inputs.mask_size = 5
-    estimate_model.inputs.output_type = 'NIFTI_GZ'
     estimate_model.inputs.results_dir = 'results'
     # Smooth auto-correlation estimates
     estimate_model.inputs.smooth_autocorr = True
-    estimate_model.inputs.terminal_output = 'stream'
     frstlvl_wf.connect(modelfit_inputspec, 'film_threshold', estimate_model, 'threshold')
     frstlvl_wf.connect(modelfit_inputspec, 'functional_data', estimate_model, 'in_file')
     # Mat file containing ascii matrix for design
@@ -406,6 +408,20 @@ def firstlevel_wf(subject_id,
     frstlvl_wf.connect(generate_model, 'con_file', estimate_model, 'tcon_file')
 
 
+    # Statistics store: in-mask arrays go straight to {sink}/{subject}/modelfit/store
+    # (see wmaze_utility.stat_store), so no NIfTI maps, z2pval or DataSink stages are needed
+    if engine == 'native' and store:
+        estimate_model.inputs.store_dir = os.path.join(sink_directory, subject_id, 'modelfit', 'store')
+        # manifest of the store runs for the lvl2 scripts (see wmaze_utility.manifest_util)
+        from wmaze_utility.manifest_util import sink_manifest
+        manifest = Node(Function(input_names = ['sunk', 'modelfit_dir'], output_names = ['manifest'],
+                                 function = sink_manifest),
+                        name = 'manifest')
+        manifest.inputs.modelfit_dir = os.path.join(sink_directory, subject_id, 'modelfit')
+        frstlvl_wf.connect(estimate_model, 'store_dir', manifest, 'sunk')
+        return frstlvl_wf
+
+
 
     # Create a merge node to merge the contrasts - necessary for fsl 5.0.7 and greater
     merge_contrasts = MapNode(Merge(2), 
@@ -416,21 +432,23 @@ def firstlevel_wf(subject_id,
 
 
     # Create a MapNode to transform the z2pval
-    z2pval = MapNode(ImageMaths(),  
-                     iterfield = ['in_file'], 
-                     name='z2pval')
-    z2pval.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    # Do not ignore exceptions
-    z2pval.inputs.ignore_exception = False
-    # Defines the operation used
-    z2pval.inputs.op_string = '-ztop'
-    # Set the outfile type to nii.gz
-    z2pval.inputs.output_type = 'NIFTI_GZ'
-    # Out-file suffix
-    z2pval.inputs.suffix = '_pval'
-    # Set output to stream in terminal
-    z2pval.inputs.terminal_output = 'stream'
-    frstlvl_wf.connect(merge_contrasts, ('out', pop_lambda), z2pval, 'in_file')
+    if engine != 'native':
+        # The native estimator writes the p maps while the zstats are in memory
+        z2pval = MapNode(ImageMaths(),  
+                         iterfield = ['in_file'], 
+                         name='z2pval')
+        z2pval.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        # Do not ignore exceptions
+        z2pval.inputs.ignore_exception = False
+        # Defines the operation used
+        z2pval.inputs.op_string = '-ztop'
+        # Set the outfile type to nii.gz
+        z2pval.inputs.output_type = 'NIFTI_GZ'
+        # Out-file suffix
+        z2pval.inputs.suffix = '_pval'
+        # Set output to stream in terminal
+        z2pval.inputs.terminal_output = 'stream'
+        frstlvl_wf.connect(merge_contrasts, ('out', pop_lambda), z2pval, 'in_file')
 
 
 
@@ -450,7 +468,10 @@ def firstlevel_wf(subject_id,
     # All zstats across runs
     frstlvl_wf.connect(merge_contrasts, 'out', modelfit_outputspec, 'zstats')
     # 
-    frstlvl_wf.connect(z2pval, 'out_file', modelfit_outputspec, 'pfiles')
+    if engine == 'native':
+        frstlvl_wf.connect(estimate_model, ('pvals', pop_lambda), modelfit_outputspec, 'pfiles')
+    else:
+        frstlvl_wf.connect(z2pval, 'out_file', modelfit_outputspec, 'pfiles')
     # Graphical representation of design matrix
     frstlvl_wf.connect(generate_model, 'design_image', modelfit_outputspec, 'design_image')
     # Mat file containing ascii matrix for design
@@ -485,6 +506,15 @@ def firstlevel_wf(subject_id,
     frstlvl_wf.connect(modelfit_outputspec, 'design_file', sinkd, 'modelfit.design.@matrix')
     frstlvl_wf.connect(modelfit_outputspec, 'pfiles', sinkd, 'modelfit.contrasts.@pstats')
 
+
+    # manifest of the sunk outputs (run, contrast, stat, path, dof) for the lvl2 scripts (see wmaze_utility.manifest_util)
+    from wmaze_utility.manifest_util import sink_manifest
+    manifest = Node(Function(input_names = ['sunk', 'modelfit_dir'], output_names = ['manifest'],
+                             function = sink_manifest),
+                    name = 'manifest')
+    manifest.inputs.modelfit_dir = os.path.join(sink_directory, subject_id, 'modelfit')
+    frstlvl_wf.connect(sinkd, 'out_file', manifest, 'sunk')
+
     return frstlvl_wf
 
 
@@ -497,6 +527,9 @@ def create_frstlvl_workflow(args, name = 'wmaze_MR_frstlvl'):
     # Creates a dictionary containing variables subject_id, sink_directory, and name
     kwargs = dict(subject_id = args.subject_id,
                   sink_directory = os.path.abspath(args.out_dir),
+                  engine = args.engine,
+                  batch_runs = args.batch_runs,
+                  store = args.store,
                   name = name)
     # Passes the value of all dictionary items to firstlevel_wf
     frstlvl_workflow = firstlevel_wf(**kwargs)
@@ -518,8 +551,24 @@ if __name__ == "__main__":
     # Add argument for working directory when you flag "-w"
     parser.add_argument("-w", "--work_dir", dest = "work_dir",
                         help = "Working directory base")
+    # Add argument for the model estimation engine when you flag "-e"
+    parser.add_argument("-e", "--engine", dest = "engine", default = 'fsl',
+                        choices = ['fsl', 'native'], help = "Model estimation engine")
+    # Add argument to fit all runs of the subject in one process when you flag "-b" (native engine)
+    parser.add_argument("-b", "--batch_runs", dest = "batch_runs", action = 'store_true',
+                        help = "Fit all runs in one process (native engine)")
+    # Add argument to write in-mask statistics to a store when you flag "-S" (native engine)
+    parser.add_argument("-S", "--store", dest = "store", action = 'store_true',
+                        help = "Write in-mask statistics to a store instead of NIfTI maps (native engine)")
+    # Add argument for the precision of stored and loaded image data when you flag "-P"
+    parser.add_argument("-P", "--precision", dest = "precision", choices = ['float32', 'float64'],
+                        help = "Image data precision (default float32, see wmaze_utility.precision)")
     # Parser arguments are passed to the create_frstlvl_workflow function
     args = parser.parse_args()
+    # Every node (and SLURM job) started from here inherits the precision
+    if args.precision:
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
 
     # Object containing all important workflow info
     wf = create_frstlvl_workflow(args)
@@ -7,13 +7,24 @@ subjs = ['WMAZE_001', 'WMAZE_002', 'WMAZE_004', 'WMAZE_005', 'WMAZE_006', 'WMAZE
 workdir = '/scratch/madlab/crash/model_GLM1/status/lvl2'
 outdir = '/home/data/madlab/data/mri/wmaze/scndlvl/model_GLM1'
 
-for sid in subjs:
-    #flexible command to execute script with kwarg flags and respective information using python
-    convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_GLM1/GLM1_lvl2.py', '-s', sid, '-o', outdir, '-w', workdir])
-    
-    # Submission statement of the shell file to the SLURM scheduler
-    outcmd = 'sbatch -J atm-fixed_wmaze_lvl2_curve-{0} -p investor --qos pq_madlab \
-             -e /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/err_{0} \
-             -o /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+#True: one job combining every subject in-process (native fixed effects, see wmaze_utility.cohort_util)
+cohort = False
+
+if cohort:
+    convertcmd = ' '.join(['cd', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test', '&&', 'python', '-m', 'wmaze_utility.cohort_util', '-m', 'GLM1',
+                           '-o', outdir, '-n', '8', '-s'] + subjs)
+    outcmd = 'sbatch -J atm-fixed_wmaze_lvl2_curve-cohort -p investor --qos pq_madlab -N 1 -n 8 \
+             -e /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/err_cohort \
+             -o /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/out_cohort --wrap="{0}"'.format(convertcmd)
     os.system(outcmd)
-    continue
+else:
+    for sid in subjs:
+        #flexible command to execute script with kwarg flags and respective information using python
+        convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_GLM1/GLM1_lvl2.py', '-s', sid, '-o', outdir, '-w', workdir])
+    
+        # Submission statement of the shell file to the SLURM scheduler
+        outcmd = 'sbatch -J atm-fixed_wmaze_lvl2_curve-{0} -p investor --qos pq_madlab \
+                 -e /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/err_{0} \
+                 -o /scratch/madlab/crash/mandy_crash/model_GLM1/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+        os.system(outcmd)
+        continue
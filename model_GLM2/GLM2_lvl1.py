@@ -200,34 +200,15 @@ def get_subs(cons): #function for naming the output types
 
 #function for extracting the motion parameters from the noise files
 def motion_noise(subjinfo, files):
-    import numpy as np
-    motion_noise_params = []
-    motion_noi_par_names = []
+    #Each file is parsed once into a cached array and attached by reference
+    from wmaze_utility.confound_util import load_run_confounds, attach_confounds
     if not isinstance(files, list):
         files = [files]
     if not isinstance(subjinfo, list):
         subjinfo = [subjinfo]
-    for j,i in enumerate(files):
-        curr_mot_noi_par_names = ['Pitch (rad)', 'Roll (rad)', 'Yaw (rad)', 'Tx (mm)', 'Ty (mm)', 'Tz (mm)',
-                                  'Pitch_1d', 'Roll_1d', 'Yaw_1d', 'Tx_1d', 'Ty_1d', 'Tz_1d',
-                                  'Norm (mm)', 'LG_1stOrd', 'LG_2ndOrd', 'LG_3rdOrd', 'LG_4thOrd']
-        a = np.genfromtxt(i)
-        motion_noise_params.append([[]] * a.shape[1])
-        if a.shape[1] > 17:
-            for num_out in range(a.shape[1] - 17):
-                out_name = 'out_{0}'.format(num_out + 1)
-                curr_mot_noi_par_names.append(out_name)
-        for z in range(a.shape[1]):
-            motion_noise_params[j][z] = a[:, z].tolist()
-        motion_noi_par_names.append(curr_mot_noi_par_names)
+    confounds = [load_run_confounds(i) for i in files]
     for j,i in enumerate(subjinfo):
-        if i.regressor_names == None: 
-            i.regressor_names = []
-        if i.regressors == None: 
-            i.regressors = []
-        for j3, i3 in enumerate(motion_noise_params[j]):
-            i.regressor_names.append(motion_noi_par_names[j][j3])
-            i.regressors.append(i3)           
+        attach_confounds(i, confounds[j])
     return subjinfo
 
 ###################################
@@ -237,6 +218,9 @@ def motion_noise(subjinfo, files):
 
 def firstlevel_wf(subject_id,
                   sink_directory,
+                  engine = 'fsl',
+                  batch_runs = False,
+                  store = False,
                   name = 'wmaze_frstlvl_wf'):
     frstlvl_wf = Workflow(name = 'frstlvl_wf')
     
@@ -291,13 +275,18 @@ def firstlevel_wf(subject_id,
     datasource.inputs.raise_on_empty = True
 
 
-    #function node to remove last three volumes from functional data
-    fslroi_epi = MapNode(ExtractROI(t_min = 0, t_size = 197),  #start from first volume and end on -3
-                         iterfield = ['in_file'],
-                         name = 'fslroi_epi')
-    fslroi_epi.output_type = 'NIFTI_GZ'
-    fslroi_epi.terminal_output = 'stream'
-    frstlvl_wf.connect(datasource, 'task_mri_files', fslroi_epi, 'in_file')
+    if engine == 'native':
+        #The estimator keeps the first 197 volumes while loading each run, no trimmed copy is written
+        epi_source, epi_field = datasource, 'task_mri_files'
+    else:
+        #function node to remove last three volumes from functional data
+        fslroi_epi = MapNode(ExtractROI(t_min = 0, t_size = 197),  #start from first volume and end on -3
+                             iterfield = ['in_file'],
+                             name = 'fslroi_epi')
+        fslroi_epi.output_type = 'NIFTI_GZ'
+        fslroi_epi.terminal_output = 'stream'
+        frstlvl_wf.connect(datasource, 'task_mri_files', fslroi_epi, 'in_file')
+        epi_source, epi_field = fslroi_epi, 'roi_file'
 
 
     #function node to modify the motion and noise files to be single regressors
@@ -317,7 +306,7 @@ def firstlevel_wf(subject_id,
     specify_model.inputs.ignore_exception = False
     specify_model.inputs.input_units = 'secs' #input units in either 'secs' or 'scans'
     specify_model.inputs.time_repetition = 2.0 #TR
-    frstlvl_wf.connect(fslroi_epi, 'roi_file', specify_model, 'functional_runs') #editted data files for model -- list of 4D files
+    frstlvl_wf.connect(epi_source, epi_field, specify_model, 'functional_runs') #editted data files for model -- list of 4D files
     #list of event description files in 3 column format corresponding to onsets, durations, and amplitudes 
     frstlvl_wf.connect(motionnoise, 'subjinfo', specify_model, 'subject_info')
 
@@ -331,49 +320,87 @@ def firstlevel_wf(subject_id,
     modelfit_inputspec.inputs.film_threshold = 0.0 
     modelfit_inputspec.inputs.interscan_interval = 2.0
     modelfit_inputspec.inputs.model_serial_correlations = True
-    frstlvl_wf.connect(fslroi_epi, 'roi_file', modelfit_inputspec, 'functional_data')
+    frstlvl_wf.connect(epi_source, epi_field, modelfit_inputspec, 'functional_data')
     frstlvl_wf.connect(getcontrasts, 'contrasts', modelfit_inputspec, 'contrasts')
     frstlvl_wf.connect(specify_model, 'session_info', modelfit_inputspec, 'session_info')
    
 
-    #node for first level SPM design matrix to demonstrate contrasts and motion/noise regressors
-    level1_design = MapNode(Level1Design(), iterfield = ['contrasts', 'session_info'],
-                            name = 'level1_design')
-    level1_design.inputs.ignore_exception = False
-    frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', level1_design, 'interscan_interval')
-    frstlvl_wf.connect(modelfit_inputspec, 'session_info', level1_design, 'session_info')
-    frstlvl_wf.connect(modelfit_inputspec, 'contrasts', level1_design, 'contrasts')
-    frstlvl_wf.connect(modelfit_inputspec, 'bases', level1_design, 'bases')
-    frstlvl_wf.connect(modelfit_inputspec, 'model_serial_correlations', level1_design, 'model_serial_correlations')
+    if engine == 'native':
+        #Design and contrast matrices built in-process, no fsf file or feat_model (see wmaze_utility.design_util)
+        from wmaze_utility.interfaces import Level1DesignNative
+        generate_model = MapNode(Level1DesignNative(), iterfield = ['contrasts', 'session_info'],
+                                 name = 'generate_model')
+        frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', generate_model, 'interscan_interval')
+        frstlvl_wf.connect(modelfit_inputspec, 'session_info', generate_model, 'session_info')
+        frstlvl_wf.connect(modelfit_inputspec, 'contrasts', generate_model, 'contrasts')
+        frstlvl_wf.connect(modelfit_inputspec, 'bases', generate_model, 'bases')
+        generate_model.inputs.n_vols = 197
+    else:
+        #node for first level SPM design matrix to demonstrate contrasts and motion/noise regressors
+        level1_design = MapNode(Level1Design(), iterfield = ['contrasts', 'session_info'],
+                                name = 'level1_design')
+        level1_design.inputs.ignore_exception = False
+        frstlvl_wf.connect(modelfit_inputspec, 'interscan_interval', level1_design, 'interscan_interval')
+        frstlvl_wf.connect(modelfit_inputspec, 'session_info', level1_design, 'session_info')
+        frstlvl_wf.connect(modelfit_inputspec, 'contrasts', level1_design, 'contrasts')
+        frstlvl_wf.connect(modelfit_inputspec, 'bases', level1_design, 'bases')
+        frstlvl_wf.connect(modelfit_inputspec, 'model_serial_correlations', level1_design, 'model_serial_correlations')
     
 
-    #MapNode to generate a design.mat file for each run
-    generate_model = MapNode(FEATModel(), iterfield = ['fsf_file', 'ev_files'],
-                             name = 'generate_model') 
-    generate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    generate_model.inputs.ignore_exception = False
-    generate_model.inputs.output_type = 'NIFTI_GZ'
-    generate_model.inputs.terminal_output = 'stream' 
-    frstlvl_wf.connect(level1_design, 'fsf_files', generate_model, 'fsf_file')
-    frstlvl_wf.connect(level1_design, 'ev_files', generate_model, 'ev_files')
+        #MapNode to generate a design.mat file for each run
+        generate_model = MapNode(FEATModel(), iterfield = ['fsf_file', 'ev_files'],
+                                 name = 'generate_model') 
+        generate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        generate_model.inputs.ignore_exception = False
+        generate_model.inputs.output_type = 'NIFTI_GZ'
+        generate_model.inputs.terminal_output = 'stream' 
+        frstlvl_wf.connect(level1_design, 'fsf_files', generate_model, 'fsf_file')
+        frstlvl_wf.connect(level1_design, 'ev_files', generate_model, 'ev_files')
   
 
     #MapNode to estimate the model using FILMGLS -- fits the design matrix to the voxel timeseries
-    estimate_model = MapNode(FILMGLS(), iterfield = ['design_file', 'in_file', 'tcon_file'],
-                             name = 'estimate_model')
-    estimate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    estimate_model.inputs.ignore_exception = False
+    if engine == 'native':
+        #In-process prewhitened GLM with the same outputs (see wmaze_utility.glm_util)
+        from wmaze_utility.interfaces import FILMGLSNative, FILMGLSNativeRuns
+        if batch_runs or store:
+            #One node fits every run, reusing the mask and reading the next run during each fit
+            estimate_model = Node(FILMGLSNativeRuns(), name = 'estimate_model')
+        else:
+            estimate_model = MapNode(FILMGLSNative(), iterfield = ['design_file', 'in_file', 'tcon_file'],
+                                     name = 'estimate_model')
+        estimate_model.inputs.n_vols = 197
+        estimate_model.inputs.stats = ['pe', 'cope', 'varcope', 'zstat', 'pval'] #tstats are not used downstream
+        estimate_model.inputs.final_names = True #written as the DataSink substitutions would name them
+    else:
+        estimate_model = MapNode(FILMGLS(), iterfield = ['design_file', 'in_file', 'tcon_file'],
+                                 name = 'estimate_model')
+        estimate_model.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        estimate_model.inputs.ignore_exception = False
+        estimate_model.inputs.output_type = 'NIFTI_GZ'
+        estimate_model.inputs.terminal_output = 'stream'
     estimate_model.inputs.mask_size = 5 #Susan-smooth mask size
-    estimate_model.inputs.output_type = 'NIFTI_GZ'
     estimate_model.inputs.results_dir = 'results'
     estimate_model.inputs.smooth_autocorr = True #smooth auto-correlation estimates
-    estimate_model.inputs.terminal_output = 'stream'
     frstlvl_wf.connect(modelfit_inputspec, 'film_threshold', estimate_model, 'threshold')
     frstlvl_wf.connect(modelfit_inputspec, 'functional_data', estimate_model, 'in_file')
     frstlvl_wf.connect(generate_model, 'design_file', estimate_model, 'design_file') #mat file containing ascii matrix for design
     frstlvl_wf.connect(generate_model, 'con_file', estimate_model, 'tcon_file') #contrast file containing contrast vectors
 
 
+    #Statistics store: in-mask arrays go straight to {sink}/{subject}/modelfit/store (see wmaze_utility.stat_store),
+    #so no NIfTI maps, z2pval or DataSink stages are needed
+    if engine == 'native' and store:
+        estimate_model.inputs.store_dir = os.path.join(sink_directory, subject_id, 'modelfit', 'store')
+        #manifest of the store runs for the lvl2 scripts (see wmaze_utility.manifest_util)
+        from wmaze_utility.manifest_util import sink_manifest
+        manifest = Node(Function(input_names = ['sunk', 'modelfit_dir'], output_names = ['manifest'],
+                                 function = sink_manifest),
+                        name = 'manifest')
+        manifest.inputs.modelfit_dir = os.path.join(sink_directory, subject_id, 'modelfit')
+        frstlvl_wf.connect(estimate_model, 'store_dir', manifest, 'sunk')
+        return frstlvl_wf
+
+
     #merge node to merge the contrasts - necessary for fsl 5.0.7 and greater
     merge_contrasts = MapNode(Merge(2), iterfield = ['in1'], 
                               name = 'merge_contrasts')
@@ -381,15 +408,17 @@ def firstlevel_wf(subject_id,
 
 
     #MapNode to transform the z2pval
-    z2pval = MapNode(ImageMaths(), iterfield = ['in_file'], 
-                     name='z2pval')
-    z2pval.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    z2pval.inputs.ignore_exception = False
-    z2pval.inputs.op_string = '-ztop' #defines the operation used
-    z2pval.inputs.output_type = 'NIFTI_GZ'
-    z2pval.inputs.suffix = '_pval'
-    z2pval.inputs.terminal_output = 'stream'
-    frstlvl_wf.connect(merge_contrasts, ('out', pop_lambda), z2pval, 'in_file')
+    if engine != 'native':
+        #the native estimator writes the p maps while the zstats are in memory
+        z2pval = MapNode(ImageMaths(), iterfield = ['in_file'], 
+                         name='z2pval')
+        z2pval.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        z2pval.inputs.ignore_exception = False
+        z2pval.inputs.op_string = '-ztop' #defines the operation used
+        z2pval.inputs.output_type = 'NIFTI_GZ'
+        z2pval.inputs.suffix = '_pval'
+        z2pval.inputs.terminal_output = 'stream'
+        frstlvl_wf.connect(merge_contrasts, ('out', pop_lambda), z2pval, 'in_file')
 
 
     #outputspec node using IdentityInterface() to receive information from estimate_model, merge_contrasts, z2pval, generate_model, and estimate_model
@@ -400,7 +429,10 @@ def firstlevel_wf(subject_id,
     frstlvl_wf.connect(estimate_model, 'copes', modelfit_outputspec, 'copes') #lvl1 cope files
     frstlvl_wf.connect(estimate_model, 'varcopes', modelfit_outputspec, 'varcopes') #lvl1 varcope files
     frstlvl_wf.connect(merge_contrasts, 'out', modelfit_outputspec, 'zstats') #zstats across runs 
-    frstlvl_wf.connect(z2pval, 'out_file', modelfit_outputspec, 'pfiles')
+    if engine == 'native':
+        frstlvl_wf.connect(estimate_model, ('pvals', pop_lambda), modelfit_outputspec, 'pfiles')
+    else:
+        frstlvl_wf.connect(z2pval, 'out_file', modelfit_outputspec, 'pfiles')
     frstlvl_wf.connect(generate_model, 'design_image', modelfit_outputspec, 'design_image') #graphical representation of design matrix
     frstlvl_wf.connect(generate_model, 'design_file', modelfit_outputspec, 'design_file') #mat file containing ascii matrix for design
     frstlvl_wf.connect(generate_model, 'design_cov', modelfit_outputspec, 'design_cov') #graphical representation of design covariance
@@ -428,6 +460,15 @@ def firstlevel_wf(subject_id,
     frstlvl_wf.connect(modelfit_outputspec, 'design_file', sinkd, 'modelfit.design.@matrix')
     frstlvl_wf.connect(modelfit_outputspec, 'pfiles', sinkd, 'modelfit.contrasts.@pstats')
 
+
+    #manifest of the sunk outputs (run, contrast, stat, path, dof) for the lvl2 scripts (see wmaze_utility.manifest_util)
+    from wmaze_utility.manifest_util import sink_manifest
+    manifest = Node(Function(input_names = ['sunk', 'modelfit_dir'], output_names = ['manifest'],
+                             function = sink_manifest),
+                    name = 'manifest')
+    manifest.inputs.modelfit_dir = os.path.join(sink_directory, subject_id, 'modelfit')
+    frstlvl_wf.connect(sinkd, 'out_file', manifest, 'sunk')
+
     return frstlvl_wf
 
 
@@ -438,6 +479,9 @@ def firstlevel_wf(subject_id,
 def create_frstlvl_workflow(args, name = 'GLM2_frstlvl'):
     kwargs = dict(subject_id = args.subject_id,
                   sink_directory = os.path.abspath(args.out_dir),
+                  engine = args.engine,
+                  batch_runs = args.batch_runs,
+                  store = args.store,
                   name = name)
     frstlvl_workflow = firstlevel_wf(**kwargs)
     return frstlvl_workflow
@@ -448,7 +492,14 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--subject_id", dest = "subject_id", help = "Current subject id", required = True)
     parser.add_argument("-o", "--output_dir", dest = "out_dir", help = "Output directory base")
     parser.add_argument("-w", "--work_dir", dest = "work_dir", help = "Working directory base")
+    parser.add_argument("-e", "--engine", dest = "engine", default = 'fsl', choices = ['fsl', 'native'], help = "Model estimation engine")
+    parser.add_argument("-b", "--batch_runs", dest = "batch_runs", action = 'store_true', help = "Fit all runs in one process (native engine)")
+    parser.add_argument("-S", "--store", dest = "store", action = 'store_true', help = "Write in-mask statistics to a store instead of NIfTI maps (native engine)")
+    parser.add_argument("-P", "--precision", dest = "precision", choices = ['float32', 'float64'], help = "Image data precision (default float32, see wmaze_utility.precision)")
     args = parser.parse_args()
+    if args.precision: #inherited by every node (and SLURM job) started from here
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
 
     wf = create_frstlvl_workflow(args)
 
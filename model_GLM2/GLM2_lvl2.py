@@ -29,7 +29,18 @@ from nipype.utils.misc import getsource
 from nipype.interfaces.fsl.model import L2Model, FLAMEO
 from nipype.interfaces.io import DataGrabber, DataSink
 from nipype.interfaces.fsl.utils import Merge
-from glob import glob
+
+
+#Contrasts combined at the second level, shared with wmaze_utility.cohort_util;
+#contrasts with a single first-level run are skipped (see Manifest.select)
+CONTRASTS = ['AllVsBase', 'fixed_corr', 'fixed_incorr', 'cond_corr', 'cond_incorr', 'all_BL',
+             'fixedCorr_minus_fixedIncorr', 'fixedIncorr_minus_fixedCorr', 'all_fixed',
+             'condCorr_minus_condIncorr', 'condIncorr_minus_condCorr', 'all_cond',
+             'fixedCorr_minus_condCorr', 'condCorr_minus_fixedCorr', 'all_corr',
+             'fixedIncorr_minus_condIncorr', 'condIncorr_minus_fixedIncorr', 'all_incorr',
+             'allCorr_minus_allIncorr', 'allIncorr_minus_allCorr',
+             'allFixed_minus_allCond', 'allCond_minus_allFixed']
+FIXED_CONTRASTS = False
 
 
 ###################
@@ -54,21 +65,6 @@ def num_copes_range(files): #function to determine the range of the copes list
         return range(0,len(files))
 
 
-def doublelist(x):
-    for i, item in enumerate(x):
-        if not isinstance(item, list):
-            x[i] = [item]
-    return x
-
-
-def get_contrasts(data_inputs):
-    import os
-    infiles = [os.path.split(d[0])[1] for d in data_inputs]
-    contrasts = [inf[7:].split('.nii')[0] for inf in infiles]
-    print contrasts
-    return contrasts
-
-
 def get_subs(subject_id, cons):
     subs = []
     for i, con in enumerate(cons):
@@ -81,29 +77,9 @@ def get_subs(subject_id, cons):
 
 
 def get_dofvolumes(dof_files, cope_files):
-    import os
-    import nibabel as nb
-    import numpy as np
-    filenames = []
-    for cope_file_num, cope_file in enumerate(cope_files):
-        cope_file_list = cope_file.split('/')
-        cope_name = cope_file_list[-1][7:-7]
-        img = nb.load(cope_file)
-        out_data = np.zeros(img.get_shape())
-        if out_data.shape[-1] != 56:
-            for i in range(out_data.shape[-1]):
-                dof = np.loadtxt(dof_files[cope_file_num][i])
-                out_data[:, :, :, i] = dof        
-        else:
-            dof = np.loadtxt(dof_files[cope_file_num][-1])
-            out_data = np.expand_dims(curr_out_data, 3)
-            out_data[:, : , :, 0] = dof
-            
-        filename = os.path.join(os.getcwd(), 'dof_file_{0}.nii.gz'.format(cope_name))
-        newimg = nb.Nifti1Image(out_data, None, img.get_header())
-        newimg.to_filename(filename)
-        filenames.append(filename)
-    return filenames
+    #per-run scalar DOFs broadcast over the cope grid, one volume per distinct set of runs
+    from wmaze_utility.fixedfx_util import dof_volumes
+    return dof_volumes(dof_files, cope_files)
 
 
 ###################################
@@ -112,43 +88,21 @@ def get_dofvolumes(dof_files, cope_files):
 
 def secondlevel_wf(subject_id,
                    sink_directory,
+                   engine = 'fsl',
+                   merged = False,
                    name = 'GLM2_scndlvl_wf'):    
     scndlvl_wf = Workflow(name = 'scndlvl_wf')    
     base_dir = os.path.abspath('/home/data/madlab/data/mri/wmaze/')
        
-    all_contrasts = ['AllVsBase', 'fixed_corr', 'fixed_incorr', 'cond_corr', 'cond_incorr', 'all_BL',
-                     'fixedCorr_minus_fixedIncorr', 'fixedIncorr_minus_fixedCorr', 'all_fixed',
-                     'condCorr_minus_condIncorr', 'condIncorr_minus_condCorr', 'all_cond',
-                     'fixedCorr_minus_condCorr', 'condCorr_minus_fixedCorr', 'all_corr',
-                     'fixedIncorr_minus_condIncorr', 'condIncorr_minus_fixedIncorr', 'all_incorr',
-                     'allCorr_minus_allIncorr', 'allIncorr_minus_allCorr',
-                     'allFixed_minus_allCond', 'allCond_minus_allFixed']
-    contrasts = []
-    dof_runs = []
-
-    for i, curr_cont in enumerate(all_contrasts):
-        cont_files = glob(os.path.join(base_dir, 'frstlvl/model_GLM2/{0}/modelfit/contrasts/_estimate_model*/cope??_{1}.nii.gz'.format(subject_id, 
-     																       curr_cont)))
-        if len(cont_files) > 1:
-            contrasts.append(curr_cont) 
-            dof_runs.append([])      
-   
-    cnt_file_list = []
-    for curr_contrast in contrasts:          
-        cnt_file_list.append(glob(os.path.join(base_dir, 
-                             'frstlvl/model_GLM2/{0}/modelfit/contrasts/_estimate_model*/cope??_{1}.nii.gz'.format(subject_id, curr_contrast)))) 
-
-    for i, curr_file_list in enumerate(cnt_file_list):
-        if not isinstance(curr_file_list, list):
-            curr_file_list = [curr_file_list]    
-        for curr_file in curr_file_list:
-            dof_runs[i].append(curr_file.split('/')[-2][-1]) #grabs the estimate_model #
+    #first-level manifest: runs, files and DOFs of every contrast (see wmaze_utility.manifest_util)
+    from wmaze_utility.manifest_util import load_manifest
+    manifest = load_manifest(os.path.join(base_dir, 'frstlvl/model_GLM2', subject_id, 'modelfit'))
+    contrasts = manifest.select(CONTRASTS, FIXED_CONTRASTS)
+    if engine != 'native' and manifest.stored(contrasts): #FLAMEO reads NIfTI maps only
+        raise ValueError('{0} was fit with -S (statistics store), use -e native'.format(subject_id))
 
 
-    info = dict(copes = [['subject_id', contrasts]],
-                varcopes = [['subject_id', contrasts]],
-                mask_file = [['subject_id', 'aparc+aseg_thresh']],
-                dof_files = [['subject_id', dof_runs, 'dof']])
+    info = dict(mask_file = [['subject_id', 'aparc+aseg_thresh']])
 
     #datasource node to get the task_mri and motion-noise files
     datasource = Node(DataGrabber(infields = ['subject_id'], 
@@ -157,64 +111,55 @@ def secondlevel_wf(subject_id,
     datasource.inputs.template = '*'
     datasource.inputs.subject_id = subject_id
     datasource.inputs.base_directory = os.path.abspath('/home/data/madlab/data/mri/wmaze/')
-    datasource.inputs.field_template = dict(copes = 'frstlvl/model_GLM2/%s/modelfit/contrasts/_estimate_model*/cope*_%s.nii.gz',
-                                            varcopes = 'frstlvl/model_GLM2/%s/modelfit/contrasts/_estimate_model*/varcope*_%s.nii.gz',
-                                            mask_file = 'preproc/%s/ref/_fs_threshold20/%s*_thresh.nii',
-                                            dof_files = 'frstlvl/model_GLM2/%s/modelfit/dofs/_estimate_model%s/%s')
+    datasource.inputs.field_template = dict(mask_file = 'preproc/%s/ref/_fs_threshold20/%s*_thresh.nii')
     datasource.inputs.template_args = info
     datasource.inputs.sort_filelist = True
     datasource.inputs.ignore_exception = False
     datasource.inputs.raise_on_empty = True
 
 
-    #Inputspec node to deal with copes and varcopes doublelist issues
+    #Inputspec node holding the copes, varcopes and dof files of every contrast, in run order
     fixedfx_inputspec = Node(IdentityInterface(fields = ['copes', 'varcopes', 'dof_files'],
                                                mandatory_inputs = True),
                              name = 'fixedfx_inputspec')
-    scndlvl_wf.connect(datasource, ('copes', doublelist), fixedfx_inputspec, 'copes')
-    scndlvl_wf.connect(datasource, ('varcopes', doublelist), fixedfx_inputspec, 'varcopes')
-    scndlvl_wf.connect(datasource, ('dof_files', doublelist), fixedfx_inputspec, 'dof_files')
+    fixedfx_inputspec.inputs.copes = manifest.stat_files(contrasts, 'cope')
+    fixedfx_inputspec.inputs.varcopes = manifest.stat_files(contrasts, 'varcope')
+    fixedfx_inputspec.inputs.dof_files = manifest.dof_files(contrasts)
 
  
     #Merge node to collect all of the COPES
-    copemerge = MapNode(Merge(), iterfield = ['in_files'], 
-                        name = 'copemerge')
-    copemerge.inputs.dimension = 't'
-    copemerge.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    copemerge.inputs.ignore_exception = False
-    copemerge.inputs.output_type = 'NIFTI_GZ'
-    copemerge.inputs.terminal_output = 'stream'
-    scndlvl_wf.connect(fixedfx_inputspec, 'copes', copemerge, 'in_files')
+    if engine != 'native': #the native combiner stacks the run copes in memory
+        copemerge = MapNode(Merge(), iterfield = ['in_files'], 
+                            name = 'copemerge')
+        copemerge.inputs.dimension = 't'
+        copemerge.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        copemerge.inputs.ignore_exception = False
+        copemerge.inputs.output_type = 'NIFTI_GZ'
+        copemerge.inputs.terminal_output = 'stream'
+        scndlvl_wf.connect(fixedfx_inputspec, 'copes', copemerge, 'in_files')
    
 
     #Function node to generate a DOF volume
-    gendofvolume = Node(Function(input_names = ['dof_files', 'cope_files'],
-                                 output_names = ['dof_volumes'],
-                                 function = get_dofvolumes),
-                        name = 'gendofvolume')
-    gendofvolume.inputs.ignore_exception = False
-    scndlvl_wf.connect(fixedfx_inputspec, 'dof_files', gendofvolume, 'dof_files')
-    scndlvl_wf.connect(copemerge, 'merged_file', gendofvolume, 'cope_files')
+    if engine != 'native': #the native combiner takes the run DOFs as scalars
+        gendofvolume = Node(Function(input_names = ['dof_files', 'cope_files'],
+                                     output_names = ['dof_volumes'],
+                                     function = get_dofvolumes),
+                            name = 'gendofvolume')
+        gendofvolume.inputs.ignore_exception = False
+        scndlvl_wf.connect(fixedfx_inputspec, 'dof_files', gendofvolume, 'dof_files')
+        scndlvl_wf.connect(copemerge, 'merged_file', gendofvolume, 'cope_files')
 
 
     #Merge node to collect all of the VARCOPES
-    varcopemerge = MapNode(Merge(), iterfield = ['in_files'], 
-                           name = 'varcopemerge')
-    varcopemerge.inputs.dimension = 't'
-    varcopemerge.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    varcopemerge.inputs.ignore_exception = False
-    varcopemerge.inputs.output_type = 'NIFTI_GZ'
-    varcopemerge.inputs.terminal_output = 'stream'
-    scndlvl_wf.connect(fixedfx_inputspec, 'varcopes', varcopemerge, 'in_files')
-
-
-    #Node to define the contrasts from the names of the copes
-    getcontrasts = Node(Function(input_names = ['data_inputs'],
-                                 output_names = ['contrasts'],
-                                 function = get_contrasts),
-                        name = 'getcontrasts')
-    getcontrasts.inputs.ignore_exception = False
-    scndlvl_wf.connect(datasource, ('copes', doublelist), getcontrasts, 'data_inputs')
+    if engine != 'native': #the native combiner stacks the run varcopes in memory
+        varcopemerge = MapNode(Merge(), iterfield = ['in_files'], 
+                               name = 'varcopemerge')
+        varcopemerge.inputs.dimension = 't'
+        varcopemerge.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        varcopemerge.inputs.ignore_exception = False
+        varcopemerge.inputs.output_type = 'NIFTI_GZ'
+        varcopemerge.inputs.terminal_output = 'stream'
+        scndlvl_wf.connect(fixedfx_inputspec, 'varcopes', varcopemerge, 'in_files')
 
 
     #Function node to rename output files with something more meaningful
@@ -224,41 +169,54 @@ def secondlevel_wf(subject_id,
                    name = 'getsubs')
     getsubs.inputs.ignore_exception = False
     getsubs.inputs.subject_id = subject_id
-    scndlvl_wf.connect(getcontrasts, 'contrasts', getsubs, 'cons')
-
-
-    #l2model node for the Fixed Effects analysis (aka within subj across runs)
-    l2model = MapNode(L2Model(), 
-                      iterfield = ['num_copes'],
-                      name = 'l2model')
-    l2model.inputs.ignore_exception = False
-    scndlvl_wf.connect(datasource, ('copes', num_copes), l2model, 'num_copes')
-
-
-    #FLAMEO Node to run the fixed effects analysis
-    flameo_fe = MapNode(FLAMEO(),
-                        iterfield = ['cope_file', 'var_cope_file', 'dof_var_cope_file', 'design_file', 't_con_file', 'cov_split_file'],
-                        name = 'flameo_fe')
-    flameo_fe.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
-    flameo_fe.inputs.ignore_exception = False
-    flameo_fe.inputs.log_dir = 'stats'
-    flameo_fe.inputs.output_type = 'NIFTI_GZ'
-    flameo_fe.inputs.run_mode = 'fe'
-    flameo_fe.inputs.terminal_output = 'stream'
-    scndlvl_wf.connect(varcopemerge, 'merged_file', flameo_fe, 'var_cope_file')
-    scndlvl_wf.connect(l2model, 'design_mat', flameo_fe, 'design_file')
-    scndlvl_wf.connect(l2model, 'design_con', flameo_fe, 't_con_file')
-    scndlvl_wf.connect(l2model, 'design_grp', flameo_fe, 'cov_split_file')
-    scndlvl_wf.connect(gendofvolume, 'dof_volumes', flameo_fe, 'dof_var_cope_file')
-    scndlvl_wf.connect(datasource, 'mask_file', flameo_fe, 'mask_file')
-    scndlvl_wf.connect(copemerge, 'merged_file', flameo_fe, 'cope_file')
+    getsubs.inputs.cons = contrasts
+
+
+    if engine == 'native':
+        #Fixed effects of every contrast in one process, written as cope_/varcope_/tstat_/zstat_<contrast>
+        #(see wmaze_utility.fixedfx_util)
+        from wmaze_utility.interfaces import FixedEffectsNative
+        flameo_fe = Node(FixedEffectsNative(), name = 'flameo_fe')
+        flameo_fe.inputs.write_merged = merged
+        scndlvl_wf.connect(fixedfx_inputspec, 'copes', flameo_fe, 'cope_files')
+        scndlvl_wf.connect(fixedfx_inputspec, 'varcopes', flameo_fe, 'var_cope_files')
+        scndlvl_wf.connect(fixedfx_inputspec, 'dof_files', flameo_fe, 'dof_files')
+        scndlvl_wf.connect(datasource, 'mask_file', flameo_fe, 'mask_file')
+        flameo_fe.inputs.contrasts = contrasts
+    else:
+        #l2model node for the Fixed Effects analysis (aka within subj across runs)
+        l2model = MapNode(L2Model(), 
+                          iterfield = ['num_copes'],
+                          name = 'l2model')
+        l2model.inputs.ignore_exception = False
+        l2model.inputs.num_copes = num_copes(fixedfx_inputspec.inputs.copes)
+
+
+        #FLAMEO Node to run the fixed effects analysis
+        flameo_fe = MapNode(FLAMEO(),
+                            iterfield = ['cope_file', 'var_cope_file', 'dof_var_cope_file', 'design_file', 't_con_file', 'cov_split_file'],
+                            name = 'flameo_fe')
+        flameo_fe.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+        flameo_fe.inputs.ignore_exception = False
+        flameo_fe.inputs.log_dir = 'stats'
+        flameo_fe.inputs.output_type = 'NIFTI_GZ'
+        flameo_fe.inputs.run_mode = 'fe'
+        flameo_fe.inputs.terminal_output = 'stream'
+        scndlvl_wf.connect(varcopemerge, 'merged_file', flameo_fe, 'var_cope_file')
+        scndlvl_wf.connect(l2model, 'design_mat', flameo_fe, 'design_file')
+        scndlvl_wf.connect(l2model, 'design_con', flameo_fe, 't_con_file')
+        scndlvl_wf.connect(l2model, 'design_grp', flameo_fe, 'cov_split_file')
+        scndlvl_wf.connect(gendofvolume, 'dof_volumes', flameo_fe, 'dof_var_cope_file')
+        scndlvl_wf.connect(datasource, 'mask_file', flameo_fe, 'mask_file')
+        scndlvl_wf.connect(copemerge, 'merged_file', flameo_fe, 'cope_file')
 
 
     #outputspec node
-    scndlvl_outputspec = Node(IdentityInterface(fields = ['res4d', 'copes', 'varcopes', 'zstats', 'tstats'],
+    scndlvl_outputspec = Node(IdentityInterface(fields = ['copes', 'varcopes', 'zstats', 'tstats'] + (['res4d'] if engine != 'native' else []),
                                                 mandatory_inputs = True),
                               name = 'scndlvl_outputspec')
-    scndlvl_wf.connect(flameo_fe, 'res4d', scndlvl_outputspec, 'res4d')
+    if engine != 'native': #no residuals from the native combiner
+        scndlvl_wf.connect(flameo_fe, 'res4d', scndlvl_outputspec, 'res4d')
     scndlvl_wf.connect(flameo_fe, 'copes', scndlvl_outputspec, 'copes')
     scndlvl_wf.connect(flameo_fe, 'var_copes', scndlvl_outputspec, 'varcopes')
     scndlvl_wf.connect(flameo_fe, 'zstats', scndlvl_outputspec, 'zstats')
@@ -274,7 +232,11 @@ def secondlevel_wf(subject_id,
     scndlvl_wf.connect(scndlvl_outputspec, 'varcopes', sinkd, 'fixedfx.@varcopes')
     scndlvl_wf.connect(scndlvl_outputspec, 'tstats', sinkd, 'fixedfx.@tstats')
     scndlvl_wf.connect(scndlvl_outputspec, 'zstats', sinkd, 'fixedfx.@zstats')
-    scndlvl_wf.connect(scndlvl_outputspec, 'res4d', sinkd, 'fixedfx.@pvals')
+    if engine != 'native': #no residuals from the native combiner
+        scndlvl_wf.connect(scndlvl_outputspec, 'res4d', sinkd, 'fixedfx.@pvals')
+    if engine == 'native' and merged: #debug only: the stacked run inputs as merged 4D files
+        scndlvl_wf.connect(flameo_fe, 'merged_copes', sinkd, 'fixedfx.merged.@copes')
+        scndlvl_wf.connect(flameo_fe, 'merged_var_copes', sinkd, 'fixedfx.merged.@varcopes')
     scndlvl_wf.connect(getsubs, 'subs', sinkd, 'substitutions')
 
     return scndlvl_wf
@@ -287,6 +249,8 @@ def create_scndlvl_workflow(args, name = 'GLM2_scndlvl'):
 
     kwargs = dict(subject_id = args.subject_id,
                   sink_directory = os.path.abspath(args.out_dir),
+                  engine = args.engine,
+                  merged = args.merged,
                   name = name)
     scndlvl_workflow = secondlevel_wf(**kwargs)
     return scndlvl_workflow
@@ -297,7 +261,13 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--subject_id", dest = "subject_id", help = "Current subject id", required = True)
     parser.add_argument("-o", "--output_dir", dest = "out_dir", help = "Output directory base")
     parser.add_argument("-w", "--work_dir", dest = "work_dir", help = "Working directory base")
+    parser.add_argument("-e", "--engine", dest = "engine", default = 'fsl', choices = ['fsl', 'native'], help = "Fixed-effects engine")
+    parser.add_argument("-M", "--merged", dest = "merged", action = 'store_true', help = "Also write the merged run copes/varcopes (native engine, debug)")
+    parser.add_argument("-P", "--precision", dest = "precision", choices = ['float32', 'float64'], help = "Image data precision (default float32, see wmaze_utility.precision)")
     args = parser.parse_args()
+    if args.precision: #inherited by every node (and SLURM job) started from here
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
 
     wf = create_scndlvl_workflow(args)
 
@@ -24,6 +24,7 @@ from nipype.interfaces.io import DataGrabber, DataSink
 from nipype.interfaces import ants
 from mattfeld_utility_workflows.fs_skullstrip_util import create_freesurfer_skullstrip_workflow
 from nipype.interfaces.c3 import C3dAffineTool 
+from wmaze_utility.precision import ants_precision_args
 
 
 ###############
@@ -131,7 +132,7 @@ cope2targ.inputs.input_image_type = 3
 cope2targ.inputs.interpolation = 'LanczosWindowedSinc'
 cope2targ.inputs.invert_transform_flags = [False, False]
 cope2targ.inputs.terminal_output = 'file'
-cope2targ.inputs.args = '--float'
+cope2targ.inputs.args = ants_precision_args() #--float unless WMAZE_PRECISION=float64
 cope2targ.inputs.num_threads = 4
 cope2targ.plugin_args = {'bsub_args': '-n%d' % 4}
 #specify image whose space you are converting into
@@ -148,7 +149,7 @@ varcope2targ.inputs.input_image_type = 3
 varcope2targ.inputs.interpolation = 'LanczosWindowedSinc'
 varcope2targ.inputs.invert_transform_flags = [False, False]
 varcope2targ.inputs.terminal_output = 'file'
-varcope2targ.inputs.args = '--float'
+varcope2targ.inputs.args = ants_precision_args() #--float unless WMAZE_PRECISION=float64
 varcope2targ.inputs.num_threads = 4
 varcope2targ.plugin_args = {'bsub_args': '-n 4 -R "span[ptile=4]"'}
 varcope2targ.inputs.reference_image = '/home/data/madlab/data/mri/wmaze/wmaze_T1_template/T_wmaze_template.nii.gz'
@@ -7,12 +7,23 @@ subjs = ['WMAZE_001', 'WMAZE_002', 'WMAZE_004', 'WMAZE_005', 'WMAZE_006', 'WMAZE
 workdir = '/scratch/madlab/crash/mandy_crash/model_GLM3/lvl2'
 outdir = '/home/data/madlab/data/mri/wmaze/scndlvl/model_GLM3/'
 
-for sid in subjs:
-    #flexible command to execute script with kwarg flags and respective information using python
-    convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_GLM3/GLM3_lvl2.py', '-s',sid, '-o',outdir, '-w',workdir]) 
-    # Submission statement of the shell file to the SLURM scheduler
-    outcmd = 'sbatch -J hamm-GLM3_lvl2-{0} -p investor --qos pq_madlab \
-             -e /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/err_{0} \
-             -o /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+#True: one job combining every subject in-process (native fixed effects, see wmaze_utility.cohort_util)
+cohort = False
+
+if cohort:
+    convertcmd = ' '.join(['cd', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test', '&&', 'python', '-m', 'wmaze_utility.cohort_util', '-m', 'GLM3',
+                           '-o', outdir, '-n', '8', '-s'] + subjs)
+    outcmd = 'sbatch -J hamm-GLM3_lvl2-cohort -p investor --qos pq_madlab -N 1 -n 8 \
+             -e /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/err_cohort \
+             -o /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/out_cohort --wrap="{0}"'.format(convertcmd)
     os.system(outcmd)
-    continue
+else:
+    for sid in subjs:
+        #flexible command to execute script with kwarg flags and respective information using python
+        convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_GLM3/GLM3_lvl2.py', '-s',sid, '-o',outdir, '-w',workdir]) 
+        # Submission statement of the shell file to the SLURM scheduler
+        outcmd = 'sbatch -J hamm-GLM3_lvl2-{0} -p investor --qos pq_madlab \
+                 -e /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/err_{0} \
+                 -o /scratch/madlab/crash/mandy_crash/model_GLM3/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+        os.system(outcmd)
+        continue
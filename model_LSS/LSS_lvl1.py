@@ -37,154 +37,27 @@ from nipype.interfaces.utility import Merge
 # Grab the first dimension of an array/matrix
 pop_lambda = lambda x : x[0]
 
+# Build one LSS model per trial from a compact per-run event table
+# Models are index views into the shared run arrays (see wmaze_utility.trial_util)
 def subjectinfo(subject_id):
-    import os
-    from nipype.interfaces.base import Bunch
-    from copy import deepcopy
-    import numpy as np
+    from wmaze_utility.trial_util import load_run_events, iter_trial_models
     base_proj_dir = '/home/data/madlab/data/mri/wmaze/scanner_behav'
-    # Empty array to contain info from each run (index 1-6)
+    # Empty array to contain the trial models of each run (index 1-6)
     output = []
 
     # For the current run, of which there are 6
-    model_counter = 0 #MODEL COUNTER WILL UPDATE FOR EACH TRIAL OF A GIVEN CONDITION
     for curr_run in range(1,7):
-        data_FX_before_COND_corr = np.genfromtxt(base_proj_dir + '/{0}/model_LSS2/run{1}_all_before_B_corr.txt'.format(subject_id,curr_run),dtype = str)
-        data_FX_before_COND_incorr = np.genfromtxt(base_proj_dir + '/{0}/model_LSS2/run{1}_all_before_B_incorr.txt'.format(subject_id,curr_run),dtype = str)
-        data_all_remaining = np.genfromtxt(base_proj_dir + '/{0}/model_LSS2/run{1}_all_remaining.txt'.format(subject_id,curr_run),dtype = str)
-
-        # CONSOLIDATE ALL FIXED B4 CONDITIONAL DATA INTO A DICTIONARY FOR ITERATION
-        # USE THE FOLLOWING CONDITIONALS TO DEAL WITH THE FACT THAT SOMETIMES PEOPLE DIDN'T MAKE MISTAKES
-        if data_FX_before_COND_incorr.size > 0:
-            orig_all_fixed_b4_cond_data = {'FX_before_COND_corr': data_FX_before_COND_corr, 
-                                           'FX_before_COND_incorr': data_FX_before_COND_incorr}
-        else:
-            orig_all_fixed_b4_cond_data = {'FX_before_COND_corr': data_FX_before_COND_corr}
-
-        # ITERATE OVER THE KEYS OF THE DICTIONARY TO ISOLATE THE CONDITIONS OF INTEREST
-        for curr_key in orig_all_fixed_b4_cond_data.keys():
-            # ESTABLISH TRIAL COUNTER FOR NAMING OF REGRESSORS
-            trial_counter = 1
-            # ISOLATE CURRENT CONDITION DATA USING POP FUNCTION
-            # DICTIONARY WILL NO LONGER HAVE THAT KEY
-            # I USE THAT FUNCTIONALITY TO ESTABLISH THE PENDING KEYS (NOT YET ITERATED OVER)
-            copy_all_fixed_b4_cond_data = dict(orig_all_fixed_b4_cond_data)
-            curr_condition_data = copy_all_fixed_b4_cond_data.pop(curr_key)
-
-            if curr_condition_data.size == 3: # ONLY ONE EVENT OF THIS CONDITION DURING THIS RUN
-                names = [curr_key + '_run%d_trl%d_onset%0.2f' %(curr_run, trial_counter, float(curr_condition_data[0]))]
-                onsets = [[float(curr_condition_data[0])]]
-                durations = [[float(curr_condition_data[1])]]
-                amplitudes = [[float(curr_condition_data[2])]]
-                # DEAL WITH THE REMAINING DATA THAT HASN'T BEEN ITERATED THROUGH YET (AKA PENDING)
-                for pending_key in copy_all_fixed_b4_cond_data.keys():
-                    names.append(pending_key)
-                    pending_data = copy_all_fixed_b4_cond_data[pending_key]
-                    if pending_data.size == 3: #ONLY ONE EVENT OF THIS CONDITION
-                        onsets.append([float(pending_data[0])])
-                        durations.append([float(pending_data[1])])
-                        amplitudes.append([float(pending_data[2])])
-                    else:
-                        onsets.append(map(float,pending_data[:,0]))
-                        durations.append(map(float,pending_data[:,1]))
-                        amplitudes.append(map(float,pending_data[:,2]))
-                # INSERT THE ALL REAMINING EV INTO THE MODEL
-                names.append('all_remaining')
-                onsets.append(map(float, data_all_remaining[:,0]))
-                durations.append(map(float, data_all_remaining[:,1]))
-                amplitudes.append(map(float, data_all_remaining[:,2]))
-
-                # UPDATE TRIAL COUNTER
-                trial_counter = trial_counter + 1
-
-                # Insert the contents of each run at the index of model_counter
-                output.insert(model_counter,
-                              Bunch(conditions = names,
-                                    onsets = deepcopy(onsets),
-                                    durations = deepcopy(durations),
-                                    amplitudes = deepcopy(amplitudes),
-                                    tmod = None,
-                                    pmod = None,
-                                    regressor_names = None,
-                                    regressors = None))
-
-                # UPDATE MODEL COUNTER
-                model_counter = model_counter + 1
-            else: # THERE IS MORE THAN ONE EVENT OF THIS CONDITION DURING THIS RUN
-                # ITERATE OVER THE NUMBER OF TRIALS WITHIN THAT CONDITION
-                for curr_cond_trl in range(len(curr_condition_data)):
-                    # ESTABLISH THE LISTS FOR NAMES, ONSETS, DURATIONS, AND AMPLITUDES FOR ALL MODELS
-                    # WE WILL HAVE AS MANY MODELS AS TRIALS ACROSS RUNS FOR THE DIFFERENT CONDITIONS
-                    names = []
-                    onsets = []
-                    durations = []
-                    amplitudes = []
-                    curr_cond_trl_name = curr_key + '_run%d_trl%d_onset%0.2f' %(curr_run, trial_counter,     
-                                                                                float(curr_condition_data[curr_cond_trl][0]))
-                    curr_cond_trl_onset = [float(curr_condition_data[curr_cond_trl][0])]
-                    curr_cond_trl_dur = [float(curr_condition_data[curr_cond_trl][1])]
-                    curr_cond_trl_amp = [float(curr_condition_data[curr_cond_trl][2])]
-                    
-                    names.append(curr_cond_trl_name)
-                    onsets.append(curr_cond_trl_onset)
-                    durations.append(curr_cond_trl_dur)
-                    amplitudes.append(curr_cond_trl_amp)
-                
-                    # ISOLATE THE REMAINING TRIALS FOR THE CURRENT CONDITION USING THE NUMPY DELETE FUNCTION
-                    # THIS FUNCTION WILL NOT MODIFY THE ORIGINAL VARIABLE LIKE POP DOES ABOVE
-                    curr_cond_remaining_data = np.delete(curr_condition_data, curr_cond_trl, 0)
-                    curr_cond_remaining_name = curr_key + '_allbut_run%d_trl%d' %(curr_run, trial_counter)
-                    curr_cond_remaining_onsets = map(float, curr_cond_remaining_data[:,0])
-                    curr_cond_remaining_durs = map(float, curr_cond_remaining_data[:,1])
-                    curr_cond_remaining_amps = map(float, curr_cond_remaining_data[:,2])
-                    
-                    names.append(curr_cond_remaining_name)
-                    onsets.append(curr_cond_remaining_onsets)
-                    durations.append(curr_cond_remaining_durs)
-                    amplitudes.append(curr_cond_remaining_amps)
-                
-                    # DEAL WITH THE PENDING DATA THAT HASN'T BEEN ITERATED THROUGH YET
-                    # THIS IS WHERE THAT POP FUNCTION ABOVE CAME IN HANDY
-                    for pending_key in copy_all_fixed_b4_cond_data.keys():
-                        names.append(pending_key)
-                        pending_data = copy_all_fixed_b4_cond_data[pending_key]
-                        if pending_data.size == 3: #ONLY ONE EVENT OF THIS CONDITION
-                            onsets.append([float(pending_data[0])])
-                            durations.append([float(pending_data[1])])
-                            amplitudes.append([float(pending_data[2])])
-                        else:
-                            onsets.append(map(float,pending_data[:,0]))
-                            durations.append(map(float,pending_data[:,1]))
-                            amplitudes.append(map(float,pending_data[:,2]))
-               
-                    # INSERT THE ALL REAMINING EV INTO THE MODEL
-                    names.append('all_remaining')
-                    onsets.append(map(float, data_all_remaining[:,0]))
-                    durations.append(map(float, data_all_remaining[:,1]))
-                    amplitudes.append(map(float, data_all_remaining[:,2]))
-
-                    # UPDATE TRIAL COUNTER
-                    trial_counter = trial_counter + 1
-
-                    # Insert the contents of each run at the index of model_counter
-                    output.insert(model_counter,
-                                  Bunch(conditions = names,
-                                        onsets = deepcopy(onsets),
-                                        durations = deepcopy(durations),
-                                        amplitudes = deepcopy(amplitudes),
-                                        tmod = None,
-                                        pmod = None,
-                                        regressor_names = None,
-                                        regressors = None))
-
-                    # UPDATE MODEL COUNTER
-                    model_counter = model_counter + 1
+        # PARSE THE FIXED B4 CONDITIONAL AND ALL REMAINING EVS ONCE PER RUN
+        # THE INCORRECT CONDITION IS DROPPED WHEN PEOPLE DIDN'T MAKE MISTAKES
+        events = load_run_events(base_proj_dir + '/{0}/model_LSS2'.format(subject_id), curr_run)
+        # ONE MODEL PER TRIAL: [TRIAL, ALLBUT, PENDING, ALL_REMAINING]
+        output.extend(iter_trial_models(events))
     return output
 
 
-
 # Function to obtain and create contrasts *flexibly* in case there are not enough incorrect trials
-def get_contrasts(subject_id, info):
+# With target_only, only the trial of interest (first condition of each model) gets a contrast
+def get_contrasts(subject_id, info, target_only = False):
     contrasts = []
     # For each bunch received from subjectinfo function in get_contrasts node
     for i, j in enumerate(info):
@@ -193,6 +66,8 @@ def get_contrasts(subject_id, info):
         for curr_cond in j.conditions:
             curr_cont = [curr_cond, 'T', [curr_cond], [1]]
             curr_run_contrasts.append(curr_cont)            
+            if target_only:
+                break
         contrasts.append(curr_run_contrasts)
     return contrasts
 
@@ -216,63 +91,18 @@ def get_subs(cons):
 
 # Function for extracting the motion parameters from the noise files
 def motion_noise(subjinfo, files):
-    import numpy as np
-    motion_noise_params = []
-    motion_noi_par_names = []
-    # If each instance of files is not a list, make it one
+    # Each file is parsed once into a cached array (last three volumes dropped) and attached by reference
+    import re
+    from wmaze_utility.confound_util import load_run_confounds, attach_confounds
     if not isinstance(files, list):
         files = [files]
-    # If each instance of subjinfo is not a list, make it one
     if not isinstance(subjinfo, list):
         subjinfo = [subjinfo]
-    # For each instance of files
-    for j,i in enumerate(files):
-        curr_mot_noi_par_names = ['Pitch (rad)', 'Roll (rad)', 'Yaw (rad)', 
-                                  'Tx (mm)', 'Ty (mm)', 'Tz (mm)',
-                                  'Pitch_1d', 'Roll_1d', 'Yaw_1d', 
-                                  'Tx_1d', 'Ty_1d', 'Tz_1d',
-                                  'Norm (mm)', 
-                                  'LG_1stOrd', 'LG_2ndOrd', 'LG_3rdOrd', 'LG_4thOrd']
-        # Numpy array of each motion noise files
-        a_orig = np.genfromtxt(i)
-        a = a_orig[:-3]
-        motion_noise_params.append([[]] * a.shape[1])
-        # If there are more than 17 motion noise parameters
-        if a.shape[1] > 17:
-            # For those additional noise parameters over 17
-            for num_out in range(a.shape[1] - 17):
-                # Give it a name
-                out_name = 'out_{0}'.format(num_out + 1)
-                curr_mot_noi_par_names.append(out_name)
-        # For each instance in the second column of a
-        for z in range(a.shape[1]):
-            motion_noise_params[j][z] = a[:, z].tolist()
-        motion_noi_par_names.append(curr_mot_noi_par_names)
-    # For each instace of subjinfo    
-    for j,i in enumerate(subjinfo):
-        # If there are are no regressor names
-        if i.regressor_names == None: 
-            i.regressor_names = []
-        # If there are no regressors
-        if i.regressors == None: 
-            i.regressors = []
+    confounds = [load_run_confounds(i, trim = 3) for i in files]
+    for i in subjinfo:
         # Deal with multiple trialwise models for each run
-        if 'run1' in i.conditions[0]:
-            curr_run = 0
-        elif 'run2' in i.conditions[0]:
-            curr_run = 1
-        elif 'run3' in i.conditions[0]:
-            curr_run = 2
-        elif 'run4' in i.conditions[0]:
-            curr_run = 3
-        elif 'run5' in i.conditions[0]:
-            curr_run = 4
-        elif 'run6' in i.conditions[0]:
-            curr_run = 5
-        # For each instance of motion_noise_params in the current iteration of subjinfo
-        for j3, i3 in enumerate(motion_noise_params[curr_run]):
-            i.regressor_names.append(motion_noi_par_names[curr_run][j3])
-            i.regressors.append(i3)           
+        curr_run = int(re.search(r'_run(\d+)_', i.conditions[0]).group(1)) - 1
+        attach_confounds(i, confounds[curr_run])
     return subjinfo
 
 
@@ -297,6 +127,41 @@ def expand_files(subjinfo, in_files):
     return files_expanded
 
 
+# Native LSS: fit every trial model in-process, loading each run only once
+def native_lss(subject_id, sink_directory, solver = 'batched',
+               target_only = False, with_variance = False, work_dir = None,
+               n_procs = 1, memory_gb = None, max_runs = None, models_per_task = None):
+    from glob import glob
+    from wmaze_utility.lss_util import fit_lss_models
+    from wmaze_utility.betaseries_util import BetaSeriesStore, trial_index_path
+    # EV trial index (written by LSS_create_evs.ipynb), carried along with the copes: checked
+    # before fitting so a missing index fails the job instead of leaving an unlabeled store
+    index_file = trial_index_path('/home/data/madlab/data/mri/wmaze/scanner_behav/{0}'.format(subject_id))
+    if not os.path.exists(index_file):
+        raise ValueError('No trial index at {0}: run LSS_create_evs.ipynb first'.format(index_file))
+    preproc_dir = '/home/data/madlab/data/mri/wmaze/preproc/{0}'.format(subject_id)
+    # Same files the datasource node grabs for the FSL workflow
+    task_mri_files = sorted(glob(preproc_dir + '/func/smoothed_fullspectrum/_maskfunc2*/*wmaze*.nii.gz'))
+    motion_noise_files = sorted(glob(preproc_dir + '/noise/filter_regressor??.txt'))
+    models = motion_noise(subjectinfo(subject_id), motion_noise_files)
+    store_dir = os.path.join(sink_directory, subject_id, 'betaseries')
+    fitted = fit_lss_models(models, expand_files(models, task_mri_files),
+                            os.path.join(sink_directory, subject_id),
+                            n_vols = 197, tr = 2.0, method = solver,
+                            target_only = target_only, with_variance = with_variance,
+                            # Each run is decompressed once into an uncompressed buffer in the work dir
+                            buffer_dir = os.path.join(work_dir, subject_id, 'epi_buffer') if work_dir else None,
+                            # Trial copes also go straight into the subject's beta-series store
+                            store_dir = store_dir,
+                            # Local process pool bounded by workers, memory and loaded runs
+                            n_procs = n_procs, memory_gb = memory_gb, max_runs = max_runs,
+                            models_per_task = models_per_task)
+    for in_file, model_ids in fitted:
+        print('Fit {0} trial models of {1}'.format(len(model_ids), in_file))
+    BetaSeriesStore(store_dir).attach_trial_index(index_file)
+    return os.path.join(sink_directory, subject_id)
+
+
 ###################################
 ## Function for 1st lvl analysis ##
 ###################################
@@ -304,7 +169,9 @@ def expand_files(subjinfo, in_files):
 
 def firstlevel_wf(subject_id,
                   sink_directory,
-                  name = 'wmaze_frstlvl_wf'):
+                  name = 'wmaze_frstlvl_wf',
+                  target_only = False,
+                  with_variance = False):
     # Create the frstlvl workflow
     frstlvl_wf = Workflow(name = 'frstlvl_wf')
     
@@ -324,7 +191,7 @@ def firstlevel_wf(subject_id,
 
 
     # Create another Function node to define the contrasts for the experiment
-    getcontrasts = Node(Function(input_names = ['subject_id', 'info'],
+    getcontrasts = Node(Function(input_names = ['subject_id', 'info', 'target_only'],
                                  output_names = ['contrasts'],
                                  # Calls the function 'get_contrasts'
                                  function = get_contrasts),
@@ -332,6 +199,7 @@ def firstlevel_wf(subject_id,
     getcontrasts.inputs.ignore_exception = False
     # Receives subject_id as input
     getcontrasts.inputs.subject_id = subject_id
+    getcontrasts.inputs.target_only = target_only
     frstlvl_wf.connect(subject_info, 'output', getcontrasts, 'info')
 
     
@@ -379,8 +247,11 @@ def firstlevel_wf(subject_id,
     fslroi_epi = MapNode(ExtractROI(t_min = 0, t_size = 197),
                          iterfield = ['in_file'],
                          name = 'fslroi_epi')
-    fslroi_epi.output_type = 'NIFTI_GZ'
-    fslroi_epi.terminal_output = 'stream'
+    # Write the trimmed run uncompressed: every trial model of the run reuses this one file,
+    # so FILMGLS reads it without gunzipping it again for each trial
+    fslroi_epi.inputs.environ = {'FSLOUTPUTTYPE': 'NIFTI'}
+    fslroi_epi.inputs.output_type = 'NIFTI'
+    fslroi_epi.inputs.terminal_output = 'stream'
     frstlvl_wf.connect(datasource, 'task_mri_files', fslroi_epi, 'in_file')
 
 
@@ -510,6 +381,25 @@ def firstlevel_wf(subject_id,
 
 
 
+    # Target-only mode: sink the trial-of-interest cope (plus varcope and dof when asked)
+    # and skip the z-to-p conversion and the remaining FILMGLS outputs
+    if target_only:
+        sink_iterfield = ['substitutions', 'modelfit.contrasts.@copes']
+        if with_variance:
+            sink_iterfield.extend(['modelfit.contrasts.@varcopes', 'modelfit.dofs'])
+        sinkd = MapNode(DataSink(),
+                        iterfield = sink_iterfield,
+                        name = 'sinkd')
+        sinkd.inputs.base_directory = sink_directory 
+        sinkd.inputs.container = subject_id
+        frstlvl_wf.connect(getsubs, 'subs', sinkd, 'substitutions')
+        frstlvl_wf.connect(estimate_model, 'copes', sinkd, 'modelfit.contrasts.@copes')
+        if with_variance:
+            frstlvl_wf.connect(estimate_model, 'varcopes', sinkd, 'modelfit.contrasts.@varcopes')
+            frstlvl_wf.connect(estimate_model, 'dof_file', sinkd, 'modelfit.dofs')
+        return frstlvl_wf
+
+
     # Create a merge node to merge the contrasts - necessary for fsl 5.0.7 and greater
     merge_contrasts = MapNode(Merge(2), 
                               # Iterate over 'in1' input
@@ -598,7 +488,9 @@ def create_frstlvl_workflow(args, name = 'wmaze_MR_frstlvl'):
     # Creates a dictionary containing variables subject_id, sink_directory, and name
     kwargs = dict(subject_id = args.subject_id,
                   sink_directory = os.path.abspath(args.out_dir),
-                  name = name)
+                  name = name,
+                  target_only = args.target_only,
+                  with_variance = args.with_variance)
     # Passes the value of all dictionary items to firstlevel_wf
     frstlvl_workflow = firstlevel_wf(**kwargs)
     # Returns all those values
@@ -619,20 +511,75 @@ if __name__ == "__main__":
     # Add argument for working directory when you flag "-w"
     parser.add_argument("-w", "--work_dir", dest = "work_dir",
                         help = "Working directory base")
+    # Add argument for the estimation engine when you flag "-e"
+    # 'fsl' runs the nipype/FILMGLS workflow, 'native' fits all trial models in-process
+    parser.add_argument("-e", "--engine", dest = "engine", default = 'fsl',
+                        choices = ['fsl', 'native'], help = "Estimation engine")
+    # Add argument for the native LSS solver when you flag "--solver"
+    # 'projection' factorizes the shared nuisance columns once per run
+    # 'lsa' fits one least-squares-all model per run instead of one model per trial
+    parser.add_argument("--solver", dest = "solver", default = 'batched',
+                        choices = ['batched', 'projection', 'lsa'], help = "Native LSS solver")
+    # Add argument to estimate and sink only the trial of interest when you flag "-t"
+    parser.add_argument("-t", "--target_only", dest = "target_only", action = 'store_true',
+                        help = "Only write the trial-of-interest cope")
+    # Add argument to also write the trial-of-interest varcope (and dof) in target-only mode
+    parser.add_argument("--with_variance", dest = "with_variance", action = 'store_true',
+                        help = "Also write the trial-of-interest varcope in target-only mode")
+    # Add argument for the number of local worker processes when you flag "-n"
+    # Native engine: process pool; FSL engine: MultiProc plugin instead of SLURM
+    parser.add_argument("-n", "--n_procs", dest = "n_procs", type = int, default = 1,
+                        help = "Local worker processes")
+    # Add argument for the memory budget of the local workers in GB
+    parser.add_argument("--memory_gb", dest = "memory_gb", type = float, default = None,
+                        help = "Memory budget for local workers (GB)")
+    # Add argument to cap how many runs are loaded at once (native engine)
+    parser.add_argument("--max_runs", dest = "max_runs", type = int, default = None,
+                        help = "Maximum number of runs loaded at once")
+    # Add argument to split each run into batches of trial models (native engine, needs -w)
+    parser.add_argument("--models_per_task", dest = "models_per_task", type = int, default = None,
+                        help = "Trial models per pool task")
+    # Add argument for the nipype plugin of the FSL engine when you flag "-p"
+    parser.add_argument("-p", "--plugin", dest = "plugin", default = 'SLURM',
+                        choices = ['SLURM', 'MultiProc'], help = "Nipype plugin")
+    # Add argument for the precision of stored and loaded image data when you flag "-P"
+    parser.add_argument("-P", "--precision", dest = "precision", choices = ['float32', 'float64'],
+                        help = "Image data precision (default float32, see wmaze_utility.precision)")
     # Parser arguments are passed to the create_frstlvl_workflow function
     args = parser.parse_args()
-
-    # Object containing all important workflow info
-    wf = create_frstlvl_workflow(args)
-
-    # If not None, then assume a working directory
-    if args.work_dir:
-        work_dir = os.path.abspath(args.work_dir)
-    # If not valid working dir, make the current dir the work_dir    
+    # Every node (and SLURM job) started from here inherits the precision
+    if args.precision:
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
+    if args.solver == 'lsa' and args.engine != 'native':
+        parser.error("--solver lsa requires -e native")
+
+    # Native engine writes the same modelfit layout directly, no workflow needed
+    if args.engine == 'native':
+        native_lss(args.subject_id, os.path.abspath(args.out_dir), solver = args.solver,
+                   target_only = args.target_only, with_variance = args.with_variance,
+                   work_dir = os.path.abspath(args.work_dir) if args.work_dir else None,
+                   n_procs = args.n_procs, memory_gb = args.memory_gb, max_runs = args.max_runs,
+                   models_per_task = args.models_per_task)
     else:
-        work_dir = os.getcwd()
+        # Object containing all important workflow info
+        wf = create_frstlvl_workflow(args)
 
-    wf.config['execution']['crashdump_dir'] = '/scratch/madlab/crash/mandy_crash/model_LSS2/'
-    wf.base_dir = work_dir + '/' + args.subject_id
-    wf.run(plugin='SLURM', plugin_args={'sbatch_args': ('-p investor --qos pq_madlab -N 1 -n 1'), 'overwrite': True})
+        # If not None, then assume a working directory
+        if args.work_dir:
+            work_dir = os.path.abspath(args.work_dir)
+        # If not valid working dir, make the current dir the work_dir    
+        else:
+            work_dir = os.getcwd()
+
+        wf.config['execution']['crashdump_dir'] = '/scratch/madlab/crash/mandy_crash/model_LSS2/'
+        wf.base_dir = work_dir + '/' + args.subject_id
+        # MultiProc runs every trial model within this allocation instead of one sbatch job each
+        if args.plugin == 'MultiProc':
+            plugin_args = {'n_procs': args.n_procs}
+            if args.memory_gb:
+                plugin_args['memory_gb'] = args.memory_gb
+            wf.run(plugin='MultiProc', plugin_args=plugin_args)
+        else:
+            wf.run(plugin='SLURM', plugin_args={'sbatch_args': ('-p investor --qos pq_madlab -N 1 -n 1'), 'overwrite': True})
 
@@ -22,56 +22,41 @@ Model LSS
 import os
 from nipype.pipeline.engine import Workflow, Node, MapNode
 from nipype.interfaces.utility import Function
-from nipype.interfaces.io import DataGrabber
 from nipype.interfaces.io import DataSink
-from nipype.interfaces.fsl import Merge
 
+# Function to write the learning and nonlearning beta series from the subject's store
+# Trials keep the order of the sorted deriv/ file lists the FSL merge used
+def merge_store_copes(store_dir):
+	import os
+	from wmaze_utility.betaseries_util import BetaSeriesStore
+	store = BetaSeriesStore(store_dir)
+	merged = []
+	for label in ['learn', 'nonlearn']:
+		rows = sorted(store.select(label = label), key = lambda row: store.trials[row]['name'])
+		merged.append(store.to_nifti(rows, os.path.abspath('cope_{0}ing.nii.gz'.format(label)), tr = 2.00))
+	return merged[0], merged[1]
+
 # Function to merge copes for each participant
 def cope_merge_wf(subject_id, sink_directory,
 	          name = 'cope_merge_wf'):   
 	cope_merge_wf = Workflow(name = 'cope_merge_wf')
         
-    	info = dict(learning_cope = [['subject_id']], #dictionary for Datagrabber
-		    nonlearning_cope = [['subject_id']])
-
-        #node to grab corr and incorr cope files
-	datasource = Node(DataGrabber(infields = ['subject_id'], outfields = info.keys()), 
-                          name = 'datasource')
-	datasource.inputs.template = '*'
-	datasource.inputs.subject_id = subject_id
-	datasource.inputs.base_directory = os.path.abspath('/home/data/madlab/data/mri/wmaze/frstlvl/model_LSS2')
-	datasource.inputs.field_template = dict(learning_cope = '%s/deriv/learn/*.nii.gz',
-				                nonlearning_cope = '%s/deriv/nonlearn/*.nii.gz')
-	datasource.inputs.template_args = info
-	datasource.inputs.sort_filelist = True
-	datasource.inputs.ignore_exception = False
-	datasource.inputs.raise_on_empty = True
-
+	#node to export the learning and nonlearning trials from the beta-series store
+	#learn/nonlearn are index selections labeled by LSS_sort_copes.ipynb (no copies, no fslmerge)
+	merge_store = Node(Function(input_names = ['store_dir'],
+				     output_names = ['learning_cope', 'nonlearning_cope'],
+				     function = merge_store_copes),
+			   name = 'merge_store')
+	merge_store.inputs.store_dir = os.path.join('/home/data/madlab/data/mri/wmaze/frstlvl/model_LSS2',
+						     subject_id, 'betaseries')
 
-	#node to merge learning trials across all 6 runs
-	merge_learning = Node(Merge(), name = 'merge_learning')
-	merge_learning.inputs.dimension = 't'
-	merge_learning.inputs.output_type = 'NIFTI_GZ'
-        merge_learning.inputs.merged_file = 'cope_learning.nii.gz'
-	merge_learning.inputs.tr = 2.00
-	cope_merge_wf.connect(datasource, 'learning_cope', merge_learning, 'in_files')
-
-
-        #node to merge nonlearning trials across all 6 runs
-	merge_nonlearning = Node(Merge(), name = 'merge_nonlearning')
-	merge_nonlearning.inputs.dimension = 't'
-	merge_nonlearning.inputs.output_type = 'NIFTI_GZ'
-        merge_nonlearning.inputs.merged_file = 'cope_nonlearning.nii.gz'
-	merge_nonlearning.inputs.tr = 2.00
-	cope_merge_wf.connect(datasource, 'nonlearning_cope', merge_nonlearning, 'in_files')
-
 
         #node to output data
 	dsink = Node(DataSink(), name = 'dsink')
 	dsink.inputs.base_directory = sink_directory 
 	dsink.inputs.container = subject_id
-	cope_merge_wf.connect(merge_learning, 'merged_file', dsink, 'merged.@learning')
-	cope_merge_wf.connect(merge_nonlearning, 'merged_file', dsink, 'merged.@nonlearning')
+	cope_merge_wf.connect(merge_store, 'learning_cope', dsink, 'merged.@learning')
+	cope_merge_wf.connect(merge_store, 'nonlearning_cope', dsink, 'merged.@nonlearning')
 	
 	return cope_merge_wf
 
@@ -7,13 +7,24 @@ subjs = ['WMAZE_001', 'WMAZE_002', 'WMAZE_004', 'WMAZE_005', 'WMAZE_006', 'WMAZE
 workdir = '/scratch/madlab/crash/mandy_crash/model_RSA/lvl2'
 outdir = '/home/data/madlab/data/mri/wmaze/scndlvl/model_RSA'
 
-for i, sid in enumerate(subjs):
-    #flexible command to execute level 1 script with kwarg flags and respective information using python
-    convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_RSA/RSA_lvl2.py', '-s', sid, '-o', outdir, '-w', workdir])
-      
-    #submission statement of the shell file to SLURM scheduler
-    outcmd = 'sbatch -J hamm-RSA_lvl2-{0} -p investor --qos pq_madlab \
-             -e /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/err_{0} \
-             -o /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+#True: one job combining every subject in-process (native fixed effects, see wmaze_utility.cohort_util)
+cohort = False
+
+if cohort:
+    convertcmd = ' '.join(['cd', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test', '&&', 'python', '-m', 'wmaze_utility.cohort_util', '-m', 'RSA',
+                           '-o', outdir, '-n', '8', '-s'] + subjs)
+    outcmd = 'sbatch -J hamm-RSA_lvl2-cohort -p investor --qos pq_madlab -N 1 -n 8 \
+             -e /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/err_cohort \
+             -o /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/out_cohort --wrap="{0}"'.format(convertcmd)
     os.system(outcmd)
-    continue
+else:
+    for i, sid in enumerate(subjs):
+        #flexible command to execute level 1 script with kwarg flags and respective information using python
+        convertcmd = ' '.join(['python', '/home/data/madlab/scripts/wmaze/anal_MR_thesis/test/model_RSA/RSA_lvl2.py', '-s', sid, '-o', outdir, '-w', workdir])
+      
+        #submission statement of the shell file to SLURM scheduler
+        outcmd = 'sbatch -J hamm-RSA_lvl2-{0} -p investor --qos pq_madlab \
+                 -e /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/err_{0} \
+                 -o /scratch/madlab/crash/mandy_crash/model_RSA/lvl2/out_{0} --wrap="{1}"'.format(sid, convertcmd)
+        os.system(outcmd)
+        continue
@@ -0,0 +1,8 @@
+"""
+=================================================
+wmaze_utility: native model fitting for wmaze data
+=================================================
+Shared, in-process replacements for the FSL stages used by the model_*
+scripts. Put the repository root on PYTHONPATH so both the scripts and any
+nipype nodes they spawn can import it.
+"""
@@ -0,0 +1,292 @@
+"""
+===============================================
+Beta-series utilities -- per-subject cope store
+===============================================
+One on-disk beta series per subject, replacing the copy-into-deriv/ and
+fslmerge steps of LSS_sort_copes.ipynb and LSS_merge_copes.py.
+
+A store is a directory holding
+
+    copes.npy   -- trials x voxels array (float32 unless float64 was requested,
+                   see wmaze_utility.precision), opened memory-mapped
+    trials.tsv  -- one row per trial: row, model, run, trial, onset,
+                   condition, name, label
+    ref.nii.gz  -- 3D reference volume (grid and affine of the copes)
+
+Rows follow the LSS model order (row N is ``_estimate_model{N}``) and hold
+the trial-of-interest cope (cope01) of that model over the full volume grid.
+Learning labels are metadata: learn/nonlearn subsets are index selections
+of the same array, exported as 4D NIfTI only when a merged file is needed.
+
+The correlation engine works on any beta series (a merged 4D file, an array
+or store rows). Each ROI is a list of binary masks whose mean series are
+averaged (e.g. left and right hemisphere), so all ROI series come from one
+weighted sum over the data. The ROI x ROI correlations are returned as a
+tidy table (subject, split, roi1, roi2, r, z, n_trials) and seeds can be
+correlated with every voxel in the same pass, written as NIfTI maps.
+
+Learning states are assigned through a keyed join. LSS_create_evs.ipynb
+writes a trial index next to the EVs (subject, set, run, trial, condition,
+onset, b_index, valid), where b_index is the position, within its stimulus
+set, of the B trial the EV trial precedes. The same file is copied into the
+store, and the store rows are labeled by joining it with the learning-curve
+files (Bprime_pmode, B_pmode, B_p95) on (subject, set, b_index).
+"""
+
+import os
+import re
+import shutil
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.precision import precision_dtype
+
+
+TRIAL_FIELDS = ['row', 'model', 'run', 'trial', 'onset', 'condition', 'name', 'label']
+
+# EV trial index of a subject (scanner_behav/<subject>/...), written by LSS_create_evs.ipynb
+# next to the EVs LSS_lvl1.subjectinfo reads
+TRIAL_INDEX = os.path.join('model_LSS2', 'trial_index.txt')
+
+# LSS trial regressor name: {condition}_run{r}_trl{n}_onset{t}
+TRIAL_NAME = re.compile(r'^(?P<condition>.+)_run(?P<run>\d+)_trl(?P<trial>\d+)_onset(?P<onset>[-\d.]+)$')
+
+
+# Trial index file of a subject's scanner_behav directory
+def trial_index_path(behav_dir):
+    return os.path.join(behav_dir, TRIAL_INDEX)
+
+
+# Metadata of one trial from its LSS regressor name
+def trial_metadata(name, row, model = None):
+    match = TRIAL_NAME.match(name)
+    if match is None:
+        raise ValueError('Not an LSS trial regressor name: {0}'.format(name))
+    return dict(row = row,
+                model = row if model is None else model,
+                run = int(match.group('run')),
+                trial = int(match.group('trial')),
+                onset = float(match.group('onset')),
+                condition = match.group('condition'),
+                name = name,
+                label = 'n/a')
+
+
+class BetaSeriesStore(object):
+    """Memory-mapped trials x voxels cope array plus its trial table."""
+
+    def __init__(self, store_dir, mode = 'r'):
+        self.store_dir = store_dir
+        self.ref_img = nb.load(os.path.join(store_dir, 'ref.nii.gz'))
+        self.copes = np.load(os.path.join(store_dir, 'copes.npy'), mmap_mode = mode)
+        self.trials = read_trials(os.path.join(store_dir, 'trials.tsv'))
+
+    # Create an empty store for the given trial names (row N = model N)
+    @classmethod
+    def create(cls, store_dir, ref_img, names):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        shape = ref_img.shape[:3]
+        ref = nb.Nifti1Image(np.zeros(shape, dtype = np.uint8), ref_img.affine)
+        ref.to_filename(os.path.join(store_dir, 'ref.nii.gz'))
+        copes = np.lib.format.open_memmap(os.path.join(store_dir, 'copes.npy'), mode = 'w+',
+                                          dtype = precision_dtype(),
+                                          shape = (len(names), int(np.prod(shape))))
+        del copes
+        write_trials(os.path.join(store_dir, 'trials.tsv'),
+                     [trial_metadata(name, row) for row, name in enumerate(names)])
+        return cls(store_dir, mode = 'r+')
+
+    # Build a store from existing cope01 files (e.g. the FSL workflow outputs)
+    # Rows are ordered by their _estimate_model{N} directory; names come from the files
+    @classmethod
+    def from_copes(cls, store_dir, cope_files):
+        model_num = lambda f: int(re.search(r'_estimate_model(\d+)', f).group(1))
+        cope_files = sorted(cope_files, key = model_num)
+        names = [os.path.basename(f)[len('cope01_'):-len('.nii.gz')] for f in cope_files]
+        store = cls.create(store_dir, nb.load(cope_files[0]), names)
+        for row, cope_file in enumerate(cope_files):
+            store.copes[row] = np.asarray(nb.load(cope_file).dataobj, dtype = store.copes.dtype).ravel()
+        store.copes.flush()
+        return store
+
+    @property
+    def shape(self):
+        return self.ref_img.shape[:3]
+
+    # Write one trial's in-mask cope values into its row
+    def write_trial(self, row, values, mask):
+        out_row = np.zeros(self.copes.shape[1], dtype = self.copes.dtype)
+        out_row[mask.ravel()] = values
+        self.copes[row] = out_row
+
+    # Rows whose metadata match every given field, in store (model) order
+    def select(self, **criteria):
+        return np.array([trial['row'] for trial in self.trials
+                         if all(trial[key] == value for key, value in criteria.items())], dtype = int)
+
+    # Set the label of the given rows; call save_trials to keep it
+    def set_label(self, rows, label):
+        for row in rows:
+            self.trials[row]['label'] = label
+
+    def save_trials(self):
+        write_trials(os.path.join(self.store_dir, 'trials.tsv'), self.trials)
+
+    # Keep the EV trial index with the copes it describes
+    def attach_trial_index(self, index_file):
+        if not os.path.exists(index_file):
+            raise ValueError('No trial index at {0} (written by LSS_create_evs.ipynb)'.format(index_file))
+        shutil.copy2(index_file, os.path.join(self.store_dir, 'trial_index.txt'))
+
+    @property
+    def trial_index_file(self):
+        return os.path.join(self.store_dir, 'trial_index.txt')
+
+    # Export the given rows as one 4D volume (trials along time)
+    def to_nifti(self, rows, filename, tr = 2.0):
+        data = np.asarray(self.copes[np.asarray(rows, dtype = int)]).T.reshape(self.shape + (len(rows),))
+        img = nb.Nifti1Image(data, self.ref_img.affine)
+        img.header.set_zooms(self.ref_img.header.get_zooms()[:3] + (tr,))
+        img.to_filename(filename)
+        return filename
+
+
+def write_trials(filename, trials):
+    with open(filename, 'w') as out_file:
+        out_file.write('\t'.join(TRIAL_FIELDS) + '\n')
+        for trial in trials:
+            out_file.write('\t'.join(str(trial[field]) for field in TRIAL_FIELDS) + '\n')
+
+
+def read_trials(filename):
+    types = dict(row = int, model = int, run = int, trial = int, onset = float)
+    trials = []
+    with open(filename) as in_file:
+        fields = in_file.readline().rstrip('\n').split('\t')
+        for line in in_file:
+            values = line.rstrip('\n').split('\t')
+            trials.append(dict((field, types.get(field, str)(value))
+                               for field, value in zip(fields, values)))
+    return trials
+
+
+# ROI weights over the voxel grid: each ROI is the mean of its masks' means
+# rois: list of (name, [mask file or array, ...]) -- returns names, (R, V) weights
+def roi_weights(rois, shape):
+    names = []
+    weights = np.zeros((len(rois), int(np.prod(shape))), dtype = np.float64)
+    for idx, (name, masks) in enumerate(rois):
+        names.append(name)
+        for mask in masks:
+            if not isinstance(mask, np.ndarray):
+                mask = np.asarray(nb.load(mask).dataobj)
+            mask = mask.ravel() > 0.
+            weights[idx, mask] += 1. / (mask.sum() * len(masks))
+    return names, weights
+
+
+# Pearson correlation of every row of a with every row of b: (A, T), (B, T) -> (A, B)
+def row_correlations(a, b):
+    a = a - a.mean(axis = 1)[:, None]
+    b = b - b.mean(axis = 1)[:, None]
+    a /= np.maximum(np.sqrt((a ** 2).sum(axis = 1)), 1e-30)[:, None]
+    b /= np.maximum(np.sqrt((b ** 2).sum(axis = 1)), 1e-30)[:, None]
+    return np.dot(a, b.T)
+
+
+# Beta series as (V, T) voxels x trials from a 4D file/image or array
+def load_betaseries(betas):
+    if isinstance(betas, np.ndarray):
+        return betas.reshape(-1, betas.shape[-1]), None
+    img = betas if isinstance(betas, nb.Nifti1Image) else nb.load(betas)
+    data = np.asarray(img.dataobj, dtype = precision_dtype())
+    return data.reshape(-1, data.shape[-1]), img
+
+
+# ROI series, ROI x ROI correlations and optional seed maps for one beta series
+# seeds: ROI names to correlate with every voxel; maps go to map_dir/{prefix}{seed}.nii.gz
+def betaseries_connectivity(betas, rois, seeds = None, map_dir = None, map_prefix = ''):
+    data, img = load_betaseries(betas)
+    names, weights = roi_weights(rois, data.shape[0] if img is None else img.shape[:3])
+    # One pass over the data gives every ROI mean series
+    series = np.dot(weights.astype(data.dtype), data).astype(np.float64)
+    corr = row_correlations(series, series.copy())
+    seed_maps = {}
+    if seeds:
+        seed_series = series[[names.index(seed) for seed in seeds]]
+        maps = row_correlations(seed_series.copy(), data.astype(np.float64)).astype(precision_dtype())
+        for seed, seed_map in zip(seeds, maps):
+            seed_maps[seed] = seed_map
+            if map_dir and img is not None:
+                if not os.path.exists(map_dir):
+                    os.makedirs(map_dir)
+                nb.Nifti1Image(seed_map.reshape(img.shape[:3]), img.affine).to_filename(
+                    os.path.join(map_dir, '{0}{1}.nii.gz'.format(map_prefix, seed)))
+    return names, series, corr, seed_maps
+
+
+# Connectivity for a cohort: betas[i] is a list of (split, beta series) and rois[i]
+# the ROI list of subjects[i]; returns the tidy table rows and the ROI series
+def cohort_connectivity(subjects, betas, rois, seeds = None, map_dir = None, table_file = None):
+    rows = []
+    series = {}
+    for subject, subject_betas, subject_rois in zip(subjects, betas, rois):
+        for split, split_betas in subject_betas:
+            curr_map_dir = os.path.join(map_dir, subject) if map_dir else None
+            names, roi_series, corr, _ = betaseries_connectivity(split_betas, subject_rois, seeds,
+                                                                 curr_map_dir, '{0}_'.format(split))
+            series[(subject, split)] = dict(zip(names, roi_series))
+            n_trials = roi_series.shape[1]
+            for idx1 in range(len(names)):
+                for idx2 in range(idx1 + 1, len(names)):
+                    r = float(corr[idx1, idx2])
+                    rows.append(dict(subject = subject, split = split,
+                                     roi1 = names[idx1], roi2 = names[idx2],
+                                     r = r, z = float(np.arctanh(np.clip(r, -1 + 1e-7, 1 - 1e-7))),
+                                     n_trials = n_trials))
+    if table_file:
+        fields = ['subject', 'split', 'roi1', 'roi2', 'r', 'z', 'n_trials']
+        with open(table_file, 'w') as out_file:
+            out_file.write('\t'.join(fields) + '\n')
+            for row in rows:
+                out_file.write('\t'.join(str(row[field]) for field in fields) + '\n')
+    return rows, series
+
+
+# Learning-curve values of every B trial of a subject, one row per (set, b_index)
+def learning_curves(behav_dir, subject, sets = ('set1', 'set2', 'set3')):
+    import pandas as pd
+    tables = []
+    for curr_set in sets:
+        curves = dict(deriv = 'Bprime_pmode_{0}.txt', learning = 'B_pmode_{0}.txt', p95 = 'B_p95_{0}.txt')
+        table = pd.DataFrame(dict((key, np.loadtxt(os.path.join(behav_dir, template.format(curr_set))))
+                                  for key, template in curves.items()))
+        table['subject'] = subject
+        table['set'] = int(curr_set[-1])
+        table['b_index'] = np.arange(len(table))
+        tables.append(table)
+    return pd.concat(tables, ignore_index = True)
+
+
+# Join trial indices with learning curves (both may hold many subjects)
+# Valid trials preceding a B with a positive derivative are 'learn', else 'nonlearn'
+def join_learning_states(trial_index, curves):
+    states = trial_index.merge(curves, how = 'left', on = ['subject', 'set', 'b_index'])
+    labels = np.where(states['deriv'] > 0, 'learn', 'nonlearn')
+    labeled = states['valid'].astype(bool) & states['deriv'].notnull()
+    states['label'] = np.where(labeled, labels, 'n/a')
+    return states
+
+
+# Label the rows of a subject's store from its joined learning states
+def label_store(store, states):
+    import pandas as pd
+    rows = pd.DataFrame(store.trials)[['row', 'run', 'trial', 'condition']]
+    rows = rows.merge(states[['run', 'trial', 'condition', 'label']], how = 'left',
+                      on = ['run', 'trial', 'condition'])
+    for label in ['learn', 'nonlearn']:
+        store.set_label(rows['row'][rows['label'] == label].values, label)
+    store.set_label(rows['row'][~rows['label'].isin(['learn', 'nonlearn'])].values, 'n/a')
+    store.save_trials()
+    return store
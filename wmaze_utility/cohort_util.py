@@ -0,0 +1,183 @@
+"""
+=====================================================
+Cohort utilities -- second level of every subject
+=====================================================
+Runs the fixed-effects (within subject, across runs) stage of a model for a
+whole subject list in one process, in place of one *_lvl2.py nipype graph
+and sbatch job per subject (``*_lvl2_submit.py``).
+
+Each subject is one task on a local process pool (parallel_util.bounded_map):
+
+1. its run copes, varcopes and dof files are looked up in the first-level
+   manifest, for the contrasts of the model's lvl2 script (its ``CONTRASTS``
+   and ``FIXED_CONTRASTS`` rule, applied with ``Manifest.select``), so the
+   same ``fixedfx`` outputs are written as by the per-subject lvl2 jobs
+2. every contrast is combined with ``fixedfx_util.combine_contrasts``, the
+   combiner behind ``-e native`` on the lvl2 scripts
+3. the maps are written where the lvl2 DataSink puts them,
+   ``scndlvl/model_*/<subject>/fixedfx/{cope,varcope,tstat,zstat}_<contrast>.nii.gz``
+
+The number of workers is bounded by ``-n`` and by ``--memory_gb`` over the
+largest per-subject estimate (``subject_memory_gb``). The time of every
+subject is reported once all of them are done.
+
+    python -m wmaze_utility.cohort_util -m GLM2 -s WMAZE_001 WMAZE_002 ... [-n 8 --memory_gb 32]
+"""
+
+import os
+import ast
+import glob
+import time
+
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.fixedfx_util import combine_contrasts
+from wmaze_utility.manifest_util import load_manifest
+from wmaze_utility.multimodel_util import MODELS, REPO_DIR, PREPROC_DIR, FRSTLVL_DIR
+from wmaze_utility.parallel_util import bounded_map
+from wmaze_utility.precision import precision_dtype
+
+
+SCNDLVL_DIR = '/home/data/madlab/data/mri/wmaze/scndlvl'
+
+# Brain mask of the lvl2 DataGrabber (mask_file)
+MASK = '{0}/ref/_fs_threshold20/aparc+aseg_thresh*_thresh.nii'
+
+_LVL2_CONTRASTS = {}
+
+
+# CONTRASTS and FIXED_CONTRASTS of a model's lvl2 script, read from its source (the script
+# needs nipype and FSL to import, the cohort process does not)
+def lvl2_contrasts(model):
+    if model not in _LVL2_CONTRASTS:
+        with open(os.path.join(REPO_DIR, MODELS[model]['lvl2'])) as in_file:
+            tree = ast.parse(in_file.read().expandtabs())
+        values = {}
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                if node.targets[0].id in ('CONTRASTS', 'FIXED_CONTRASTS'):
+                    values[node.targets[0].id] = ast.literal_eval(node.value)
+        if len(values) != 2:
+            raise ValueError('{0} defines no CONTRASTS/FIXED_CONTRASTS'.format(MODELS[model]['lvl2']))
+        _LVL2_CONTRASTS[model] = (values['CONTRASTS'], values['FIXED_CONTRASTS'])
+    return _LVL2_CONTRASTS[model]
+
+
+# Contrasts of a subject to combine, selected as the model's lvl2 script selects them:
+# its CONTRASTS (or the requested ones) under its FIXED_CONTRASTS rule (Manifest.select)
+def subject_contrasts(manifest, model, contrasts = None):
+    lvl2_list, fixed = lvl2_contrasts(model)
+    return manifest.select(contrasts or lvl2_list, fixed)
+
+
+# Mask file of a subject, as the lvl2 scripts grab it
+def subject_mask(subject_id, preproc_dir = PREPROC_DIR):
+    mask_files = sorted(glob.glob(os.path.join(preproc_dir, MASK.format(subject_id))))
+    if not mask_files:
+        raise ValueError('No mask for {0} in {1}'.format(subject_id, preproc_dir))
+    return mask_files[0]
+
+
+# Rough peak memory (GB) of combining the contrasts of one subject (grid of its mask, so
+# runs held in a statistics store are estimated the same way)
+def subject_memory_gb(manifest, contrasts, mask_file):
+    if not contrasts:
+        return 0.
+    n_vox = int(np.prod(nb.load(mask_file).shape[:3]))
+    n_runs = max(len(manifest.runs(name)) for name in contrasts)
+    item = np.dtype(precision_dtype()).itemsize
+    # Stacked copes/varcopes at the stored precision plus the float64 workspace of fixed_effects
+    stacked = 2 * len(contrasts) * n_runs * n_vox * item
+    workspace = 4 * len(contrasts) * n_runs * n_vox * 8
+    return (stacked + workspace) / 1024. ** 3
+
+
+# Pool task: combine every contrast of one subject; returns its summary and timing
+def combine_subject(task):
+    start = time.time()
+    out_dir = os.path.join(task['out_base'], task['subject_id'], 'fixedfx')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    manifest = load_manifest(task['modelfit_dir'])
+    outputs = combine_contrasts(manifest.stat_files(task['contrasts'], 'cope'),
+                                manifest.stat_files(task['contrasts'], 'varcope'),
+                                manifest.dof_files(task['contrasts']), task['mask_file'],
+                                task['contrasts'], out_dir)
+    return dict(subject_id = task['subject_id'], out_dir = out_dir, contrasts = len(task['contrasts']),
+                runs = max(len(manifest.runs(name)) for name in task['contrasts']),
+                dofs = outputs['dofs'], seconds = time.time() - start)
+
+
+# Fixed effects of every subject of a model on a bounded local pool
+# Returns the per-subject summaries (subject_id, out_dir, contrasts, runs, dofs, seconds) in subject order;
+# a subject without a contrast to combine is skipped (out_dir None, no contrasts)
+def combine_cohort(model, subjects, contrasts = None, frstlvl_dir = FRSTLVL_DIR, preproc_dir = PREPROC_DIR,
+                   out_base = None, n_procs = 1, memory_gb = None):
+    if model not in MODELS:
+        raise ValueError('Unknown model: {0}'.format(model))
+    out_base = os.path.abspath(out_base or os.path.join(SCNDLVL_DIR, 'model_{0}'.format(model)))
+    summaries = []
+    positions = []
+    tasks = []
+    task_gb = 0.
+    for subject_id in subjects:
+        modelfit_dir = os.path.join(frstlvl_dir, 'model_{0}'.format(model), subject_id, 'modelfit')
+        manifest = load_manifest(modelfit_dir)
+        names = subject_contrasts(manifest, model, contrasts)
+        if not names:
+            summaries.append(dict(subject_id = subject_id, out_dir = None, contrasts = 0, runs = 0,
+                                  dofs = [], seconds = 0.))
+            continue
+        mask_file = subject_mask(subject_id, preproc_dir)
+        task_gb = max(task_gb, subject_memory_gb(manifest, names, mask_file))
+        positions.append(len(summaries))
+        summaries.append(None)
+        tasks.append(dict(subject_id = subject_id, modelfit_dir = modelfit_dir, contrasts = names,
+                          mask_file = mask_file, out_base = out_base))
+
+    for idx, summary in bounded_map(combine_subject, tasks, n_procs, memory_gb, task_gb):
+        summaries[positions[idx]] = summary
+    return summaries
+
+
+# Per-subject timing table of combine_cohort summaries
+def timing_report(summaries, wall_time = None):
+    lines = ['{0:<12}{1:>10}{2:>6}{3:>10}'.format('subject', 'contrasts', 'runs', 'seconds')]
+    for summary in summaries:
+        if summary['out_dir'] is None:
+            lines.append('{0:<12}{1:>26}'.format(summary['subject_id'], 'no contrast, skipped'))
+            continue
+        lines.append('{0:<12}{1:>10}{2:>6}{3:>10.1f}'.format(summary['subject_id'], summary['contrasts'],
+                                                           summary['runs'], summary['seconds']))
+    total = sum(summary['seconds'] for summary in summaries)
+    lines.append('{0:<28}{1:>10.1f}'.format('total (sum over subjects)', total))
+    if wall_time is not None:
+        lines.append('{0:<28}{1:>10.1f}'.format('wall time', wall_time))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Fixed-effects second level of every subject of a model in one process')
+    parser.add_argument('-m', '--model', dest = 'model', required = True, choices = list(MODELS), help = 'Model')
+    parser.add_argument('-s', '--subject_ids', dest = 'subject_ids', nargs = '+', required = True,
+                        help = 'Subject ids')
+    parser.add_argument('-c', '--contrasts', dest = 'contrasts', nargs = '+',
+                        help = 'Contrasts to combine (default: CONTRASTS of the model\'s lvl2 script)')
+    parser.add_argument('-o', '--output_dir', dest = 'out_dir',
+                        help = 'Output directory base (default: scndlvl/model_<model>)')
+    parser.add_argument('-n', '--n_procs', dest = 'n_procs', type = int, default = 1,
+                        help = 'Subjects combined at once')
+    parser.add_argument('--memory_gb', dest = 'memory_gb', type = float, default = None,
+                        help = 'Memory budget bounding the number of workers')
+    parser.add_argument('-P', '--precision', dest = 'precision', choices = ['float32', 'float64'],
+                        help = 'Image data precision (default float32, see wmaze_utility.precision)')
+    args = parser.parse_args()
+    if args.precision:
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
+    start = time.time()
+    summaries = combine_cohort(args.model, args.subject_ids, args.contrasts, out_base = args.out_dir,
+                               n_procs = args.n_procs, memory_gb = args.memory_gb)
+    print(timing_report(summaries, time.time() - start))
@@ -0,0 +1,91 @@
+"""
+==================================================
+Confound utilities -- cached motion/noise loading
+==================================================
+Array-backed replacement for the parsing in the lvl1 ``motion_noise``
+functions.
+
+Each run's ``filter_regressor??.txt`` is parsed once into a read-only
+``RunConfounds`` (float array plus regressor names), cached by path,
+modification time and trimmed volume count. Models get the regressors by
+reference:
+
+- LSS ``TrialModel``s only hold the shared ``RunConfounds``; their
+  ``regressors`` and ``regressor_names`` are derived on access, so every
+  trial model of a run shares one copy in memory and when nipype pickles the
+  model list
+- plain Bunches get column views of the cached array appended to their
+  ``regressors``
+
+Regressor names follow motion_noise: 17 motion/noise names, then out_1,
+out_2, ... for any further (outlier) columns.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+from wmaze_utility.trial_util import TrialModel
+
+
+MOTION_NOISE_NAMES = ['Pitch (rad)', 'Roll (rad)', 'Yaw (rad)', 'Tx (mm)', 'Ty (mm)', 'Tz (mm)',
+                      'Pitch_1d', 'Roll_1d', 'Yaw_1d', 'Tx_1d', 'Ty_1d', 'Tz_1d',
+                      'Norm (mm)', 'LG_1stOrd', 'LG_2ndOrd', 'LG_3rdOrd', 'LG_4thOrd']
+
+_CONFOUND_CACHE = {}
+
+
+# Motion/noise names for a file with n_cols columns
+def confound_names(n_cols):
+    names = MOTION_NOISE_NAMES[:n_cols]
+    names.extend('out_{0}'.format(num_out + 1) for num_out in range(n_cols - len(MOTION_NOISE_NAMES)))
+    return names
+
+
+class RunConfounds(object):
+    """Motion/noise regressors of one run: (volumes, regressors) array and names."""
+
+    def __init__(self, filename, data, names):
+        self.filename = filename
+        self.data = data
+        self.names = names
+
+    # Column views of the shared array, one per regressor
+    def columns(self):
+        return [self.data[:, col] for col in range(self.data.shape[1])]
+
+    # Deterministic representation so nipype input hashing is stable across runs
+    def __repr__(self):
+        digest = hashlib.md5(np.ascontiguousarray(self.data).tobytes())
+        return 'RunConfounds(file={0}, md5={1})'.format(os.path.basename(self.filename), digest.hexdigest())
+
+
+# Parse a regressor file once per (path, mtime, trim); trim drops trailing volumes
+def load_run_confounds(filename, trim = 0):
+    filename = os.path.abspath(filename)
+    key = (filename, os.path.getmtime(filename), trim)
+    if key not in _CONFOUND_CACHE:
+        data = np.genfromtxt(filename, dtype = float)
+        if data.ndim == 1:
+            data = data[:, None]
+        if trim:
+            data = data[:-trim]
+        data = np.ascontiguousarray(data)
+        data.setflags(write = False)
+        _CONFOUND_CACHE[key] = RunConfounds(filename, data, confound_names(data.shape[1]))
+    return _CONFOUND_CACHE[key]
+
+
+# Attach a run's confounds to a model by reference
+def attach_confounds(model, confounds):
+    if isinstance(model, TrialModel):
+        # Regressors are derived from the shared RunConfounds
+        model.confounds = confounds
+        return model
+    if model.regressor_names is None:
+        model.regressor_names = []
+    if model.regressors is None:
+        model.regressors = []
+    model.regressor_names.extend(confounds.names)
+    model.regressors.extend(confounds.columns())
+    return model
@@ -0,0 +1,237 @@
+"""
+===================================================
+Design utilities -- FEAT style design construction
+===================================================
+Builds the same kind of design matrix that Level1Design + FEATModel produce
+for ``bases = {'dgamma': {'derivs': False}}``:
+
+- three column EVs are turned into boxcars on a fine time grid
+- boxcars are convolved with FSL's double-gamma HRF
+- the convolved EVs are sampled at the middle of each volume
+- every column (EVs and confound regressors) is demeaned
+
+EVs are not convolved on the fine grid: a boxcar convolved with the HRF is
+the difference of two shifted HRF step responses, so every event is
+evaluated only at the sampled time points, for all EVs of a model at once.
+The HRF and its step response are cached per time step, so building the
+designs of a whole subject (or of every LSS trial model) costs milliseconds.
+
+``session_design`` works directly on a SpecifyModel session_info entry and
+``write_design`` writes the design.mat / design.con files (plus design.png
+and design_cov.png previews) that FEATModel would, so the result can be
+handed to FILMGLS or wmaze_utility.glm_util.film_gls.
+"""
+
+import os
+import zlib
+import struct
+import numpy as np
+from scipy.stats import gamma
+
+
+_HRF_CACHE = {}
+
+
+# FSL double-gamma: peak at 6s (sd 2.449s), undershoot at 16s (sd 4s), ratio 1/6
+def dgamma_hrf(dt, length = 32.):
+    key = (float(dt), float(length))
+    if key not in _HRF_CACHE:
+        t = np.arange(0., length, dt)
+        peak = gamma.pdf(t, 6., scale = 1.)
+        undershoot = gamma.pdf(t, 16., scale = 1.)
+        hrf = peak - undershoot / 6.
+        hrf = hrf / hrf.sum()
+        hrf.setflags(write = False)
+        _HRF_CACHE[key] = hrf
+    return _HRF_CACHE[key]
+
+
+# Cumulative HRF with a leading zero: step response of the fine grid
+def hrf_step(dt):
+    key = ('step', float(dt))
+    if key not in _HRF_CACHE:
+        step = np.concatenate(([0.], np.cumsum(dgamma_hrf(dt))))
+        step.setflags(write = False)
+        _HRF_CACHE[key] = step
+    return _HRF_CACHE[key]
+
+
+# Fine grid start/stop index, amplitude and column of every event
+# Durations and amplitudes of length one apply to every onset of their EV
+def event_table(onsets, durations, amplitudes, n_fine, dt):
+    cols, starts, stops, amps = [], [], [], []
+    for col, (ons, durs, amp) in enumerate(zip(onsets, durations, amplitudes)):
+        ons = np.atleast_1d(np.asarray(ons, dtype = float))
+        if not ons.size:
+            continue
+        durs = np.broadcast_to(np.atleast_1d(np.asarray(durs, dtype = float)), ons.shape)
+        amp = np.broadcast_to(np.atleast_1d(np.asarray(amp, dtype = float)), ons.shape)
+        start = np.round(ons / dt).astype(int)
+        stop = np.maximum(np.round((ons + durs) / dt).astype(int), start + 1)
+        cols.append(np.full(ons.shape, col, dtype = int))
+        starts.append(start)
+        stops.append(stop)
+        amps.append(amp)
+    if not cols:
+        empty = np.zeros(0, dtype = int)
+        return empty, empty, np.zeros(0), empty
+    # Boxcars only exist on the fine grid
+    starts = np.clip(np.concatenate(starts), 0, n_fine)
+    stops = np.clip(np.concatenate(stops), 0, n_fine)
+    return starts, stops, np.concatenate(amps), np.concatenate(cols)
+
+
+# Convolve three-column EVs and sample them on the volume grid
+# A boxcar convolved with the HRF is the difference of two shifted step
+# responses, so only the sampled time points of every event are evaluated
+def event_regressors(onsets, durations, amplitudes, n_vols, tr, oversampling = 20):
+    dt = float(tr) / oversampling
+    n_fine = int(n_vols * oversampling)
+    starts, stops, amps, cols = event_table(onsets, durations, amplitudes, n_fine, dt)
+    step = hrf_step(dt)
+    # Sample at the middle of each volume
+    sample_idx = (np.arange(n_vols) * oversampling + oversampling // 2).astype(int)
+    # step[k] is the HRF summed over lags below k
+    lag_start = np.clip(sample_idx[:, None] - starts[None, :] + 1, 0, len(step) - 1)
+    lag_stop = np.clip(sample_idx[:, None] - stops[None, :] + 1, 0, len(step) - 1)
+    responses = (step[lag_start] - step[lag_stop]) * amps[None, :]
+    # Sum the events of each column
+    indicator = np.zeros((len(cols), len(onsets)))
+    indicator[np.arange(len(cols)), cols] = 1.
+    return np.dot(responses, indicator)
+
+
+# Full design for one model: convolved conditions followed by confound regressors
+def model_design(info, n_vols, tr, oversampling = 20):
+    design = event_regressors(info.onsets, info.durations, info.amplitudes,
+                              n_vols, tr, oversampling)
+    names = list(info.conditions)
+    if info.regressors:
+        confounds = np.column_stack([np.asarray(reg, dtype = float)[:n_vols] for reg in info.regressors])
+        design = np.column_stack((design, confounds))
+        names.extend(info.regressor_names)
+    return design - design.mean(axis = 0), names
+
+
+# Number of volumes of a session: its regressors, or else its scans
+def session_volumes(run_info):
+    if run_info.get('regress'):
+        return len(run_info['regress'][0]['val'])
+    import nibabel as nb
+    scans = run_info['scans']
+    if isinstance(scans, (list, tuple)):
+        if len(scans) > 1:
+            return len(scans)
+        scans = scans[0]
+    return nb.load(scans).shape[3]
+
+
+# Design for one SpecifyModel session_info entry, as Level1Design + FEATModel build it
+# Only bases = {'dgamma': {'derivs': False}} without high-pass filtering is supported
+def session_design(run_info, bases, tr, n_vols = None, oversampling = 20):
+    if isinstance(run_info, (list, tuple)):
+        if len(run_info) != 1:
+            raise ValueError('Expected the session_info of one run, got {0}'.format(len(run_info)))
+        run_info = run_info[0]
+    if list(bases.keys()) != ['dgamma'] or (bases['dgamma'] or {}).get('derivs', False):
+        raise ValueError('Only dgamma bases without derivatives are supported: {0}'.format(bases))
+    if run_info.get('hpf', -1) > 0:
+        raise ValueError('High-pass filtering of the design is not supported (hpf = {0})'.format(run_info['hpf']))
+    if n_vols is None:
+        n_vols = session_volumes(run_info)
+    # Regressors cover the untrimmed run at most; their trailing rows are dropped with the volumes
+    for reg in run_info.get('regress') or []:
+        if len(reg['val']) < n_vols:
+            raise ValueError('Regressor {0} has {1} values for {2} volumes'.format(reg['name'], len(reg['val']), n_vols))
+
+    conds = run_info.get('cond', [])
+    design = event_regressors([cond['onset'] for cond in conds],
+                              [cond['duration'] for cond in conds],
+                              [cond.get('amplitudes', [1.]) for cond in conds],
+                              n_vols, tr, oversampling)
+    names = [cond['name'] for cond in conds]
+    if run_info.get('regress'):
+        confounds = np.column_stack([np.asarray(reg['val'], dtype = float)[:n_vols]
+                                     for reg in run_info['regress']])
+        design = np.column_stack((design, confounds))
+        names.extend(reg['name'] for reg in run_info['regress'])
+    return design - design.mean(axis = 0), names
+
+
+# Contrast names and (n_contrasts, n_columns) weights of the T contrasts
+# given as (name, 'T', [conditions], [weights]); columns not named get zero weight
+def contrast_matrix(contrasts, names):
+    con_names = []
+    rows = []
+    for con in contrasts:
+        if con[1] != 'T':
+            continue
+        row = np.zeros(len(names))
+        for cond, weight in zip(con[2], con[3]):
+            if cond in names:
+                row[names.index(cond)] = weight
+        con_names.append(con[0])
+        rows.append(row)
+    return con_names, np.array(rows).reshape(-1, len(names))
+
+
+# Write an FSL VEST file: header entries as (key, value) pairs, then the matrix
+def write_vest(filename, matrix, header):
+    with open(filename, 'w') as out_file:
+        for key, value in header:
+            out_file.write('/{0}\t{1}\n'.format(key, value))
+        out_file.write('/Matrix\n')
+        for row in np.atleast_2d(matrix):
+            out_file.write('\t'.join('%0.6e' % value for value in row) + '\n')
+    return filename
+
+
+# Write an 8 bit greyscale PNG (rows x columns, values 0-255)
+def write_png(filename, image):
+    image = np.ascontiguousarray(image, dtype = np.uint8)
+    height, width = image.shape
+    raw = b''.join(b'\x00' + image[row].tobytes() for row in range(height))
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    with open(filename, 'wb') as out_file:
+        out_file.write(b'\x89PNG\r\n\x1a\n')
+        out_file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        out_file.write(chunk(b'IDAT', zlib.compress(raw)))
+        out_file.write(chunk(b'IEND', b''))
+    return filename
+
+
+# Column-scaled design (time down, one block per column) and |correlation| previews
+def design_previews(design, block = 8):
+    ptp = np.ptp(design, axis = 0)
+    scaled = (design - design.min(axis = 0)) / np.where(ptp > 0, ptp, 1.)
+    image = np.repeat(scaled * 255, block, axis = 1)
+    if design.shape[1] > 1:
+        corr = np.nan_to_num(np.corrcoef(design.T))
+    else:
+        corr = np.ones((1, 1))
+    cov = np.kron(np.abs(corr) * 255, np.ones((block * 2, block * 2)))
+    return image, cov
+
+
+# Write design.mat, design.con, design.png and design_cov.png like FEATModel
+def write_design(design, con_names, contrasts, out_dir = '.'):
+    out_dir = os.path.abspath(out_dir)
+    files = dict(design_file = os.path.join(out_dir, 'design.mat'),
+                 con_file = os.path.join(out_dir, 'design.con'),
+                 design_image = os.path.join(out_dir, 'design.png'),
+                 design_cov = os.path.join(out_dir, 'design_cov.png'))
+    ppheights = ' '.join('%0.6e' % value for value in np.ptp(design, axis = 0))
+    write_vest(files['design_file'], design,
+               [('NumWaves', design.shape[1]), ('NumPoints', design.shape[0]), ('PPheights', ppheights)])
+    con_heights = ' '.join('%0.6e' % value for value in np.ptp(np.dot(design, contrasts.T), axis = 0))
+    header = [('ContrastName{0}'.format(idx + 1), name) for idx, name in enumerate(con_names)]
+    header += [('NumWaves', design.shape[1]), ('NumContrasts', len(con_names)), ('PPheights', con_heights)]
+    write_vest(files['con_file'], contrasts, header)
+    image, cov = design_previews(design)
+    write_png(files['design_image'], image)
+    write_png(files['design_cov'], cov)
+    return files
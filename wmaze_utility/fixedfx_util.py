@@ -0,0 +1,184 @@
+"""
+=====================================================
+Fixed-effects utilities -- per-run scalar DOFs
+=====================================================
+Each first-level run has one DOF (the ``dof`` file FILMGLS writes), the same
+for every voxel and every contrast of the run. The fixed-effects stage keeps
+them as a vector of per-run scalars and broadcasts them against the run axis
+of the copes instead of materializing (x, y, z, runs) volumes of constants:
+
+- ``read_dofs`` parses each dof file once (cached by path and mtime)
+- ``fixed_effects`` combines in-mask copes/varcopes over runs with the
+  scalar DOFs, as FLAMEO does in fixed-effects mode with the L2Model
+  single-group design (inverse-variance weighted mean, varcope =
+  1 / sum(1 / varcope), DOF = sum of the run DOFs)
+- ``combine_contrasts`` replaces the L2Model + FLAMEO fe MapNodes of the
+  lvl2 scripts (``-e native``): every contrast of a subject is combined in
+  one process, contrasts with the same runs stacked into one array, and the
+  results are written as ``cope_``/``varcope_``/``tstat_``/``zstat_<name>``.
+  Run copes and varcopes are read straight into that array; the merged 4D
+  files of the fslmerge step are only written on request (``write_merged``).
+  Runs of a first level fit with ``-S`` are read straight from its statistics
+  store (``run{n}/{stat}.npy``), no NIfTI export needed
+- ``dof_volumes`` writes the DOF volumes FLAMEO still needs for its
+  ``dof_var_cope_file`` input: a read-only broadcast view of the scalars is
+  written once per distinct set of run DOFs and shared by every contrast
+  with the same runs
+"""
+
+import os
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.precision import precision_dtype
+from wmaze_utility.stats_util import t_to_z
+
+
+_DOF_CACHE = {}
+
+
+# Per-run scalar DOFs of the given dof files, each file parsed once
+def read_dofs(dof_files):
+    dofs = []
+    for dof_file in dof_files:
+        dof_file = os.path.abspath(dof_file)
+        key = (dof_file, os.path.getmtime(dof_file))
+        if key not in _DOF_CACHE:
+            _DOF_CACHE[key] = float(np.loadtxt(dof_file))
+        dofs.append(_DOF_CACHE[key])
+    return np.array(dofs)
+
+
+# Fixed-effects combination of (..., runs, voxels) copes and varcopes with per-run scalar DOFs
+# (dofs of shape (runs,) or (..., runs)); leading axes (e.g. contrasts) are combined at once
+# Returns cope, varcope, tstat and zstat (..., voxels) arrays and the combined DOF (...)
+def fixed_effects(copes, varcopes, dofs):
+    copes = np.asarray(copes, dtype = float)
+    varcopes = np.asarray(varcopes, dtype = float)
+    dofs = np.asarray(dofs, dtype = float)
+    if copes.ndim < 2 or copes.shape != varcopes.shape or dofs.shape[-1] != copes.shape[-2]:
+        raise ValueError('Expected (..., runs, voxels) copes and varcopes and one DOF per run, got '
+                         '{0}, {1} and {2} DOFs'.format(copes.shape, varcopes.shape, dofs.shape))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        weights = np.where(varcopes > 0, 1. / varcopes, 0.)
+        total = weights.sum(axis = -2)
+        valid = total > 0
+        varcope = np.where(valid, 1. / total, 0.)
+        cope = np.where(valid, (weights * copes).sum(axis = -2) * varcope, 0.)
+        tstat = np.where(valid, cope / np.sqrt(varcope), 0.)
+    dof = dofs.sum(axis = -1)
+    dtype = precision_dtype()
+    return dict(cope = cope.astype(dtype), varcope = varcope.astype(dtype), tstat = tstat.astype(dtype),
+                zstat = t_to_z(tstat, np.expand_dims(dof, -1)).astype(dtype), dof = dof)
+
+
+# (runs, voxels) in-mask values of one contrast, stacked in memory from its run files
+# (a merged 4D file, or a 3D file of a single run, is read as is); runs held in a
+# statistics store (manifest references, see stat_store.store_ref) are read from the store
+def masked_runs(files, mask, contrast = None):
+    from wmaze_utility.stat_store import parse_ref, read_ref
+    if not files:
+        raise ValueError('No run files for contrast {0}: it is missing from every run'.format(contrast))
+    if isinstance(files, (list, tuple)) and len(files) == 1 and parse_ref(files[0]) is None:
+        files = files[0]
+    if not isinstance(files, (list, tuple)):
+        img = nb.load(files)
+        data = np.asarray(img.dataobj, dtype = precision_dtype())
+        if data.ndim == 3:
+            data = data[..., None]
+        return data[mask].T, img
+    values = np.empty((len(files), int(mask.sum())), dtype = precision_dtype())
+    for run, run_file in enumerate(files):
+        if parse_ref(run_file) is not None:
+            values[run], img = read_ref(run_file, mask)
+            continue
+        img = nb.load(run_file)
+        if img.shape[:3] != mask.shape:
+            raise ValueError('{0} is {1}, the mask is {2}'.format(run_file, img.shape[:3], mask.shape))
+        values[run] = np.asarray(img.dataobj, dtype = precision_dtype())[mask]
+    return values, img
+
+
+# Write (runs, voxels) in-mask values as a merged 4D file, as fslmerge -t would (zero outside the mask)
+def save_merged(values, mask, ref_img, filename):
+    out_data = np.zeros(mask.shape + (values.shape[0],), dtype = precision_dtype())
+    out_data[mask] = values.T
+    header = ref_img.header.copy()
+    header.set_data_dtype(out_data.dtype)
+    nb.Nifti1Image(out_data, ref_img.affine, header).to_filename(filename)
+    return filename
+
+
+# Fixed effects of every contrast of a subject in one pass, as L2Model + FLAMEO fe per contrast
+# cope_files / varcope_files hold per contrast its run files (stacked in memory, no fslmerge)
+# or one merged file, and dof_files one list of run dof files per contrast; contrasts with
+# the same runs are stacked and combined together.
+# Writes {stat}_{contrast}.nii.gz (cope, varcope, tstat, zstat) to out_dir and returns the
+# files keyed copes / varcopes / tstats / zstats in contrast order, plus the combined dofs.
+# write_merged also writes the stacked inputs as merged_{cope,varcope}_{contrast}.nii.gz (debug).
+def combine_contrasts(cope_files, varcope_files, dof_files, mask_file, con_names, out_dir = None,
+                      write_merged = False):
+    from wmaze_utility.io_util import save_masked
+    if not len(cope_files) == len(varcope_files) == len(dof_files) == len(con_names):
+        raise ValueError('Expected one cope, varcope, dof list and name per contrast')
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    mask = np.asarray(nb.load(mask_file).dataobj) > 0
+    groups = {}
+    for idx, run_dofs in enumerate(dof_files):
+        groups.setdefault(tuple(os.path.abspath(dof_file) for dof_file in run_dofs), []).append(idx)
+    keys = ['copes', 'varcopes', 'tstats', 'zstats', 'dofs']
+    if write_merged:
+        keys += ['merged_copes', 'merged_varcopes']
+    outputs = dict((key, [None] * len(con_names)) for key in keys)
+    for run_dofs, indices in groups.items():
+        dofs = read_dofs(run_dofs)
+        copes = np.empty((len(indices), len(dofs), int(mask.sum())), dtype = precision_dtype())
+        varcopes = np.empty_like(copes)
+        for row, idx in enumerate(indices):
+            values, img = masked_runs(cope_files[idx], mask, con_names[idx])
+            if values.shape[0] != len(dofs):
+                raise ValueError('{0} holds {1} runs but {2} dof files were given'.format(
+                    con_names[idx], values.shape[0], len(dofs)))
+            copes[row] = values
+            varcopes[row] = masked_runs(varcope_files[idx], mask, con_names[idx])[0]
+            if write_merged:
+                for stat, stacked in (('cope', copes), ('varcope', varcopes)):
+                    outputs['merged_{0}s'.format(stat)][idx] = save_merged(stacked[row], mask, img, os.path.join(
+                        out_dir, 'merged_{0}_{1}.nii.gz'.format(stat, con_names[idx])))
+        fit = fixed_effects(copes, varcopes, dofs)
+        del copes, varcopes
+        for row, idx in enumerate(indices):
+            for stat in ('cope', 'varcope', 'tstat', 'zstat'):
+                outputs[stat + 's'][idx] = save_masked(fit[stat][row], mask, img, os.path.join(
+                    out_dir, '{0}_{1}.nii.gz'.format(stat, con_names[idx])))
+            outputs['dofs'][idx] = float(fit['dof'])
+    return outputs
+
+
+# (x, y, z, runs) read-only view of per-run scalar DOFs over a 3D grid
+def broadcast_dofs(dofs, shape):
+    dofs = np.asarray(dofs, dtype = precision_dtype()).reshape(-1)
+    return np.broadcast_to(dofs, tuple(shape[:3]) + (len(dofs),))
+
+
+# DOF volumes for FLAMEO, one per merged cope file (a 3D cope file is a single run)
+# Copes whose runs have the same DOFs share one written volume
+def dof_volumes(dof_files, cope_files, out_dir = None):
+    out_dir = out_dir or os.getcwd()
+    written = {}
+    filenames = []
+    for cope_dofs, cope_file in zip(dof_files, cope_files):
+        img = nb.load(cope_file)
+        n_runs = img.shape[3] if len(img.shape) > 3 else 1
+        dofs = read_dofs(cope_dofs)
+        if len(dofs) != n_runs:
+            raise ValueError('{0} holds {1} runs but {2} dof files were given'.format(cope_file, n_runs, len(dofs)))
+        key = (img.shape[:3], tuple(dofs))
+        if key not in written:
+            filename = os.path.join(out_dir, 'dof_{0}.nii.gz'.format('_'.join('%d' % dof for dof in dofs)))
+            header = img.header.copy()
+            header.set_data_dtype(precision_dtype())
+            nb.Nifti1Image(broadcast_dofs(dofs, img.shape), img.affine, header).to_filename(filename)
+            written[key] = filename
+        filenames.append(written[key])
+    return filenames
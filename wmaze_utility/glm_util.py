@@ -0,0 +1,354 @@
+"""
+===============================================
+GLM utilities -- native prewhitened estimation
+===============================================
+In-process replacement for FILMGLS as configured in the *_lvl1.py scripts
+(``smooth_autocorr = True``, ``mask_size = 5``):
+
+1. voxels with a mean above the threshold are fit by OLS over voxel chunks
+2. the residual autocorrelation of every voxel is estimated up to the Tukey
+   window M (default 2 * sqrt(T)), smoothed spatially within the mask over a
+   mask_size neighbourhood (normalized box filter in place of SUSAN) and
+   Tukey tapered
+3. data and design are prewhitened per voxel in the frequency domain and the
+   model is refit; copes, varcopes, t and z statistics of all contrasts are
+   computed per voxel chunk from the whitened fit in one batched product,
+   and only the requested statistics are kept
+
+Outputs use FILMGLS names in the results directory: pe{n}, cope{n},
+varcope{n}, tstat{n}, zstat{n}, sigmasquareds, threshac1 (.nii.gz) and dof,
+or with final_names the {stat}{NN}_{contrast} names the lvl1 DataSink
+substitutions would give the contrast outputs. When requested, p maps
+(upper tail of the zstats, as fslmaths -ztop) are computed from the zstats
+still in memory and written as zstat{n}_pval.
+
+Stored arrays and written maps follow the precision policy (float32 unless
+WMAZE_PRECISION=float64, see wmaze_utility.precision); each voxel chunk is
+fit in float64. Voxel chunks are processed on a thread pool (NumPy's FFT
+and BLAS calls release the GIL). film_gls_runs fits all runs of a subject in
+one process, reusing the mask and reading the next run while the current
+one is fit.
+
+Models that share confound regressors can share the OLS step: the OLS
+residuals of the full design equal those of the confound-free columns fit
+to data with the confounds projected out (confound_basis, project_out), so
+the projection is done once per run and only the model columns are fit per
+model (fit_run acf_data / acf_design).
+"""
+
+import os
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from scipy import ndimage
+
+from wmaze_utility.io_util import load_run, save_masked
+from wmaze_utility.stats_util import t_to_z, z_to_p
+from wmaze_utility.precision import precision_dtype
+
+
+# Statistic types and the outputs they are returned under; FILMGLS writes
+# FILM_STATS, p maps (fslmaths -ztop of the zstats) are written only on request
+STATS = ('pe', 'cope', 'varcope', 'tstat', 'zstat', 'pval')
+FILM_STATS = STATS[:5]
+STAT_OUTPUTS = dict(pe = 'param_estimates', cope = 'copes', varcope = 'varcopes',
+                    tstat = 'tstats', zstat = 'zstats', pval = 'pvals')
+
+
+# Matrix of an FSL VEST file (design.mat, design.con) plus its header entries
+def read_vest(filename):
+    header = {}
+    rows = []
+    in_matrix = False
+    with open(filename) as in_file:
+        for line in in_file:
+            line = line.strip()
+            if not line:
+                continue
+            if in_matrix:
+                rows.append([float(value) for value in line.split()])
+            elif line.startswith('/Matrix'):
+                in_matrix = True
+            elif line.startswith('/'):
+                parts = line[1:].split(None, 1)
+                header[parts[0]] = parts[1] if len(parts) > 1 else ''
+    return np.array(rows, ndmin = 2), header
+
+
+# Contrast names and weights (n_contrasts, n_regressors) of a FSL .con file
+def read_contrasts(tcon_file):
+    matrix, header = read_vest(tcon_file)
+    names = [header.get('ContrastName{0}'.format(idx + 1), str(idx + 1))
+             for idx in range(matrix.shape[0])]
+    return names, matrix
+
+
+def next_pow2(n):
+    return int(2 ** np.ceil(np.log2(n)))
+
+
+# Map func over voxel chunks, on a thread pool when n_threads > 1
+def map_chunks(func, n_vox, chunk_size, n_threads = 1):
+    chunks = [(start, min(start + chunk_size, n_vox)) for start in range(0, n_vox, chunk_size)]
+    if n_threads > 1 and len(chunks) > 1:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(func, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            func(chunk)
+
+
+# Orthonormal basis (T, k) of the space spanned by the confound columns
+def confound_basis(confounds, tol = 1e-10):
+    confounds = np.asarray(confounds, dtype = np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds[:, None]
+    if not confounds.shape[1]:
+        return np.zeros((confounds.shape[0], 0))
+    u, s, _ = np.linalg.svd(confounds, full_matrices = False)
+    return u[:, s > tol * s.max()]
+
+
+# Remove the span of basis from the columns of values (T, n), in voxel chunks
+def project_out(values, basis, chunk_size = 2000, n_threads = 1):
+    out = np.empty(values.shape, dtype = values.dtype)
+
+    def project_chunk(bounds):
+        start, stop = bounds
+        chunk = values[:, start:stop].astype(np.float64)
+        out[:, start:stop] = chunk - np.dot(basis, np.dot(basis.T, chunk))
+
+    map_chunks(project_chunk, values.shape[1], chunk_size, n_threads)
+    return out
+
+
+# Normalized residual autocorrelation (lags 0..max_lag-1) of the OLS fit
+def ols_autocorrelation(data, design, max_lag, chunk_size = 2000, n_threads = 1):
+    n_vols, n_vox = data.shape
+    nfft = next_pow2(2 * n_vols)
+    pinv = np.linalg.pinv(design)
+    acf = np.zeros((max_lag, n_vox), dtype = precision_dtype())
+
+    def fit_chunk(bounds):
+        start, stop = bounds
+        chunk = data[:, start:stop].astype(np.float64)
+        resid = chunk - np.dot(design, np.dot(pinv, chunk))
+        power = np.abs(np.fft.rfft(resid, nfft, axis = 0)) ** 2
+        corr = np.fft.irfft(power, nfft, axis = 0)[:max_lag]
+        acf[:, start:stop] = corr / np.maximum(corr[0], 1e-30)
+        # Flat voxels keep a white-noise model
+        acf[0, start:stop] = 1.
+
+    map_chunks(fit_chunk, n_vox, chunk_size, n_threads)
+    return acf
+
+
+# Share of in-mask voxels in the size^3 neighbourhood of every in-mask voxel
+def mask_weights(mask, size = 5):
+    return ndimage.uniform_filter(mask.astype(np.float64), size)[mask]
+
+
+# Smooth every lag of the autocorrelation within the mask over a size^3 neighbourhood
+def smooth_autocorrelation(acf, mask, size = 5, weights = None):
+    if weights is None:
+        weights = mask_weights(mask, size)
+    volume = np.zeros(mask.shape)
+    smoothed = np.empty_like(acf)
+    smoothed[0] = 1.
+    for lag in range(1, acf.shape[0]):
+        volume[mask] = acf[lag]
+        smoothed[lag] = ndimage.uniform_filter(volume, size)[mask] / np.maximum(weights, 1e-30)
+    return smoothed
+
+
+# Tukey taper: lag k is weighted by 0.5 * (1 + cos(pi * k / M)) for k < M
+def tukey_taper(acf, tukey_m):
+    lags = np.arange(acf.shape[0])
+    window = np.where(lags < tukey_m, 0.5 * (1. + np.cos(np.pi * lags / float(tukey_m))), 0.)
+    return acf * window[:, None].astype(acf.dtype)
+
+
+# Requested statistics of every contrast for one voxel chunk
+# betas (v, P), xtx_inv (v, P, P) and sigmasq (v,) stay in memory for the chunk;
+# all contrasts are evaluated at once as batched matrix products
+def contrast_stats(contrasts, betas, xtx_inv, sigmasq, dof, stats = FILM_STATS):
+    out = {}
+    if 'pe' in stats:
+        out['pe'] = betas.T
+    cope = np.dot(contrasts, betas.T)
+    if 'cope' in stats:
+        out['cope'] = cope
+    if any(stat in stats for stat in ('varcope', 'tstat', 'zstat', 'pval')):
+        # c' (X'X)^-1 c for every contrast and voxel
+        scale = (np.matmul(contrasts[None, :, :], xtx_inv) * contrasts[None, :, :]).sum(axis = 2).T
+        varcope = scale * sigmasq[None, :]
+        if 'varcope' in stats:
+            out['varcope'] = varcope
+        if any(stat in stats for stat in ('tstat', 'zstat', 'pval')):
+            tstat = np.where(varcope > 0, cope / np.sqrt(np.maximum(varcope, 1e-30)), 0.)
+            if 'tstat' in stats:
+                out['tstat'] = tstat
+            if 'zstat' in stats or 'pval' in stats:
+                zstat = t_to_z(tstat, dof)
+                if 'zstat' in stats:
+                    out['zstat'] = zstat
+                if 'pval' in stats:
+                    out['pval'] = z_to_p(zstat)
+    return out
+
+
+# Prewhitened refit: every voxel's data and design are filtered by the inverse
+# square root of the spectrum implied by its autocorrelation
+# Returns sigmasq, dof and a (rows, voxels) array per requested statistic
+def whitened_fit(data, design, acf, contrasts, chunk_size = 500, n_threads = 1, stats = FILM_STATS):
+    n_vols, n_vox = data.shape
+    n_regs = design.shape[1]
+    nfft = next_pow2(2 * n_vols)
+    max_lag = acf.shape[0]
+    design_fft = np.fft.rfft(design, nfft, axis = 0)
+    dof = n_vols - np.linalg.matrix_rank(design)
+
+    fit = dict((stat, np.zeros((n_regs if stat == 'pe' else len(contrasts), n_vox), dtype = precision_dtype()))
+               for stat in stats)
+    fit['sigmasq'] = np.zeros(n_vox, dtype = precision_dtype())
+
+    def fit_chunk(bounds):
+        start, stop = bounds
+        # Symmetric autocorrelation sequence -> power spectrum of each voxel
+        sequence = np.zeros((nfft, stop - start))
+        sequence[:max_lag] = acf[:, start:stop]
+        sequence[nfft - max_lag + 1:] = acf[1:, start:stop][::-1]
+        spectrum = np.real(np.fft.rfft(sequence, axis = 0))
+        filt = 1. / np.sqrt(np.maximum(spectrum, 1e-6))
+        chunk = data[:, start:stop].astype(np.float64)
+        y_w = np.fft.irfft(np.fft.rfft(chunk, nfft, axis = 0) * filt, nfft, axis = 0)[:n_vols]
+        # (voxels, time, regressors) whitened designs
+        x_w = np.fft.irfft(design_fft[None, :, :] * filt.T[:, :, None], nfft, axis = 1)[:, :n_vols]
+        xtx_inv = np.linalg.pinv(np.einsum('vtp,vtq->vpq', x_w, x_w))
+        xty = np.einsum('vtp,tv->vp', x_w, y_w)
+        betas = np.einsum('vpq,vq->vp', xtx_inv, xty)
+        sse = (y_w ** 2).sum(axis = 0) - (betas * xty).sum(axis = 1)
+        chunk_sigmasq = np.maximum(sse, 0.) / dof
+        fit['sigmasq'][start:stop] = chunk_sigmasq
+        for stat, values in contrast_stats(contrasts, betas, xtx_inv, chunk_sigmasq, dof, stats).items():
+            fit[stat][:, start:stop] = values
+
+    map_chunks(fit_chunk, n_vox, chunk_size, n_threads)
+    fit['dof'] = dof
+    return fit
+
+
+# File name of a statistic: FILMGLS numbering, or with final_names the name the
+# DataSink substitutions of get_subs would give it ({stat}{NN}_{contrast})
+# p maps are named after their zstat with the _pval suffix z2pval used
+def stat_filename(stat, idx, con_names, final_names = False):
+    if stat == 'pval':
+        return stat_filename('zstat', idx, con_names, final_names).replace('.nii.gz', '_pval.nii.gz')
+    if final_names and stat != 'pe':
+        return '{0}{1:02d}_{2}.nii.gz'.format(stat, idx + 1, con_names[idx])
+    return '{0}{1}.nii.gz'.format(stat, idx + 1)
+
+
+# Fit one loaded run (demeaned in place) and write its FILMGLS style results directory
+# Only the requested statistics are computed and written
+# Returns the written files keyed like the FILMGLS interface outputs, or with a
+# store (stat_store.StatStore over the same mask) writes the in-mask arrays as
+# the store's run and returns its store_dir and run_dir instead
+# acf_data / acf_design replace data / design in the OLS autocorrelation step
+# (e.g. the data and model columns with shared confounds projected out)
+def fit_run(data, mask, img, design, con_names, contrasts, results_dir, smooth_autocorr = True,
+            mask_size = 5, tukey_m = None, n_threads = 1, chunk_size = 500, weights = None,
+            stats = FILM_STATS, final_names = False, store = None, run = 0,
+            acf_data = None, acf_design = None):
+    data -= data.mean(axis = 0)
+    n_vols = data.shape[0]
+    if design.shape[0] != n_vols:
+        raise ValueError('Design has {0} rows but the data has {1} volumes'.format(design.shape[0], n_vols))
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError('Unknown statistics: {0}'.format(sorted(unknown)))
+
+    if tukey_m is None:
+        tukey_m = int(2 * np.sqrt(n_vols))
+    if acf_data is None:
+        acf_data, acf_design = data, design
+    acf = ols_autocorrelation(acf_data, acf_design, tukey_m, n_threads = n_threads)
+    if smooth_autocorr:
+        acf = smooth_autocorrelation(acf, mask, mask_size, weights)
+    acf = tukey_taper(acf, tukey_m)
+    fit = whitened_fit(data, design, acf, contrasts, chunk_size, n_threads, stats)
+    threshac1 = acf[1] if acf.shape[0] > 1 else np.zeros(mask.sum())
+
+    if store is not None:
+        arrays = dict((stat, fit[stat]) for stat in stats)
+        arrays.update(sigmasquareds = fit['sigmasq'], threshac1 = threshac1)
+        run_dir = store.write_run(run, con_names, arrays, fit['dof'])
+        return dict(store_dir = store.store_dir, run_dir = run_dir)
+
+    results_dir = os.path.abspath(results_dir)
+    out = {}
+    for stat in STATS:
+        if stat not in stats:
+            continue
+        out[STAT_OUTPUTS[stat]] = [save_masked(values, mask, img, os.path.join(
+            results_dir, stat_filename(stat, idx, con_names, final_names)))
+                                   for idx, values in enumerate(fit[stat])]
+    out['sigmasquareds'] = save_masked(fit['sigmasq'], mask, img, os.path.join(results_dir, 'sigmasquareds.nii.gz'))
+    out['thresholdac'] = save_masked(threshac1, mask, img, os.path.join(results_dir, 'threshac1.nii.gz'))
+    out['dof_file'] = os.path.join(results_dir, 'dof')
+    np.savetxt(out['dof_file'], [fit['dof']], fmt = '%d')
+    out['results_dir'] = results_dir
+    return out
+
+
+# Estimate one run like FILMGLS and write its results directory
+# Only the first n_vols volumes are used when given (replaces an ExtractROI copy)
+def film_gls(in_file, design_file, tcon_file, results_dir = 'results', threshold = 0.0,
+             smooth_autocorr = True, mask_size = 5, tukey_m = None, n_threads = 1,
+             chunk_size = 500, n_vols = None, stats = FILM_STATS, final_names = False):
+    design = read_vest(design_file)[0]
+    con_names, contrasts = read_contrasts(tcon_file)
+    data, mask, img = load_run(in_file, n_vols, threshold)
+    return fit_run(data, mask, img, design, con_names, contrasts, results_dir, smooth_autocorr,
+                   mask_size, tukey_m, n_threads, chunk_size, stats = stats, final_names = final_names)
+
+
+# Estimate all runs of a subject in one process, like a FILMGLS MapNode over the runs
+# The mask of the first run (and its smoothing weights) is reused for every run,
+# and run k + 1 is read on a background thread while run k is fit. Run n writes
+# to {out_dir}/_estimate_model{n}/{results_name}, so DataSink keeps the MapNode layout.
+# With store_dir the runs go into one in-mask statistics store over that mask
+# (see stat_store) and no NIfTI maps are written.
+def film_gls_runs(in_files, design_files, tcon_files, out_dir = '.', threshold = 0.0,
+                  smooth_autocorr = True, mask_size = 5, tukey_m = None, n_threads = 1,
+                  chunk_size = 500, results_name = 'results', n_vols = None, stats = FILM_STATS,
+                  final_names = False, store_dir = None):
+    if not len(in_files) == len(design_files) == len(tcon_files):
+        raise ValueError('Expected one design and contrast file per run')
+    data, mask, img = load_run(in_files[0], n_vols, threshold)
+    store = None
+    if store_dir:
+        from wmaze_utility.stat_store import StatStore
+        store = StatStore.create(store_dir, mask, img)
+    weights = mask_weights(mask, mask_size) if smooth_autocorr else None
+    loader = ThreadPool(1)
+    outputs = []
+    try:
+        for idx in range(len(in_files)):
+            pending = None
+            if idx + 1 < len(in_files):
+                pending = loader.apply_async(load_run, (in_files[idx + 1], n_vols, threshold, mask))
+            con_names, contrasts = read_contrasts(tcon_files[idx])
+            results_dir = os.path.join(out_dir, '_estimate_model{0}'.format(idx), results_name)
+            outputs.append(fit_run(data, mask, img, read_vest(design_files[idx])[0], con_names, contrasts,
+                                   results_dir, smooth_autocorr, mask_size, tukey_m, n_threads,
+                                   chunk_size, weights, stats, final_names, store, idx))
+            if pending is not None:
+                data, _, img = pending.get()
+    finally:
+        loader.close()
+        loader.join()
+    return outputs
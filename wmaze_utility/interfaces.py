@@ -0,0 +1,244 @@
+"""
+=================================================
+Nipype interfaces -- native drop-in replacements
+=================================================
+Interfaces that can take the place of FSL nodes in the *_lvl1.py and
+*_lvl2.py workflows while keeping their input and output names, so the surrounding connections
+and DataSink substitutions stay unchanged.
+
+The native estimators can be limited to the statistics a workflow uses
+(``stats``) and can write contrast outputs under their final
+``{stat}{NN}_{contrast}`` names (``final_names``), which leaves the
+substitutions nothing to rename. Outputs of statistics that were not
+requested stay undefined.
+"""
+
+import os
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec,
+                                    File, Directory, InputMultiPath, OutputMultiPath, traits)
+
+
+class StatsMixin(object):
+    """Requested statistics and naming shared by the native estimators."""
+
+    def _stat_args(self):
+        from wmaze_utility.glm_util import FILM_STATS
+        stats = self.inputs.stats if self.inputs.stats else FILM_STATS
+        return dict(stats = stats, final_names = self.inputs.final_names)
+
+
+class FILMGLSNativeInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists = True, mandatory = True, desc = 'input data file')
+    design_file = File(exists = True, mandatory = True, desc = 'design matrix file (design.mat)')
+    tcon_file = File(exists = True, mandatory = True, desc = 'contrast file containing T-contrasts')
+    threshold = traits.Float(0.0, usedefault = True, desc = 'mean intensity threshold of the voxel mask')
+    smooth_autocorr = traits.Bool(True, usedefault = True, desc = 'spatially smooth the autocorrelation')
+    mask_size = traits.Int(5, usedefault = True, desc = 'autocorrelation smoothing neighbourhood (voxels)')
+    tukey_window = traits.Int(desc = 'Tukey window size (default 2 * sqrt(volumes))')
+    results_dir = Directory('results', usedefault = True, desc = 'directory to store results in')
+    n_threads = traits.Int(1, usedefault = True, desc = 'threads used over voxel chunks')
+    n_vols = traits.Int(desc = 'only use the first n_vols volumes of each run')
+    stats = traits.List(traits.Enum('pe', 'cope', 'varcope', 'tstat', 'zstat', 'pval'),
+                        desc = 'statistics to compute and write (default: all FILMGLS outputs)')
+    final_names = traits.Bool(False, usedefault = True,
+                              desc = 'name contrast outputs {stat}{NN}_{contrast} instead of {stat}{n}')
+
+
+class FILMGLSNativeOutputSpec(TraitedSpec):
+    param_estimates = OutputMultiPath(File(exists = True), desc = 'parameter estimates for each column of the design')
+    copes = OutputMultiPath(File(exists = True), desc = 'contrast estimates for each contrast')
+    varcopes = OutputMultiPath(File(exists = True), desc = 'variance estimates for each contrast')
+    tstats = OutputMultiPath(File(exists = True), desc = 't-stat file for each contrast')
+    zstats = OutputMultiPath(File(exists = True), desc = 'z-stat file for each contrast')
+    pvals = OutputMultiPath(File(exists = True), desc = 'p value file for each contrast (pval requested)')
+    sigmasquareds = File(exists = True, desc = 'summary of residuals')
+    thresholdac = File(exists = True, desc = 'lag 1 autocorrelation estimate')
+    dof_file = File(exists = True, desc = 'degrees of freedom')
+    results_dir = Directory(exists = True, desc = 'directory storing model estimation output')
+
+
+class FILMGLSNative(StatsMixin, BaseInterface):
+    """Prewhitened GLM estimation in-process (see wmaze_utility.glm_util.film_gls)."""
+
+    input_spec = FILMGLSNativeInputSpec
+    output_spec = FILMGLSNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        from wmaze_utility.glm_util import film_gls
+        tukey_m = self.inputs.tukey_window if self.inputs.tukey_window else None
+        self._results = film_gls(self.inputs.in_file, self.inputs.design_file, self.inputs.tcon_file,
+                                 results_dir = os.path.join(runtime.cwd, self.inputs.results_dir),
+                                 threshold = self.inputs.threshold,
+                                 smooth_autocorr = self.inputs.smooth_autocorr,
+                                 mask_size = self.inputs.mask_size,
+                                 tukey_m = tukey_m,
+                                 n_threads = self.inputs.n_threads,
+                                 n_vols = self.inputs.n_vols if self.inputs.n_vols else None,
+                                 **self._stat_args())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
+
+
+class FILMGLSNativeRunsInputSpec(BaseInterfaceInputSpec):
+    in_file = InputMultiPath(File(exists = True), mandatory = True, desc = 'input data file of every run')
+    design_file = InputMultiPath(File(exists = True), mandatory = True, desc = 'design matrix file of every run')
+    tcon_file = InputMultiPath(File(exists = True), mandatory = True, desc = 'T-contrast file of every run')
+    threshold = traits.Float(0.0, usedefault = True, desc = 'mean intensity threshold of the voxel mask')
+    smooth_autocorr = traits.Bool(True, usedefault = True, desc = 'spatially smooth the autocorrelation')
+    mask_size = traits.Int(5, usedefault = True, desc = 'autocorrelation smoothing neighbourhood (voxels)')
+    tukey_window = traits.Int(desc = 'Tukey window size (default 2 * sqrt(volumes))')
+    results_dir = Directory('results', usedefault = True, desc = "name of each run's results directory")
+    store_dir = Directory(desc = 'write in-mask statistics to this store instead of NIfTI maps')
+    n_threads = traits.Int(1, usedefault = True, desc = 'threads used over voxel chunks')
+    n_vols = traits.Int(desc = 'only use the first n_vols volumes of each run')
+    stats = traits.List(traits.Enum('pe', 'cope', 'varcope', 'tstat', 'zstat', 'pval'),
+                        desc = 'statistics to compute and write (default: all FILMGLS outputs)')
+    final_names = traits.Bool(False, usedefault = True,
+                              desc = 'name contrast outputs {stat}{NN}_{contrast} instead of {stat}{n}')
+
+
+class FILMGLSNativeRunsOutputSpec(TraitedSpec):
+    param_estimates = traits.List(traits.List(File(exists = True)), desc = 'parameter estimates of every run')
+    copes = traits.List(traits.List(File(exists = True)), desc = 'contrast estimates of every run')
+    varcopes = traits.List(traits.List(File(exists = True)), desc = 'variance estimates of every run')
+    tstats = traits.List(traits.List(File(exists = True)), desc = 't-stat files of every run')
+    zstats = traits.List(traits.List(File(exists = True)), desc = 'z-stat files of every run')
+    pvals = traits.List(traits.List(File(exists = True)), desc = 'p value files of every run (pval requested)')
+    sigmasquareds = traits.List(File(exists = True), desc = 'summary of residuals of every run')
+    thresholdac = traits.List(File(exists = True), desc = 'lag 1 autocorrelation estimate of every run')
+    dof_file = traits.List(File(exists = True), desc = 'degrees of freedom of every run')
+    results_dir = traits.List(Directory(exists = True), desc = 'results directory of every run')
+    store_dir = Directory(exists = True, desc = 'in-mask statistics store (store_dir set)')
+
+
+class FILMGLSNativeRuns(StatsMixin, BaseInterface):
+    """All runs of a subject in one process (see wmaze_utility.glm_util.film_gls_runs).
+
+    Outputs are per-run lists in the shape a FILMGLS MapNode over the runs
+    produces, and run n is written under _estimate_model{n}/. With store_dir
+    the runs are written to an in-mask store (see wmaze_utility.stat_store)
+    and store_dir is the only output.
+    """
+
+    input_spec = FILMGLSNativeRunsInputSpec
+    output_spec = FILMGLSNativeRunsOutputSpec
+
+    def _run_interface(self, runtime):
+        from wmaze_utility.glm_util import film_gls_runs
+        tukey_m = self.inputs.tukey_window if self.inputs.tukey_window else None
+        runs = film_gls_runs(self.inputs.in_file, self.inputs.design_file, self.inputs.tcon_file,
+                             out_dir = runtime.cwd,
+                             results_name = self.inputs.results_dir,
+                             threshold = self.inputs.threshold,
+                             smooth_autocorr = self.inputs.smooth_autocorr,
+                             mask_size = self.inputs.mask_size,
+                             tukey_m = tukey_m,
+                             n_threads = self.inputs.n_threads,
+                             n_vols = self.inputs.n_vols if self.inputs.n_vols else None,
+                             store_dir = self.inputs.store_dir if self.inputs.store_dir else None,
+                             **self._stat_args())
+        if self.inputs.store_dir:
+            self._results = dict(store_dir = runs[0]['store_dir'])
+        else:
+            self._results = dict((key, [run[key] for run in runs]) for key in runs[0])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
+
+
+class Level1DesignNativeInputSpec(BaseInterfaceInputSpec):
+    session_info = traits.Any(mandatory = True, desc = 'session_info of one run from SpecifyModel')
+    contrasts = traits.List(traits.Any(), desc = "T contrasts as (name, 'T', [conditions], [weights])")
+    bases = traits.Dict(mandatory = True, desc = "basis functions, only {'dgamma': {'derivs': False}}")
+    interscan_interval = traits.Float(mandatory = True, desc = 'interscan interval (in secs)')
+    n_vols = traits.Int(desc = 'number of volumes modelled (default: regressor length or scans)')
+
+
+class Level1DesignNativeOutputSpec(TraitedSpec):
+    design_file = File(exists = True, desc = 'mat file containing ascii matrix for design')
+    con_file = File(exists = True, desc = 'contrast file containing contrast vectors')
+    design_image = File(exists = True, desc = 'graphical representation of design matrix')
+    design_cov = File(exists = True, desc = 'graphical representation of design covariance')
+
+
+class Level1DesignNative(BaseInterface):
+    """Level1Design + FEATModel in-process (see wmaze_utility.design_util.session_design)."""
+
+    input_spec = Level1DesignNativeInputSpec
+    output_spec = Level1DesignNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        from wmaze_utility.design_util import session_design, contrast_matrix, write_design
+        n_vols = self.inputs.n_vols if self.inputs.n_vols else None
+        design, names = session_design(self.inputs.session_info, self.inputs.bases,
+                                       self.inputs.interscan_interval, n_vols)
+        contrasts = self.inputs.contrasts if self.inputs.contrasts else []
+        con_names, weights = contrast_matrix(contrasts, names)
+        self._results = write_design(design, con_names, weights, runtime.cwd)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
+
+
+class FixedEffectsNativeInputSpec(BaseInterfaceInputSpec):
+    cope_files = traits.List(traits.Either(File(exists = True), traits.List(traits.Str())), mandatory = True,
+                             desc = 'run copes (files or stat_store references, or one merged file) of every contrast')
+    var_cope_files = traits.List(traits.Either(File(exists = True), traits.List(traits.Str())), mandatory = True,
+                                 desc = 'run varcopes (files or stat_store references, or one merged file) of every contrast')
+    dof_files = traits.List(traits.List(File(exists = True)), mandatory = True,
+                            desc = 'run dof files of every contrast')
+    mask_file = File(exists = True, mandatory = True, desc = 'brain mask on the cope grid')
+    contrasts = traits.List(traits.Str(), mandatory = True, desc = 'contrast names, one per cope file')
+    write_merged = traits.Bool(False, usedefault = True,
+                               desc = 'also write the stacked inputs as merged 4D files (debug)')
+
+
+class FixedEffectsNativeOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists = True), desc = 'fixed-effects cope of each contrast')
+    var_copes = OutputMultiPath(File(exists = True), desc = 'fixed-effects varcope of each contrast')
+    tstats = OutputMultiPath(File(exists = True), desc = 't-stat file of each contrast')
+    zstats = OutputMultiPath(File(exists = True), desc = 'z-stat file of each contrast')
+    dofs = traits.List(traits.Float(), desc = 'fixed-effects DOF of each contrast')
+    merged_copes = OutputMultiPath(File(exists = True), desc = 'merged run copes of each contrast (write_merged)')
+    merged_var_copes = OutputMultiPath(File(exists = True),
+                                       desc = 'merged run varcopes of each contrast (write_merged)')
+
+
+class FixedEffectsNative(BaseInterface):
+    """L2Model + FLAMEO fe over every contrast in-process (see wmaze_utility.fixedfx_util).
+
+    Outputs are named cope_/varcope_/tstat_/zstat_<contrast>.nii.gz, the
+    names the lvl2 DataSink substitutions give the FLAMEO outputs. Run copes
+    and varcopes are stacked in memory, so no fslmerge step is needed, and
+    runs held in a statistics store are read from it directly.
+    """
+
+    input_spec = FixedEffectsNativeInputSpec
+    output_spec = FixedEffectsNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        from wmaze_utility.fixedfx_util import combine_contrasts
+        results = combine_contrasts(self.inputs.cope_files, self.inputs.var_cope_files, self.inputs.dof_files,
+                                    self.inputs.mask_file, self.inputs.contrasts, runtime.cwd,
+                                    write_merged = self.inputs.write_merged)
+        self._results = dict(copes = results['copes'], var_copes = results['varcopes'],
+                             tstats = results['tstats'], zstats = results['zstats'], dofs = results['dofs'])
+        if self.inputs.write_merged:
+            self._results.update(merged_copes = results['merged_copes'],
+                                 merged_var_copes = results['merged_varcopes'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
@@ -0,0 +1,86 @@
+"""
+==================================
+I/O utilities -- masked EPI access
+==================================
+Helpers for reading 4D runs into voxel-by-time arrays restricted to a mask and
+writing masked statistics back out as NIfTI volumes.
+
+Runs can also be staged once into a shared buffer: an uncompressed,
+demeaned (T, V) .npy file plus its mask, written to a work directory and
+memory-mapped by every reader. Decompression and network reads then happen
+once per run, however many trial models are fit against it.
+
+Data are read and written at the precision policy of wmaze_utility.precision
+(float32 unless WMAZE_PRECISION=float64).
+"""
+
+import os
+import hashlib
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.precision import precision_dtype, precision_name
+
+
+# Load a 4D run once, keep the first n_vols volumes, return (T, V) in-mask data
+def load_run(in_file, n_vols = None, threshold = 0.0, mask = None):
+    img = nb.load(in_file)
+    if n_vols is None:
+        n_vols = img.shape[-1]
+    elif n_vols > img.shape[-1]:
+        raise ValueError('{0} has {1} volumes, {2} requested'.format(in_file, img.shape[-1], n_vols))
+    # Trailing volumes are dropped while reading, no trimmed copy is written
+    data = np.asarray(img.dataobj[..., :n_vols], dtype = precision_dtype())
+    # Same voxel selection as FILMGLS: mean intensity above the threshold
+    if mask is None:
+        mask = data.mean(axis = -1) > threshold
+    return data[mask].T, mask, img
+
+
+# Write in-mask values back into a volume shaped like the reference image
+def save_masked(values, mask, ref_img, filename):
+    out_data = np.zeros(mask.shape, dtype = precision_dtype())
+    out_data[mask] = values
+    header = ref_img.header.copy()
+    header.set_data_dtype(out_data.dtype)
+    out_dir = os.path.dirname(filename)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    nb.Nifti1Image(out_data, ref_img.affine, header).to_filename(filename)
+    return filename
+
+
+# Buffer file names for a run: one entry per source path, volume count, mask threshold
+# and precision, so a buffer staged with other settings is never reused
+def buffer_paths(in_file, buffer_dir, n_vols = None, threshold = 0.0):
+    key = hashlib.md5('{0}:{1}:{2!r}:{3}'.format(os.path.abspath(in_file), n_vols, float(threshold),
+                                                 precision_name()).encode()).hexdigest()[:12]
+    stem = os.path.join(buffer_dir, '{0}_{1}'.format(os.path.basename(in_file).split('.')[0], key))
+    return stem + '_data.npy', stem + '_mask.npy'
+
+
+# Stage a run into the shared buffer (if not already there) and memory-map it
+# Returns the demeaned (T, V) data as a read-only memmap, the mask and the image
+def shared_run(in_file, buffer_dir, n_vols = None, threshold = 0.0):
+    data_file, mask_file = buffer_paths(in_file, buffer_dir, n_vols, threshold)
+    img = nb.load(in_file)
+    # Rebuild a stale buffer when the source run changed after staging
+    if (not os.path.exists(data_file) or
+            os.path.getmtime(data_file) < os.path.getmtime(in_file)):
+        if not os.path.exists(buffer_dir):
+            try:
+                os.makedirs(buffer_dir)
+            except OSError:
+                # Another worker created it first
+                pass
+        data, mask, img = load_run(in_file, n_vols, threshold)
+        data -= data.mean(axis = 0)
+        # Write under per-process temporary names so concurrent workers staging the
+        # same run never expose (or read) a partial file; the mask goes in first
+        for values, filename in [(mask, mask_file), (data, data_file)]:
+            tmp_file = '{0}.{1}.tmp.npy'.format(filename[:-4], os.getpid())
+            np.save(tmp_file, values)
+            os.rename(tmp_file, filename)
+        del data
+    mask = np.load(mask_file)
+    return np.load(data_file, mmap_mode = 'r'), mask, img
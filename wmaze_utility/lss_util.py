@@ -0,0 +1,413 @@
+"""
+=============================================
+LSS utilities -- native beta-series estimation
+=============================================
+In-process least-squares-separate (LSS) estimation for model_LSS.
+
+Every trial model of a run is fit against the same 4D data, so each run is
+loaded once and all of its trial models are solved together over voxel
+chunks. Two solvers are available:
+
+- 'batched'    -- every trial model is solved in full as one stacked
+                  least-squares problem
+- 'projection' -- columns shared by the trial models of a run (pending
+                  condition, all_remaining, motion/noise) are factorized once
+                  and projected out of the data; each trial then only solves
+                  its own small residual problem (trial + allbut columns)
+
+Outputs follow the FILMGLS + DataSink layout of LSS_lvl1.py:
+
+    modelfit/contrasts/_estimate_model{N}/cope{NN}_{condition}.nii.gz
+    modelfit/contrasts/_estimate_model{N}/varcope{NN}_{condition}.nii.gz
+    modelfit/contrasts/_estimate_model{N}/tstat{NN}_{condition}.nii.gz
+    modelfit/contrasts/_estimate_model{N}/zstat{NN}_{condition}.nii.gz
+    modelfit/dofs/_estimate_model{N}/dof
+    modelfit/estimates/_estimate_model{N}/sigmasquareds.nii.gz
+
+An LSA (least-squares-all) mode fits a single GLM per run instead, with one
+regressor per trial next to the columns shared by all trial models
+(all_remaining, motion/noise). Each trial's estimate is written as cope01 of
+the LSS model it belongs to, so LSS and LSA outputs are interchangeable
+downstream. The collinearity of the trial regressors is written to
+
+    modelfit/lsa_collinearity/run{R}.txt
+
+(variance inflation factor and largest absolute correlation with any other
+trial regressor) so it is clear when the single fit is safe to use. The
+run's sigmasquareds map is shared by its trials: it is written once and
+hard-linked into the other trials' estimates directories.
+
+With a store directory the trial-of-interest copes are also written straight
+into the subject's beta-series store (see betaseries_util.BetaSeriesStore),
+row N holding the trial of _estimate_model{N}.
+
+Runs (or, with a buffer directory, batches of a run's trial models) can be
+fit on a local process pool (see parallel_util.bounded_map) bounded by a
+worker count, a memory budget and a cap on the number of runs in flight;
+each task writes its outputs as soon as it finishes.
+
+With a buffer directory every run is first staged as an uncompressed
+memory-mapped array (see io_util.shared_run), so all trial fits of that run,
+including repeated or concurrent invocations, read the same decompressed copy.
+
+The projection solver only writes the trial-specific conditions, since the
+shared columns are never estimated. In target-only mode just the trial of
+interest (condition 01) is estimated and only its cope is written, plus its
+varcope and dof when the variance is requested.
+"""
+
+import os
+import re
+import shutil
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.betaseries_util import BetaSeriesStore
+from wmaze_utility.design_util import event_regressors, model_design
+from wmaze_utility.io_util import load_run, save_masked, shared_run
+from wmaze_utility.parallel_util import bounded_map
+from wmaze_utility.precision import precision_dtype
+from wmaze_utility.stats_util import t_to_z
+
+
+# Solve a stack of same-sized designs against one block of voxels
+# designs: (M, T, P), data: (T, V) -- returns betas (M, P, V), sse (M, V)
+def batched_ols(designs, data):
+    pinv = np.linalg.pinv(designs)
+    betas = np.matmul(pinv, data)
+    xty = np.matmul(designs.transpose(0, 2, 1), data)
+    sse = (data ** 2).sum(axis = 0) - (betas * xty).sum(axis = 1)
+    return betas, np.maximum(sse, 0.)
+
+
+# Orthonormal basis for the column space of a (T, P) matrix
+def orth_basis(matrix, tol = 1e-10):
+    if matrix.shape[1] == 0:
+        return matrix
+    u, s, _ = np.linalg.svd(matrix, full_matrices = False)
+    return u[:, s > tol * s.max()]
+
+
+# Full solve of every model; results keep all conditions
+def solve_batched(designs, n_cons, data, n_vols, chunk_size = 20000, target_only = False):
+    results = [None] * len(designs)
+    groups = {}
+    for idx, design in enumerate(designs):
+        groups.setdefault(design.shape[1], []).append(idx)
+
+    n_vox = data.shape[1]
+    for members in groups.values():
+        stack = np.array([designs[idx] for idx in members])
+        xtx_inv = np.linalg.pinv(np.matmul(stack.transpose(0, 2, 1), stack))
+        dofs = n_vols - np.linalg.matrix_rank(stack)
+        # Target-only keeps just the trial column, which is always the first
+        n_keep = 1 if target_only else stack.shape[2]
+        betas = np.zeros((len(members), n_keep, n_vox), dtype = precision_dtype())
+        sigmasq = np.zeros((len(members), n_vox), dtype = precision_dtype())
+        for start in range(0, n_vox, chunk_size):
+            stop = min(start + chunk_size, n_vox)
+            chunk_betas, chunk_sse = batched_ols(stack, data[:, start:stop].astype(np.float64))
+            betas[:, :, start:stop] = chunk_betas[:, :n_keep]
+            sigmasq[:, start:stop] = chunk_sse / dofs[:, None]
+        for pos, idx in enumerate(members):
+            cons = [0] if target_only else list(range(n_cons[idx]))
+            results[idx] = dict(columns = cons,
+                                copes = betas[pos, cons],
+                                var_scale = xtx_inv[pos, cons, cons],
+                                sigmasq = sigmasq[pos],
+                                dof = int(dofs[pos]))
+    return results
+
+
+# Shared-nuisance solve: project the shared columns out once per group of trial
+# models, then solve each model's small trial-specific residual problem
+def solve_projected(designs, names, n_cons, data, n_vols, chunk_size = 20000, target_only = False):
+    # A column is trial-specific if its name belongs to this model only
+    counts = {}
+    for model_names in names:
+        for name in model_names:
+            counts[name] = counts.get(name, 0) + 1
+
+    groups = {}
+    for idx, model_names in enumerate(names):
+        own = [col for col, name in enumerate(model_names) if counts[name] == 1]
+        shared = tuple(name for name in model_names if counts[name] > 1)
+        groups.setdefault(shared, []).append((idx, own))
+
+    results = [None] * len(designs)
+    n_vox = data.shape[1]
+    for shared, members in groups.items():
+        # Shared columns must be the same regressors in every member
+        first = members[0][0]
+        shared_cols = [names[first].index(name) for name in shared]
+        shared_design = designs[first][:, shared_cols]
+        for idx, _ in members[1:]:
+            other = designs[idx][:, [names[idx].index(name) for name in shared]]
+            if not np.allclose(other, shared_design):
+                raise ValueError('Shared LSS columns differ between trial models')
+        basis = orth_basis(shared_design)
+
+        # Residualize every trial-specific column of the group in one pass
+        own_design = np.column_stack([designs[idx][:, own] for idx, own in members])
+        own_design = own_design - np.dot(basis, np.dot(basis.T, own_design))
+        offsets = np.cumsum([0] + [len(own) for _, own in members])
+
+        # Small per-model Gram matrices, inverted once
+        grams_inv = []
+        dofs = []
+        for pos, (idx, own) in enumerate(members):
+            resid = own_design[:, offsets[pos]:offsets[pos + 1]]
+            grams_inv.append(np.linalg.pinv(np.dot(resid.T, resid)))
+            dofs.append(n_vols - basis.shape[1] - np.linalg.matrix_rank(resid))
+
+        copes = [np.zeros((len(own), n_vox), dtype = precision_dtype()) for _, own in members]
+        sigmasq = np.zeros((len(members), n_vox), dtype = precision_dtype())
+        for start in range(0, n_vox, chunk_size):
+            stop = min(start + chunk_size, n_vox)
+            chunk = data[:, start:stop].astype(np.float64)
+            chunk = chunk - np.dot(basis, np.dot(basis.T, chunk))
+            yy = (chunk ** 2).sum(axis = 0)
+            # One product gives Z'y for every trial-specific column of the group
+            zty = np.dot(own_design.T, chunk)
+            for pos in range(len(members)):
+                block = zty[offsets[pos]:offsets[pos + 1]]
+                betas = np.dot(grams_inv[pos], block)
+                sse = np.maximum(yy - (betas * block).sum(axis = 0), 0.)
+                copes[pos][:, start:stop] = betas
+                sigmasq[pos, start:stop] = sse / dofs[pos]
+
+        for pos, (idx, own) in enumerate(members):
+            keep = [col_pos for col_pos, col in enumerate(own)
+                    if col < (1 if target_only else n_cons[idx])]
+            results[idx] = dict(columns = [own[col_pos] for col_pos in keep],
+                                copes = copes[pos][keep],
+                                var_scale = np.diag(grams_inv[pos])[keep],
+                                sigmasq = sigmasq[pos],
+                                dof = int(dofs[pos]))
+    return results
+
+
+# Write cope/varcope/tstat/zstat, sigmasquareds and dof for one trial model
+# target_only writes the copes alone, plus varcope and dof when with_variance is set
+# sigmasq_file links an already written sigmasquareds map instead of writing it again
+def write_model_outputs(result, info, model_id, mask, img, out_dir,
+                        target_only = False, with_variance = False, sigmasq_file = None):
+    model_dir = '_estimate_model{0}'.format(model_id)
+    con_dir = os.path.join(out_dir, 'modelfit', 'contrasts', model_dir)
+    write_variance = with_variance or not target_only
+    for cope, var_scale, con in zip(result['copes'], result['var_scale'], result['columns']):
+        name = '{0:02d}_{1}.nii.gz'.format(con + 1, info.conditions[con])
+        save_masked(cope, mask, img, os.path.join(con_dir, 'cope' + name))
+        if not write_variance:
+            continue
+        varcope = var_scale * result['sigmasq']
+        save_masked(varcope, mask, img, os.path.join(con_dir, 'varcope' + name))
+        if target_only:
+            continue
+        tstat = np.where(varcope > 0, cope / np.sqrt(np.maximum(varcope, 1e-30)), 0.)
+        zstat = t_to_z(tstat, result['dof'])
+        save_masked(tstat, mask, img, os.path.join(con_dir, 'tstat' + name))
+        save_masked(zstat, mask, img, os.path.join(con_dir, 'zstat' + name))
+    if not target_only:
+        filename = os.path.join(out_dir, 'modelfit', 'estimates', model_dir, 'sigmasquareds.nii.gz')
+        if sigmasq_file is None:
+            save_masked(result['sigmasq'], mask, img, filename)
+        else:
+            link_file(sigmasq_file, filename)
+    if write_variance:
+        dof_dir = os.path.join(out_dir, 'modelfit', 'dofs', model_dir)
+        if not os.path.exists(dof_dir):
+            os.makedirs(dof_dir)
+        np.savetxt(os.path.join(dof_dir, 'dof'), [result['dof']], fmt = '%d')
+
+
+# Hard-link src to dst (replacing dst), copying when the file system has no hard links
+def link_file(src, dst):
+    out_dir = os.path.dirname(dst)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+    return dst
+
+
+# Fit every trial model of a single run and write its per-condition statistics
+def fit_run_models(in_file, models, model_ids, out_dir, n_vols = 197, tr = 2.0,
+                   threshold = 0.0, method = 'batched', chunk_size = 20000,
+                   target_only = False, with_variance = False, buffer_dir = None,
+                   store = None):
+    if buffer_dir:
+        data, mask, img = shared_run(in_file, buffer_dir, n_vols, threshold)
+    else:
+        data, mask, img = load_run(in_file, n_vols, threshold)
+        data -= data.mean(axis = 0)
+
+    designs = []
+    names = []
+    for info in models:
+        design, design_names = model_design(info, n_vols, tr)
+        designs.append(design)
+        names.append(design_names)
+    n_cons = [len(info.conditions) for info in models]
+
+    if method == 'batched':
+        results = solve_batched(designs, n_cons, data, n_vols, chunk_size, target_only)
+    elif method == 'projection':
+        results = solve_projected(designs, names, n_cons, data, n_vols, chunk_size, target_only)
+    else:
+        raise ValueError('Unknown LSS method: {0}'.format(method))
+
+    for result, info, model_id in zip(results, models, model_ids):
+        write_model_outputs(result, info, model_id, mask, img, out_dir,
+                            target_only, with_variance)
+        # The trial of interest is always the first column
+        if store is not None and result['columns'][0] == 0:
+            store.write_trial(model_id, result['copes'][0], mask)
+
+
+# Single LSA design for the trial models of a run: one column per trial (condition
+# 01 of each model) followed by the columns every model shares
+def lsa_design(models, n_vols, tr):
+    trials = event_regressors([info.onsets[0] for info in models],
+                              [info.durations[0] for info in models],
+                              [info.amplitudes[0] for info in models], n_vols, tr)
+    shared_design, shared_names = model_design(models[0], n_vols, tr)
+    names = [list(info.conditions) + list(info.regressor_names or []) for info in models]
+    keep = [col for col, name in enumerate(shared_names)
+            if all(name in model_names for model_names in names)]
+    design = np.column_stack((trials - trials.mean(axis = 0), shared_design[:, keep]))
+    return design, [info.conditions[0] for info in models] + [shared_names[col] for col in keep]
+
+
+# Variance inflation factor and largest absolute correlation of each trial regressor
+def trial_collinearity(design, n_trials):
+    xtx_inv = np.linalg.pinv(np.dot(design.T, design))
+    ss = (design ** 2).sum(axis = 0)
+    vif = np.diag(xtx_inv)[:n_trials] * ss[:n_trials]
+    corr = np.corrcoef(design[:, :n_trials].T) if n_trials > 1 else np.ones((1, 1))
+    np.fill_diagonal(corr, 0.)
+    return vif, np.abs(corr).max(axis = 1)
+
+
+# Write the collinearity table of one LSA run
+def write_collinearity(filename, model_ids, names, vif, max_corr):
+    out_dir = os.path.dirname(filename)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(filename, 'w') as out_file:
+        out_file.write('model\tcondition\tvif\tmax_abs_corr\n')
+        for model_id, name, curr_vif, curr_corr in zip(model_ids, names, vif, max_corr):
+            out_file.write('{0}\t{1}\t{2:.4f}\t{3:.4f}\n'.format(model_id, name, curr_vif, curr_corr))
+
+
+# Fit one LSA model for the run and write each trial like its LSS model
+def fit_run_lsa(in_file, models, model_ids, out_dir, n_vols = 197, tr = 2.0,
+                threshold = 0.0, chunk_size = 20000, target_only = False,
+                with_variance = False, buffer_dir = None, run_label = None, store = None):
+    if buffer_dir:
+        data, mask, img = shared_run(in_file, buffer_dir, n_vols, threshold)
+    else:
+        data, mask, img = load_run(in_file, n_vols, threshold)
+        data -= data.mean(axis = 0)
+
+    design, names = lsa_design(models, n_vols, tr)
+    n_trials = len(models)
+    vif, max_corr = trial_collinearity(design, n_trials)
+    if run_label is None:
+        match = re.search(r'_run(\d+)_', models[0].conditions[0])
+        run_label = match.group(1) if match else os.path.basename(in_file).split('.')[0]
+    write_collinearity(os.path.join(out_dir, 'modelfit', 'lsa_collinearity', 'run{0}.txt'.format(run_label)),
+                       model_ids, names[:n_trials], vif, max_corr)
+
+    # One fit gives the whole beta series of the run
+    result = solve_batched([design], [n_trials], data, n_vols, chunk_size)[0]
+    # sigmasquareds is the same for every trial of the run: written once, then linked
+    sigmasq_file = None
+    for trial, (info, model_id) in enumerate(zip(models, model_ids)):
+        trial_result = dict(columns = [0],
+                            copes = result['copes'][trial:trial + 1],
+                            var_scale = result['var_scale'][trial:trial + 1],
+                            sigmasq = result['sigmasq'],
+                            dof = result['dof'])
+        write_model_outputs(trial_result, info, model_id, mask, img, out_dir,
+                            target_only, with_variance, sigmasq_file)
+        if sigmasq_file is None and not target_only:
+            sigmasq_file = os.path.join(out_dir, 'modelfit', 'estimates',
+                                        '_estimate_model{0}'.format(model_id), 'sigmasquareds.nii.gz')
+        if store is not None:
+            store.write_trial(model_id, trial_result['copes'][0], mask)
+    return vif, max_corr
+
+
+# Rough peak memory (GB) of fitting a set of trial models of one run
+def task_memory_gb(in_file, models, n_vols, chunk_size = 20000, buffered = False):
+    n_vox = int(np.prod(nb.load(in_file).shape[:3]))
+    n_cols = max(len(info.conditions) + len(info.regressors or []) for info in models)
+    # Run data at the stored precision (page cache only when memory-mapped from a buffer)
+    item = np.dtype(precision_dtype()).itemsize
+    data = 0 if buffered else n_vox * n_vols * item
+    # Estimates of every model plus the float64 chunk workspace
+    estimates = len(models) * n_cols * n_vox * item
+    workspace = 3 * len(models) * n_cols * min(chunk_size, n_vox) * 8
+    return (data + estimates + workspace) / 1024. ** 3
+
+
+# Pool task: fit one run's (batch of) trial models and write them out
+def fit_task(task):
+    store = None
+    if task['store_dir']:
+        store = BetaSeriesStore(task['store_dir'], mode = 'r+')
+    if task['method'] == 'lsa':
+        fit_run_lsa(task['in_file'], task['models'], task['model_ids'], task['out_dir'],
+                    store = store, **task['options'])
+    else:
+        fit_run_models(task['in_file'], task['models'], task['model_ids'], task['out_dir'],
+                       method = task['method'], store = store, **task['options'])
+    if store is not None:
+        store.copes.flush()
+    return task['in_file'], task['model_ids']
+
+
+# Fit all trial models of a subject, run by run on a bounded local pool
+# models[i] is fit against epi_files[i]; model i is written to _estimate_model{i}
+# method 'lsa' replaces the per-trial LSS models with one LSA fit per run
+# models_per_task splits a run into batches (only with a buffer directory, so the
+# batches share one decompressed copy); max_runs caps the runs loaded at once
+# Returns the (in_file, model_ids) fitted by each task, in task order
+def fit_lss_models(models, epi_files, out_dir, n_vols = 197, tr = 2.0, threshold = 0.0,
+                   method = 'batched', target_only = False, with_variance = False,
+                   buffer_dir = None, store_dir = None, n_procs = 1, memory_gb = None,
+                   max_runs = None, models_per_task = None):
+    if store_dir:
+        BetaSeriesStore.create(store_dir, nb.load(epi_files[0]),
+                               [info.conditions[0] for info in models])
+    runs = {}
+    for model_id, (info, in_file) in enumerate(zip(models, epi_files)):
+        runs.setdefault(in_file, []).append((model_id, info))
+
+    options = dict(n_vols = n_vols, tr = tr, threshold = threshold, target_only = target_only,
+                   with_variance = with_variance, buffer_dir = buffer_dir)
+    tasks = []
+    for in_file in sorted(runs):
+        batch = len(runs[in_file])
+        if models_per_task and buffer_dir and method != 'lsa':
+            batch = models_per_task
+        for start in range(0, len(runs[in_file]), batch):
+            members = runs[in_file][start:start + batch]
+            tasks.append(dict(in_file = in_file, method = method, out_dir = out_dir,
+                              store_dir = store_dir, options = options,
+                              model_ids = [model_id for model_id, _ in members],
+                              models = [info for _, info in members]))
+
+    task_gb = max(task_memory_gb(task['in_file'], task['models'], n_vols,
+                                 buffered = bool(buffer_dir)) for task in tasks)
+    fitted = [None] * len(tasks)
+    for idx, result in bounded_map(fit_task, tasks, n_procs, memory_gb, task_gb,
+                                   groups = [task['in_file'] for task in tasks],
+                                   max_groups = max_runs):
+        fitted[idx] = result
+    return fitted
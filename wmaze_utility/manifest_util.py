@@ -0,0 +1,227 @@
+"""
+=====================================================
+Manifest utilities -- first-level output index
+=====================================================
+A machine-readable index of a subject's first-level ``modelfit`` tree, so the
+second level looks contrasts, runs and DOFs up instead of globbing
+``_estimate_model*/cope??_{contrast}.nii.gz`` per contrast and slicing run
+numbers and contrast names out of the paths.
+
+``modelfit/manifest.tsv`` has one row per file:
+
+    run   contrast   stat   path                                          dof
+    0     A_corr     cope   contrasts/_estimate_model0/cope01_A_corr.nii.gz  189
+    0                dof    dofs/_estimate_model0/dof                      189
+
+``stat`` is cope, varcope, tstat, zstat or pval for contrast maps and dof for
+the run's dof file; ``path`` is relative to the ``modelfit`` directory. Runs
+of a first level fit with ``-S`` are listed from ``modelfit/store``, their
+maps as store rows (``store/run0/cope.npy#0``, see stat_store), which
+``fixedfx_util`` reads without a NIfTI export. The
+lvl1 scripts write it once their DataSink is done (``sink_manifest``) and
+``multimodel_util`` after sinking each model. ``load_manifest`` reads it, or
+builds it with one listing per run directory for trees written before it
+existed or refit after it was written. An empty manifest is never written:
+a modelfit tree without outputs raises ``ValueError``.
+"""
+
+import os
+import re
+from collections import OrderedDict
+
+
+MANIFEST_NAME = 'manifest.tsv'
+COLUMNS = ('run', 'contrast', 'stat', 'path', 'dof')
+
+RUN_DIR = re.compile(r'^_estimate_model(\d+)$')
+STORE_RUN_DIR = re.compile(r'^run(\d+)$')
+# Contrast statistics listed per contrast (NIfTI maps or store rows)
+CONTRAST_STATS = ('cope', 'varcope', 'tstat', 'zstat', 'pval')
+CONTRAST_FILE = re.compile(r'^(cope|varcope|tstat|zstat)(\d+)_(.+?)(_pval)?\.nii(\.gz)?$')
+
+
+# Manifest rows of a sunk modelfit tree: one listing per _estimate_model{n} directory
+def scan_modelfit(modelfit_dir):
+    rows = []
+    dofs = {}
+    dof_base = os.path.join(modelfit_dir, 'dofs')
+    for run, run_dir in run_dirs(dof_base):
+        dof_file = os.path.join(run_dir, 'dof')
+        if os.path.exists(dof_file):
+            with open(dof_file) as in_file:
+                dofs[run] = int(float(in_file.read().split()[0]))
+            rows.append((run, '', 'dof', os.path.relpath(dof_file, modelfit_dir), dofs[run]))
+    for run, run_dir in run_dirs(os.path.join(modelfit_dir, 'contrasts')):
+        for filename in sorted(os.listdir(run_dir)):
+            match = CONTRAST_FILE.match(filename)
+            if match is None:
+                continue
+            stat = 'pval' if match.group(4) else match.group(1)
+            rows.append((run, match.group(3), stat, os.path.relpath(os.path.join(run_dir, filename), modelfit_dir),
+                         dofs.get(run, '')))
+    rows.extend(scan_store(modelfit_dir, set(row[0] for row in rows)))
+    return sorted(rows, key = lambda row: (row[0], row[1], row[2]))
+
+
+# Manifest rows of the runs in modelfit/store (first level fit with -S), except the given
+# runs (already sunk as NIfTI); contrast maps are listed as store references (stat_store.store_ref)
+def scan_store(modelfit_dir, skip_runs = ()):
+    store_dir = os.path.join(modelfit_dir, 'store')
+    if not os.path.exists(os.path.join(store_dir, 'index.npy')):
+        return []
+    from wmaze_utility.stat_store import StatStore, store_ref
+    store = StatStore(store_dir)
+    rows = []
+    for run in store.runs():
+        if run in skip_runs:
+            continue
+        dof = store.dof(run)
+        rows.append((run, '', 'dof', os.path.join('store', 'run{0}'.format(run), 'dof'), dof))
+        con_names = store.contrast_names(run)
+        for stat in CONTRAST_STATS:
+            if stat not in store.stats(run):
+                continue
+            rows.extend((run, name, stat, store_ref('store', run, stat, row), dof)
+                        for row, name in enumerate(con_names))
+    return rows
+
+
+# (run, directory) of the _estimate_model{n} directories under base, in run order
+def run_dirs(base):
+    if not os.path.isdir(base):
+        return []
+    found = []
+    for name in os.listdir(base):
+        match = RUN_DIR.match(name)
+        if match and os.path.isdir(os.path.join(base, name)):
+            found.append((int(match.group(1)), os.path.join(base, name)))
+    return sorted(found)
+
+
+# Newest modification time of the run directories of a modelfit tree (None without any)
+def tree_mtime(modelfit_dir):
+    mtimes = [os.path.getmtime(run_dir) for folder in ('contrasts', 'dofs')
+              for _, run_dir in run_dirs(os.path.join(modelfit_dir, folder))]
+    store_dir = os.path.join(modelfit_dir, 'store')
+    if os.path.isdir(store_dir):
+        mtimes.extend(os.path.getmtime(os.path.join(store_dir, name)) for name in os.listdir(store_dir)
+                      if STORE_RUN_DIR.match(name))
+    return max(mtimes) if mtimes else None
+
+
+# Manifest rows of a modelfit tree, raising when it holds no first-level outputs
+def scan_rows(modelfit_dir):
+    rows = scan_modelfit(modelfit_dir)
+    if not rows:
+        raise ValueError('No first-level outputs in {0}'.format(modelfit_dir))
+    return rows
+
+
+# Write modelfit/manifest.tsv from the files in the tree; returns its path
+# (never an empty manifest: a tree without outputs raises ValueError)
+def write_manifest(modelfit_dir):
+    rows = scan_rows(modelfit_dir)
+    filename = os.path.join(modelfit_dir, MANIFEST_NAME)
+    tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmp_file, 'w') as out_file:
+        out_file.write('\t'.join(COLUMNS) + '\n')
+        for row in rows:
+            out_file.write('\t'.join(str(value) for value in row) + '\n')
+    os.rename(tmp_file, filename)
+    return filename
+
+
+# Function node body: write the manifest once the DataSink outputs exist
+def sink_manifest(sunk, modelfit_dir):
+    from wmaze_utility.manifest_util import write_manifest
+    return write_manifest(modelfit_dir)
+
+
+class Manifest(object):
+    """First-level outputs of one subject, indexed by contrast, statistic and run."""
+
+    def __init__(self, modelfit_dir, rows):
+        self.modelfit_dir = os.path.abspath(modelfit_dir)
+        self.files = {}
+        self.dof_paths = OrderedDict()
+        self.dof_values = {}
+        for run, contrast, stat, path, dof in rows:
+            path = os.path.join(self.modelfit_dir, path)
+            if stat == 'dof':
+                self.dof_paths[run] = path
+                self.dof_values[run] = dof
+            else:
+                self.files.setdefault((contrast, stat), OrderedDict())[run] = path
+
+    @classmethod
+    def read(cls, modelfit_dir):
+        rows = []
+        with open(os.path.join(modelfit_dir, MANIFEST_NAME)) as in_file:
+            header = in_file.readline().rstrip('\n').split('\t')
+            if tuple(header) != COLUMNS:
+                raise ValueError('Unexpected manifest columns: {0}'.format(header))
+            for line in in_file:
+                run, contrast, stat, path, dof = line.rstrip('\n').split('\t')
+                rows.append((int(run), contrast, stat, path, int(dof) if dof else None))
+        return cls(modelfit_dir, rows)
+
+    # Contrast names with at least one cope, sorted
+    def contrasts(self):
+        return sorted(contrast for contrast, stat in self.files if stat == 'cope')
+
+    # Runs holding a cope of the contrast
+    def runs(self, contrast):
+        return list(self.files.get((contrast, 'cope'), {}))
+
+    # Files of a statistic per contrast, one list in run order for each contrast
+    def stat_files(self, contrasts, stat):
+        return [list(self.files.get((contrast, stat), {}).values()) for contrast in contrasts]
+
+    # dof files per contrast, matching the runs of its copes
+    def dof_files(self, contrasts):
+        return [[self.dof_paths[run] for run in self.runs(contrast)] for contrast in contrasts]
+
+    # Per-run scalar DOFs of a contrast
+    def dofs(self, contrast):
+        return [self.dof_values[run] for run in self.runs(contrast)]
+
+    # Runs with a dof file but no cope of the contrast
+    def missing_runs(self, contrast):
+        return sorted(set(self.dof_paths) - set(self.runs(contrast)))
+
+    # Raise when a contrast has no cope in any run, naming the contrast and its missing runs
+    def check(self, contrasts):
+        for contrast in contrasts:
+            if not self.runs(contrast):
+                raise ValueError('Contrast {0} has no cope in {1} (missing from runs {2})'.format(
+                    contrast, self.modelfit_dir, self.missing_runs(contrast)))
+
+    # Contrasts of a lvl2 list to combine: a fixed list is checked (every contrast needs a run)
+    # and kept whole, otherwise contrasts with a single run are skipped
+    def select(self, contrasts, fixed = False):
+        if fixed:
+            self.check(contrasts)
+            return list(contrasts)
+        return [contrast for contrast in contrasts if len(self.runs(contrast)) > 1]
+
+    # Whether any run of the contrasts is held in a statistics store rather than NIfTI maps
+    def stored(self, contrasts):
+        from wmaze_utility.stat_store import parse_ref
+        return any(parse_ref(path) is not None
+                   for files in self.stat_files(contrasts, 'cope') for path in files)
+
+
+# Manifest of a modelfit directory: read manifest.tsv, or build it from the tree (and
+# write it when possible) for trees sunk before manifests were written or refit since
+# (manifest older than the newest run directory); a missing or empty tree raises ValueError
+def load_manifest(modelfit_dir):
+    newest = tree_mtime(modelfit_dir)
+    if newest is None:
+        raise ValueError('No first-level outputs in {0}'.format(modelfit_dir))
+    filename = os.path.join(modelfit_dir, MANIFEST_NAME)
+    if not os.path.exists(filename) or os.path.getmtime(filename) < newest:
+        try:
+            write_manifest(modelfit_dir)
+        except (IOError, OSError):
+            return Manifest(modelfit_dir, scan_rows(modelfit_dir))
+    return Manifest.read(modelfit_dir)
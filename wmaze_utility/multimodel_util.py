@@ -0,0 +1,237 @@
+"""
+=====================================================
+Multi-model utilities -- joint first-level fitting
+=====================================================
+Fits several first-level models of a subject over one load of its runs,
+in place of one *_lvl1.py workflow per model that each reread and refit
+the same EPI data.
+
+Models are registered in ``MODELS`` with their lvl1 script and functional
+data template. Each model's runs, contrasts and designs come from its own
+script (``subjectinfo`` and ``get_contrasts``, with the filter_regressor
+confounds attached as in ``motion_noise``), so the designs match the
+native workflow (Level1DesignNative, n_vols = 197). Models sharing a data
+template (GLM1, GLM1.2, GLM2, GLM3 and ABC on smoothed_fullspectrum; RSA
+has its own on realigned) are fit together:
+
+1. each run is read once (the first run's mask is kept for the group) and
+   the next run is read while the current one is fit
+2. the shared confounds are projected out of the run once; every model's
+   OLS autocorrelation step then fits only its own EV columns to the
+   projected data (identical residuals, see glm_util)
+3. every model's design is prewhitened and refit against the same buffer
+
+Each model writes its usual ``frstlvl/model_*/<subject>/modelfit`` tree
+(contrasts, estimates and dofs under ``_estimate_model{n}``, designs under
+``_generate_model{n}``, p maps of the first run), or its in-mask statistics
+store with ``store = True``, plus the manifest.tsv the lvl2 scripts read.
+
+    python -m wmaze_utility.multimodel_util -s WMAZE_001 [-m GLM1 GLM2 ...]
+"""
+
+import os
+import glob
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from wmaze_utility.confound_util import load_run_confounds, attach_confounds
+from wmaze_utility.design_util import model_design, contrast_matrix, write_design
+from wmaze_utility.glm_util import confound_basis, project_out, fit_run, mask_weights
+from wmaze_utility.io_util import load_run
+from wmaze_utility.manifest_util import write_manifest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREPROC_DIR = '/home/data/madlab/data/mri/wmaze/preproc'
+FRSTLVL_DIR = '/home/data/madlab/data/mri/wmaze/frstlvl'
+
+SMOOTHED = '{0}/func/smoothed_fullspectrum/_maskfunc2*/*wmaze*.nii.gz'
+REALIGNED = '{0}/func/realigned/*wmaze*.nii.gz'
+# Per-run noise files only (filter_regressor00.txt, ...), as GLM2_lvl1.py and LSS_lvl1.py grab them
+NOISE = '{0}/noise/filter_regressor??.txt'
+
+# Model name -> lvl1 and lvl2 scripts (relative to the repository root) and functional data template
+MODELS = OrderedDict([('GLM1', dict(script = 'model_GLM1/GLM1_lvl1.py', lvl2 = 'model_GLM1/GLM1_lvl2.py', func = SMOOTHED)),
+                      ('GLM1.2', dict(script = 'model_GLM1.2/GLM1.2_lvl1.py', lvl2 = 'model_GLM1.2/GLM1.2_lvl2.py', func = SMOOTHED)),
+                      ('GLM2', dict(script = 'model_GLM2/GLM2_lvl1.py', lvl2 = 'model_GLM2/GLM2_lvl2.py', func = SMOOTHED)),
+                      ('GLM3', dict(script = 'model_GLM3/GLM3_lvl1.py', lvl2 = 'model_GLM3/GLM3_lvl2.py', func = SMOOTHED)),
+                      ('ABC', dict(script = 'model_ABC/ABC_lvl1.py', lvl2 = 'model_ABC/ABC_lvl2.py', func = SMOOTHED)),
+                      ('RSA', dict(script = 'model_RSA/RSA_lvl1.py', lvl2 = 'model_RSA/RSA_lvl2.py', func = REALIGNED))])
+
+# Statistics the native lvl1 workflows sink; p maps only for the first run
+RUN_STATS = ['pe', 'cope', 'varcope', 'zstat']
+
+_SCRIPTS = {}
+
+
+# Import a model's lvl1 script (once) for its subjectinfo and get_contrasts
+def load_model_script(model):
+    if model not in _SCRIPTS:
+        path = os.path.join(REPO_DIR, MODELS[model]['script'])
+        module_name = 'wmaze_lvl1_{0}'.format(model.replace('.', '_'))
+        try:
+            from importlib.util import spec_from_file_location, module_from_spec
+        except ImportError:
+            import imp
+            _SCRIPTS[model] = imp.load_source(module_name, path)
+        else:
+            spec = spec_from_file_location(module_name, path)
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _SCRIPTS[model] = module
+    return _SCRIPTS[model]
+
+
+# Designs of every run of a model: (design, contrast names, contrast weights, EV columns)
+def model_runs(model, subject_id, noise_files, n_vols = 197, tr = 2.0):
+    script = load_model_script(model)
+    info = script.subjectinfo(subject_id)
+    contrasts = script.get_contrasts(subject_id, info)
+    if len(noise_files) != len(info):
+        raise ValueError('{0}: {1} runs but {2} noise files'.format(model, len(info), len(noise_files)))
+    runs = []
+    for run_info, run_contrasts, noise_file in zip(info, contrasts, noise_files):
+        attach_confounds(run_info, load_run_confounds(noise_file))
+        design, names = model_design(run_info, n_vols, tr)
+        con_names, weights = contrast_matrix(run_contrasts, names)
+        runs.append((design, con_names, weights, len(run_info.conditions)))
+    return runs
+
+
+# Move one run's results into the model's sink tree, as the lvl1 DataSink lays them out
+def sink_run(result, design_files, modelfit_dir, run):
+    targets = [(result.get('copes', []) + result.get('varcopes', []) + result.get('zstats', []) +
+                result.get('pvals', []), 'contrasts', '_estimate_model'),
+               (result.get('param_estimates', []) + [result['sigmasquareds']], 'estimates', '_estimate_model'),
+               ([result['dof_file']], 'dofs', '_estimate_model'),
+               ([design_files[key] for key in ('design_image', 'design_cov', 'design_file')],
+                'design', '_generate_model')]
+    for files, folder, prefix in targets:
+        out_dir = os.path.join(modelfit_dir, folder, '{0}{1}'.format(prefix, run))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for filename in files:
+            shutil.move(filename, os.path.join(out_dir, os.path.basename(filename)))
+
+
+# Fit the given models of one subject, one data load per functional data template
+# Returns {model: modelfit directory (or store directory)}
+def fit_subject_models(subject_id, models = None, n_vols = 197, tr = 2.0, threshold = 0.0,
+                       preproc_dir = PREPROC_DIR, out_base = FRSTLVL_DIR, store = False,
+                       smooth_autocorr = True, mask_size = 5, n_threads = 1, work_dir = None):
+    models = list(models or MODELS)
+    unknown = [model for model in models if model not in MODELS]
+    if unknown:
+        raise ValueError('Unknown models: {0}'.format(unknown))
+    noise_files = sorted(glob.glob(os.path.join(preproc_dir, NOISE.format(subject_id))))
+    groups = OrderedDict()
+    for model in models:
+        groups.setdefault(MODELS[model]['func'], []).append(model)
+
+    outputs = {}
+    work_dir = tempfile.mkdtemp(prefix = 'multimodel_', dir = work_dir)
+    try:
+        for template, group in groups.items():
+            in_files = sorted(glob.glob(os.path.join(preproc_dir, template.format(subject_id))))
+            if not in_files:
+                raise ValueError('No runs for {0} in {1}'.format(subject_id, template))
+            designs = dict((model, model_runs(model, subject_id, noise_files, n_vols, tr)) for model in group)
+            outputs.update(fit_group(subject_id, group, designs, in_files, n_vols, threshold, out_base,
+                                     store, smooth_autocorr, mask_size, n_threads, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    return outputs
+
+
+# Fit every model of a group run by run over one load of each run
+def fit_group(subject_id, group, designs, in_files, n_vols, threshold, out_base, store,
+              smooth_autocorr, mask_size, n_threads, work_dir):
+    for model in group:
+        if len(designs[model]) != len(in_files):
+            raise ValueError('{0}: {1} runs but {2} functional files'.format(
+                model, len(designs[model]), len(in_files)))
+    # The confound projection of group[0] is reused for every model: their confound columns must match
+    for run, (design, _, _, n_evs) in enumerate(designs[group[0]]):
+        for model in group[1:]:
+            other, _, _, other_evs = designs[model][run]
+            if other.shape[1] - other_evs != design.shape[1] - n_evs or \
+                    not np.allclose(other[:, other_evs:], design[:, n_evs:]):
+                raise ValueError('Confound columns of run {0} differ between {1} and {2}'.format(run, group[0], model))
+    modelfit_dirs = OrderedDict((model, os.path.join(out_base, 'model_{0}'.format(model), subject_id, 'modelfit'))
+                                for model in group)
+    data, mask, img = load_run(in_files[0], n_vols, threshold)
+    weights = mask_weights(mask, mask_size) if smooth_autocorr else None
+    stores = {}
+    if store:
+        from wmaze_utility.stat_store import StatStore
+        stores = dict((model, StatStore.create(os.path.join(modelfit_dir, 'store'), mask, img))
+                      for model, modelfit_dir in modelfit_dirs.items())
+
+    loader = ThreadPool(1)
+    try:
+        for run in range(len(in_files)):
+            pending = None
+            if run + 1 < len(in_files):
+                pending = loader.apply_async(load_run, (in_files[run + 1], n_vols, threshold, mask))
+            data -= data.mean(axis = 0)
+            # Confound columns are the same in every model of the group: project them out once
+            design, _, _, n_evs = designs[group[0]][run]
+            basis = confound_basis(design[:, n_evs:])
+            resid = project_out(data, basis, n_threads = n_threads)
+            for model in group:
+                design, con_names, weights_con, n_evs = designs[model][run]
+                evs = design[:, :n_evs]
+                stats = RUN_STATS + ['pval'] if run == 0 else RUN_STATS
+                run_dir = os.path.join(work_dir, model, str(run))
+                result = fit_run(data, mask, img, design, con_names, weights_con,
+                                 os.path.join(run_dir, 'results'), smooth_autocorr, mask_size,
+                                 n_threads = n_threads, weights = weights, stats = stats,
+                                 final_names = True, store = stores.get(model), run = run,
+                                 acf_data = resid, acf_design = evs - basis.dot(basis.T.dot(evs)))
+                os.makedirs(os.path.join(run_dir, 'design'))
+                design_files = write_design(design, con_names, weights_con, os.path.join(run_dir, 'design'))
+                if store:
+                    shutil.copy(design_files['design_file'],
+                                os.path.join(result['run_dir'], 'design.mat'))
+                else:
+                    sink_run(result, design_files, modelfit_dirs[model], run)
+            del resid
+            if pending is not None:
+                data, _, img = pending.get()
+    finally:
+        loader.close()
+        loader.join()
+    # The manifest lists the store runs in store mode, so the second level reads them as well
+    for modelfit_dir in modelfit_dirs.values():
+        write_manifest(modelfit_dir)
+    if store:
+        return dict((model, stores[model].store_dir) for model in group)
+    return modelfit_dirs
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Fit several first-level models over one load of the runs')
+    parser.add_argument('-s', '--subject_id', dest = 'subject_id', required = True, help = 'Current subject id')
+    parser.add_argument('-m', '--models', dest = 'models', nargs = '+', choices = list(MODELS),
+                        help = 'Models to fit (default: all)')
+    parser.add_argument('-o', '--output_dir', dest = 'out_dir', default = FRSTLVL_DIR,
+                        help = 'Base holding the model_* trees')
+    parser.add_argument('-w', '--work_dir', dest = 'work_dir', help = 'Working directory base')
+    parser.add_argument('-t', '--n_threads', dest = 'n_threads', type = int, default = 1,
+                        help = 'Threads used over voxel chunks')
+    parser.add_argument('-S', '--store', dest = 'store', action = 'store_true',
+                        help = 'Write in-mask statistics stores instead of NIfTI maps')
+    parser.add_argument('-P', '--precision', dest = 'precision', choices = ['float32', 'float64'],
+                        help = 'Image data precision (default float32, see wmaze_utility.precision)')
+    args = parser.parse_args()
+    if args.precision:
+        from wmaze_utility.precision import set_precision
+        set_precision(args.precision)
+    for model, out_dir in fit_subject_models(args.subject_id, args.models, out_base = args.out_dir,
+                                             store = args.store, n_threads = args.n_threads,
+                                             work_dir = args.work_dir).items():
+        print('{0}: {1}'.format(model, out_dir))
@@ -0,0 +1,70 @@
+"""
+==========================================
+Parallel utilities -- bounded local pools
+==========================================
+Runs independent fitting tasks on a local process pool inside one allocation
+instead of submitting each of them to the scheduler.
+
+The number of workers is limited by the requested process count and by a
+memory budget (estimated GB per task), and tasks can be grouped (e.g. by
+run) with a cap on how many groups are in flight at once, so only a bounded
+number of runs is ever loaded. Results are yielded as tasks finish, so
+callers can write them out immediately.
+"""
+
+import time
+from multiprocessing import Pool
+
+
+# Workers allowed by the process count and the memory budget
+def budget_workers(n_procs = 1, memory_gb = None, task_gb = None):
+    n_workers = max(1, int(n_procs or 1))
+    if memory_gb and task_gb:
+        n_workers = min(n_workers, max(1, int(memory_gb // task_gb)))
+    return n_workers
+
+
+# Index of the next pending task that keeps the number of active groups under the cap
+def next_task(pending, running, groups, max_groups):
+    if groups is None or not max_groups:
+        return pending[0]
+    active = set(groups[idx] for idx in running)
+    for idx in pending:
+        if groups[idx] in active or len(active) < max_groups:
+            return idx
+    return None
+
+
+# Run func(task) for every task, yielding (task index, result) as tasks finish
+# groups[i] labels task i (e.g. its run); at most max_groups groups run at once
+def bounded_map(func, tasks, n_procs = 1, memory_gb = None, task_gb = None,
+                groups = None, max_groups = None, poll = 0.05):
+    n_workers = min(budget_workers(n_procs, memory_gb, task_gb), max(1, len(tasks)))
+    if n_workers == 1:
+        for idx, task in enumerate(tasks):
+            yield idx, func(task)
+        return
+
+    pool = Pool(n_workers)
+    try:
+        pending = list(range(len(tasks)))
+        running = {}
+        while pending or running:
+            while pending and len(running) < n_workers:
+                idx = next_task(pending, running, groups, max_groups)
+                if idx is None:
+                    break
+                pending.remove(idx)
+                running[idx] = pool.apply_async(func, (tasks[idx],))
+            done = [idx for idx, result in running.items() if result.ready()]
+            if not done:
+                time.sleep(poll)
+                continue
+            for idx in done:
+                yield idx, running.pop(idx).get()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
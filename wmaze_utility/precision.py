@@ -0,0 +1,137 @@
+"""
+==============================================
+Precision utilities -- one floating point policy
+==============================================
+A single precision setting for every stage that stores or reads image data:
+native first-level outputs and stores, the lvl2 DOF volumes, ANTs
+normalization of the copes and varcopes, and ROI extraction in the
+notebooks.
+
+The setting lives in the ``WMAZE_PRECISION`` environment variable
+(``float32`` by default, ``float64`` on request), so nipype nodes running
+in other processes or on SLURM follow the workflow that set it. Scripts set
+it with ``set_precision`` (``-P/--precision``). Arithmetic that is sensitive
+to rounding (design inverses, whitening, autocorrelation sums) is still done
+in float64 per voxel chunk; only stored and loaded arrays follow the policy.
+
+``python -m wmaze_utility.precision`` fits the same synthetic runs at both
+precisions and checks the largest differences against the tolerances in
+``TOLERANCES``.
+"""
+
+import os
+import time
+import numpy as np
+
+
+PRECISION_ENV = 'WMAZE_PRECISION'
+PRECISIONS = dict(float32 = np.float32, float64 = np.float64)
+DEFAULT_PRECISION = 'float32'
+
+# Largest absolute difference between float32 and float64 results accepted by the benchmark
+# (copes/varcopes relative to their largest in-mask magnitude)
+TOLERANCES = dict(cope = 1e-4, varcope = 1e-4, zstat = 1e-3)
+
+
+# Name of the precision in use: the given one, else the environment, else float32
+def precision_name(precision = None):
+    precision = precision or os.environ.get(PRECISION_ENV) or DEFAULT_PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {0}, expected one of {1}'.format(precision, sorted(PRECISIONS)))
+    return precision
+
+
+# NumPy dtype of the precision in use
+def precision_dtype(precision = None):
+    return PRECISIONS[precision_name(precision)]
+
+
+# Set the precision for this process and every process it starts
+def set_precision(precision):
+    os.environ[PRECISION_ENV] = precision_name(precision)
+    return os.environ[PRECISION_ENV]
+
+
+# Extra antsApplyTransforms arguments: --float unless float64 was requested
+def ants_precision_args(precision = None):
+    return '--float' if precision_name(precision) == 'float32' else ''
+
+
+# Image data at the precision in use (replaces img.get_data(), which upcasts to float64)
+def load_volume(img, precision = None):
+    if not hasattr(img, 'dataobj'):
+        import nibabel as nb
+        img = nb.load(img)
+    return np.asarray(img.dataobj, dtype = precision_dtype(precision))
+
+
+# Synthetic runs: smooth AR(1) noise plus two effects over a block design
+def synthetic_run(n_vols = 197, n_vox = 4000, seed = 0):
+    rng = np.random.RandomState(seed)
+    frames = np.arange(n_vols)
+    design = np.column_stack([(frames // 10) % 2, (frames // 15) % 2]).astype(float)
+    design -= design.mean(axis = 0)
+    noise = rng.randn(n_vols, n_vox)
+    for idx in range(1, n_vols):
+        noise[idx] += 0.3 * noise[idx - 1]
+    effects = rng.randn(2, n_vox) * [[2.], [1.]]
+    data = 1000. + np.dot(design, effects) + 5. * noise
+    return data, design
+
+
+# Fit synthetic runs at float32 and float64 and compare copes, varcopes and zstats
+# Returns one row per run: largest differences, fit times and data bytes per precision
+def benchmark(n_runs = 3, n_vols = 197, n_vox = 4000, n_threads = 1):
+    from wmaze_utility.glm_util import (ols_autocorrelation, tukey_taper, whitened_fit)
+    contrasts = np.array([[1., 0.], [1., -1.]])
+    previous = os.environ.get(PRECISION_ENV)
+    rows = []
+    try:
+        for run in range(n_runs):
+            data, design = synthetic_run(n_vols, n_vox, seed = run)
+            fits = {}
+            row = dict(run = run)
+            for precision in ('float64', 'float32'):
+                set_precision(precision)
+                run_data = data.astype(precision_dtype())
+                run_data -= run_data.mean(axis = 0)
+                start = time.time()
+                tukey_m = int(2 * np.sqrt(n_vols))
+                acf = tukey_taper(ols_autocorrelation(run_data, design, tukey_m, n_threads = n_threads), tukey_m)
+                fits[precision] = whitened_fit(run_data, design, acf, contrasts, n_threads = n_threads,
+                                               stats = ('cope', 'varcope', 'zstat'))
+                row['seconds_{0}'.format(precision)] = time.time() - start
+                row['bytes_{0}'.format(precision)] = run_data.nbytes
+            for stat in TOLERANCES:
+                exact = fits['float64'][stat].astype(np.float64)
+                diff = np.abs(fits['float32'][stat] - exact).max()
+                if stat != 'zstat':
+                    diff /= max(np.abs(exact).max(), 1e-30)
+                row[stat] = diff
+            rows.append(row)
+    finally:
+        if previous is None:
+            os.environ.pop(PRECISION_ENV, None)
+        else:
+            os.environ[PRECISION_ENV] = previous
+    return rows
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'float32 vs float64 native GLM benchmark')
+    parser.add_argument('--runs', dest = 'n_runs', type = int, default = 3)
+    parser.add_argument('--vols', dest = 'n_vols', type = int, default = 197)
+    parser.add_argument('--voxels', dest = 'n_vox', type = int, default = 4000)
+    parser.add_argument('--threads', dest = 'n_threads', type = int, default = 1)
+    args = parser.parse_args()
+    failed = False
+    for row in benchmark(args.n_runs, args.n_vols, args.n_vox, args.n_threads):
+        ok = all(row[stat] <= tol for stat, tol in TOLERANCES.items())
+        failed = failed or not ok
+        print('run {0}: cope {1:.2e} varcope {2:.2e} zstat {3:.2e} | {4:.2f}s/{5:.2f}s | '
+              '{6:.1f}/{7:.1f} MB | {8}'.format(row['run'], row['cope'], row['varcope'], row['zstat'],
+                                                 row['seconds_float32'], row['seconds_float64'],
+                                                 row['bytes_float32'] / 1e6, row['bytes_float64'] / 1e6,
+                                                 'ok' if ok else 'OUT OF TOLERANCE'))
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,187 @@
+"""
+==================================================
+Statistics store -- in-mask first-level statistics
+==================================================
+Optional storage for the native first level in place of one full-volume
+NIfTI per run, statistic and contrast. Only the voxels of the subject's
+brain mask are kept. A store is a directory holding
+
+    index.npy          -- flat (C order) voxel index of the in-mask voxels
+    mask.nii.gz        -- the mask itself (grid and affine of every map)
+    run{n}/{stat}.npy  -- (rows, in-mask voxels) array per statistic, float32
+                          unless float64 was requested (wmaze_utility.precision):
+                          pe, cope, varcope, tstat, zstat, pval (those that
+                          were computed), sigmasquareds and threshac1
+    run{n}/contrasts.txt -- contrast names, one per cope row
+    run{n}/dof         -- degrees of freedom, as FILMGLS writes it
+
+Run n is the run written to ``_estimate_model{n}`` by the NIfTI layout.
+Arrays are read memory-mapped, so a later stage reads only the rows it uses
+and never the out-of-brain voxels. ``to_nifti`` and ``export_run`` write
+full-volume maps on demand, named as the estimator would have named them.
+
+The first-level manifest lists one row of a stored statistic as a reference,
+``store/run{n}/{stat}.npy#{row}`` (``store_ref``); the second level reads it
+with ``read_ref`` at the voxels of its own mask, without any NIfTI export.
+"""
+
+import os
+import re
+import numpy as np
+import nibabel as nb
+
+from wmaze_utility.glm_util import stat_filename
+from wmaze_utility.precision import precision_dtype
+
+
+# Store names of the per-run statistics and the FILMGLS files they replace
+RUN_STATS = ('pe', 'cope', 'varcope', 'tstat', 'zstat', 'pval', 'sigmasquareds', 'threshac1')
+
+# Reference to one row of a stored statistic: <store_dir>/run{n}/{stat}.npy#{row}
+STORE_REF = re.compile(r'^(.+)/run(\d+)/(\w+)\.npy#(\d+)$')
+
+_STORES = {}
+
+
+class StatStore(object):
+    """In-mask first-level statistics of one subject (see module docstring)."""
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        self.mask_img = nb.load(os.path.join(store_dir, 'mask.nii.gz'))
+        self.index = np.load(os.path.join(store_dir, 'index.npy'))
+
+    # Create a store for the given boolean mask on the grid of ref_img
+    @classmethod
+    def create(cls, store_dir, mask, ref_img):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        mask_img = nb.Nifti1Image(mask.astype(np.uint8), ref_img.affine)
+        mask_img.header.set_zooms(ref_img.header.get_zooms()[:3])
+        mask_img.to_filename(os.path.join(store_dir, 'mask.nii.gz'))
+        np.save(os.path.join(store_dir, 'index.npy'), np.flatnonzero(mask.ravel()))
+        return cls(store_dir)
+
+    @property
+    def shape(self):
+        return self.mask_img.shape[:3]
+
+    @property
+    def n_voxels(self):
+        return len(self.index)
+
+    def run_dir(self, run):
+        return os.path.join(self.store_dir, 'run{0}'.format(run))
+
+    # Run numbers present in the store
+    def runs(self):
+        return sorted(int(name[3:]) for name in os.listdir(self.store_dir)
+                      if name.startswith('run') and name[3:].isdigit())
+
+    # Write the statistics of one run: stats maps store names to (rows, voxels) arrays
+    def write_run(self, run, con_names, stats, dof):
+        run_dir = self.run_dir(run)
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        for stat, values in stats.items():
+            if stat not in RUN_STATS:
+                raise ValueError('Unknown statistic: {0}'.format(stat))
+            values = np.atleast_2d(np.asarray(values, dtype = precision_dtype()))
+            if values.shape[1] != self.n_voxels:
+                raise ValueError('{0} has {1} voxels, the store mask has {2}'.format(
+                    stat, values.shape[1], self.n_voxels))
+            np.save(os.path.join(run_dir, '{0}.npy'.format(stat)), values)
+        with open(os.path.join(run_dir, 'contrasts.txt'), 'w') as out_file:
+            out_file.write(''.join('{0}\n'.format(name) for name in con_names))
+        np.savetxt(os.path.join(run_dir, 'dof'), [dof], fmt = '%d')
+        return run_dir
+
+    # (rows, voxels) array of a statistic of one run, memory-mapped
+    def read(self, run, stat):
+        return np.load(os.path.join(self.run_dir(run), '{0}.npy'.format(stat)), mmap_mode = 'r')
+
+    def contrast_names(self, run):
+        with open(os.path.join(self.run_dir(run), 'contrasts.txt')) as in_file:
+            return [line.rstrip('\n') for line in in_file if line.strip()]
+
+    def dof(self, run):
+        return int(np.loadtxt(os.path.join(self.run_dir(run), 'dof')))
+
+    # Statistics stored for a run
+    def stats(self, run):
+        return [stat for stat in RUN_STATS
+                if os.path.exists(os.path.join(self.run_dir(run), '{0}.npy'.format(stat)))]
+
+    # (rows, mask voxels) values of a statistic at the voxels of another mask on the store grid
+    # (zero where that mask leaves the store mask, as in the exported maps)
+    def read_masked(self, run, stat, rows, mask):
+        if tuple(mask.shape) != tuple(self.shape):
+            raise ValueError('The mask is {0}, the store {1} is {2}'.format(mask.shape, self.store_dir, self.shape))
+        key = mask.tobytes()
+        if getattr(self, '_positions', (None,))[0] != key:
+            flat = np.flatnonzero(mask.ravel())
+            pos = np.minimum(np.searchsorted(self.index, flat), max(self.n_voxels - 1, 0))
+            inside = self.index[pos] == flat if self.n_voxels else np.zeros(len(flat), dtype = bool)
+            self._positions = (key, pos[inside], inside)
+        _, pos, inside = self._positions
+        values = np.zeros((len(rows), len(inside)), dtype = precision_dtype())
+        values[:, inside] = self.read(run, stat)[rows][:, pos]
+        return values
+
+    # Full-volume map of in-mask values
+    def volume(self, values):
+        data = np.zeros(int(np.prod(self.shape)), dtype = values.dtype)
+        data[self.index] = values
+        return data.reshape(self.shape)
+
+    # Write one row of a statistic as a full-volume NIfTI
+    def to_nifti(self, run, stat, row, filename):
+        out_dir = os.path.dirname(filename)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        img = nb.Nifti1Image(self.volume(self.read(run, stat)[row]), self.mask_img.affine)
+        img.header.set_zooms(self.mask_img.header.get_zooms()[:3])
+        img.to_filename(filename)
+        return filename
+
+    # Export a run as the estimator's results directory would hold it
+    # Returns the written files keyed by store statistic name
+    def export_run(self, run, out_dir, stats = None, final_names = False):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        con_names = self.contrast_names(run)
+        files = {}
+        for stat in stats or self.stats(run):
+            if stat in ('sigmasquareds', 'threshac1'):
+                files[stat] = self.to_nifti(run, stat, 0, os.path.join(out_dir, '{0}.nii.gz'.format(stat)))
+                continue
+            files[stat] = [self.to_nifti(run, stat, row, os.path.join(
+                out_dir, stat_filename(stat, row, con_names, final_names)))
+                           for row in range(self.read(run, stat).shape[0])]
+        np.savetxt(os.path.join(out_dir, 'dof'), [self.dof(run)], fmt = '%d')
+        return files
+
+
+# Manifest reference to one row of a stored statistic
+def store_ref(store_dir, run, stat, row):
+    return '{0}/run{1}/{2}.npy#{3}'.format(store_dir, run, stat, row)
+
+
+# (store_dir, run, stat, row) of a store reference, None for a plain file
+def parse_ref(ref):
+    match = STORE_REF.match(str(ref))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), match.group(3), int(match.group(4))
+
+
+# Values of a store reference at the voxels of mask, and the store mask image (the grid of the maps)
+# Stores are opened once per process (again when the store was recreated)
+def read_ref(ref, mask):
+    store_dir, run, stat, row = parse_ref(ref)
+    store_dir = os.path.abspath(store_dir)
+    key = (store_dir, os.path.getmtime(os.path.join(store_dir, 'index.npy')))
+    if key not in _STORES:
+        _STORES[key] = StatStore(store_dir)
+    store = _STORES[key]
+    return store.read_masked(run, stat, [row], mask)[0], store.mask_img
@@ -0,0 +1,27 @@
+"""
+=================================================
+Statistics utilities -- t to z and z to p maps
+=================================================
+"""
+
+import numpy as np
+from scipy import stats
+
+
+# Convert t statistics to z statistics through matched tail probabilities
+def t_to_z(tstat, dof):
+    tstat = np.asarray(tstat, dtype = float)
+    # Work in the upper tail of |t| so large statistics keep their precision
+    logp = stats.t.logsf(np.abs(tstat), dof)
+    zstat = -stats.norm.ppf(np.exp(logp))
+    # Fall back to the asymptotic expansion where exp(logp) underflows
+    tiny = ~np.isfinite(zstat)
+    if np.any(tiny):
+        lp = logp[tiny]
+        zstat[tiny] = np.sqrt(-2. * lp - np.log(-4. * np.pi * lp))
+    return np.sign(tstat) * zstat
+
+
+# Upper tail p values of z statistics, as fslmaths -ztop
+def z_to_p(zstat):
+    return stats.norm.sf(np.asarray(zstat, dtype = float))
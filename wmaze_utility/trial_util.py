@@ -0,0 +1,131 @@
+"""
+==============================================
+Trial utilities -- compact LSS trial models
+==============================================
+Array-backed replacement for the per-trial Bunch construction in the LSS
+subjectinfo functions.
+
+Each run's EV files are parsed once into a ``RunEvents`` table of float
+arrays. Trial models are ``TrialModel`` Bunches that only hold a reference to
+that table plus the trial index; conditions, onsets, durations and amplitudes
+are derived on access as index views of the shared arrays. Regressors are
+likewise derived from the run's shared confounds (see confound_util). All
+models of a run therefore share one copy of the event and confound data, in
+memory and when nipype pickles the model list between nodes.
+
+Model layout matches the original subjectinfo:
+
+    [{key}_run{r}_trl{n}_onset{t}, {key}_allbut_run{r}_trl{n}, pending..., all_remaining]
+
+where the allbut EV is left out when the condition has a single event.
+"""
+
+import hashlib
+import numpy as np
+from copy import deepcopy
+from nipype.interfaces.base import Bunch
+
+
+# Read a three column EV file as an (n, 3) float array (n may be 0)
+def read_ev(filename):
+    data = np.genfromtxt(filename, dtype = float)
+    return np.atleast_2d(data).reshape(-1, 3)
+
+
+class RunEvents(object):
+    """Event table for one run: every condition's onsets/durations/amplitudes."""
+
+    def __init__(self, run, conditions, remaining):
+        self.run = run
+        # conditions: dict of key -> (n, 3) array, iterated in dict order
+        self.conditions = conditions
+        self.keys = list(conditions.keys())
+        self.remaining = remaining
+
+    # Deterministic representation so nipype input hashing is stable across runs
+    def __repr__(self):
+        digest = hashlib.md5()
+        for key in self.keys:
+            digest.update(key.encode())
+            digest.update(np.ascontiguousarray(self.conditions[key]).tobytes())
+        digest.update(np.ascontiguousarray(self.remaining).tobytes())
+        return 'RunEvents(run={0}, md5={1})'.format(self.run, digest.hexdigest())
+
+
+# Parse the EV files of one run; the incorrect condition is dropped when empty
+def load_run_events(ev_dir, run):
+    corr = read_ev(ev_dir + '/run{0}_all_before_B_corr.txt'.format(run))
+    incorr = read_ev(ev_dir + '/run{0}_all_before_B_incorr.txt'.format(run))
+    remaining = read_ev(ev_dir + '/run{0}_all_remaining.txt'.format(run))
+    if incorr.size > 0:
+        conditions = {'FX_before_COND_corr': corr,
+                      'FX_before_COND_incorr': incorr}
+    else:
+        conditions = {'FX_before_COND_corr': corr}
+    return RunEvents(run, conditions, remaining)
+
+
+class TrialModel(Bunch):
+    """LSS model for one trial, backed by the shared RunEvents arrays."""
+
+    def __init__(self, events, key, trial, **kwargs):
+        kwargs.setdefault('tmod', None)
+        kwargs.setdefault('pmod', None)
+        # Shared motion/noise regressors of the run (see confound_util.RunConfounds)
+        kwargs.setdefault('confounds', None)
+        super(TrialModel, self).__init__(events = events, key = key, trial = trial, **kwargs)
+
+    # Event arrays in model order: trial, allbut (if any), pending conditions, all_remaining
+    def _blocks(self):
+        data = self.events.conditions[self.key]
+        blocks = [data[self.trial:self.trial + 1]]
+        if len(data) > 1:
+            # Index view of every other trial of this condition
+            blocks.append(data[np.arange(len(data)) != self.trial])
+        blocks.extend(self.events.conditions[key] for key in self.events.keys if key != self.key)
+        blocks.append(self.events.remaining)
+        return blocks
+
+    @property
+    def conditions(self):
+        run, trial = self.events.run, self.trial + 1
+        onset = self.events.conditions[self.key][self.trial, 0]
+        names = [self.key + '_run%d_trl%d_onset%0.2f' % (run, trial, onset)]
+        if len(self.events.conditions[self.key]) > 1:
+            names.append(self.key + '_allbut_run%d_trl%d' % (run, trial))
+        names.extend(key for key in self.events.keys if key != self.key)
+        names.append('all_remaining')
+        return names
+
+    @property
+    def onsets(self):
+        return [block[:, 0].tolist() for block in self._blocks()]
+
+    @property
+    def durations(self):
+        return [block[:, 1].tolist() for block in self._blocks()]
+
+    @property
+    def amplitudes(self):
+        return [block[:, 2].tolist() for block in self._blocks()]
+
+    @property
+    def regressor_names(self):
+        return list(self.confounds.names) if self.confounds is not None else None
+
+    @property
+    def regressors(self):
+        return self.confounds.columns() if self.confounds is not None else None
+
+    # Bunch.copy would drop the class (and with it the derived fields)
+    def copy(self):
+        model = self.__class__.__new__(self.__class__)
+        model.__dict__.update(deepcopy(self.__dict__))
+        return model
+
+
+# Yield one TrialModel per trial of each condition, in the original model order
+def iter_trial_models(events):
+    for key in events.keys:
+        for trial in range(len(events.conditions[key])):
+            yield TrialModel(events, key, trial)